@@ -0,0 +1,438 @@
+#!/usr/bin/python3
+"""Benchmark the differ with synthetic binary package pairs.
+
+This generates pairs of .deb files of configurable size and churn, stores
+them in a LocalArtifactManager and measures the latency of the /debdiff and
+/diffoscope endpoints with a cold and a warm cache, throughput at various
+concurrency levels (again with a cold and a warm cache) and peak memory use.
+Results are written as JSON.
+
+The differ runs in separate processes, so that its memory use can be
+measured without that of the benchmark itself. Run details normally come
+from the database; the benchmark serves them from memory, so that it can
+run without PostgreSQL.
+"""
+
+import argparse
+import asyncio
+import io
+import itertools
+import json
+import logging
+import multiprocessing
+import multiprocessing.connection
+import os
+import random
+import resource
+import statistics
+import sys
+import tarfile
+import tempfile
+import time
+from contextlib import asynccontextmanager
+
+from aiohttp import ClientSession, web
+from yarl import URL
+
+from janitor.artifacts import LocalArtifactManager
+from janitor.differ import create_app
+
+CAMPAIGN = "benchmark"
+
+
+def _tar(members: dict[str, bytes]) -> bytes:
+    f = io.BytesIO()
+    with tarfile.open(fileobj=f, mode="w:gz") as tf:
+        for name, data in sorted(members.items()):
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            info.mtime = 0
+            tf.addfile(info, io.BytesIO(data))
+    return f.getvalue()
+
+
+def _ar(members: list[tuple[str, bytes]]) -> bytes:
+    out = [b"!<arch>\n"]
+    for name, data in members:
+        out.append(
+            f"{name:<16}{0:<12}{0:<6}{0:<6}{100644:<8}{len(data):<10}`\n".encode()
+        )
+        out.append(data)
+        if len(data) % 2:
+            out.append(b"\n")
+    return b"".join(out)
+
+
+def build_deb(package: str, version: str, files: dict[str, bytes]) -> bytes:
+    """Build a minimal binary package."""
+    control = (
+        f"Package: {package}\n"
+        f"Version: {version}\n"
+        "Architecture: all\n"
+        "Maintainer: Benchmark <benchmark@example.com>\n"
+        f"Installed-Size: {sum(len(d) for d in files.values()) // 1024}\n"
+        "Description: Synthetic package for benchmarking the differ\n"
+    ).encode()
+    return _ar(
+        [
+            ("debian-binary", b"2.0\n"),
+            ("control.tar.gz", _tar({"./control": control})),
+            ("data.tar.gz", _tar(files)),
+        ]
+    )
+
+
+def generate_pair(rng, package, *, size, nfiles, churn):
+    """Generate the file contents for an old and new version of a package.
+
+    Args:
+      size: Total size of the files in the package, in bytes
+      nfiles: Number of files in the package
+      churn: Fraction of files that differ between the old and new version
+    """
+    old_files = {}
+    for i in range(nfiles):
+        lines = size // nfiles // 32
+        old_files[f"./usr/share/{package}/file{i}.txt"] = b"".join(
+            b"%016x%015x\n" % (rng.getrandbits(64), j) for j in range(lines)
+        )
+    new_files = dict(old_files)
+    for name in rng.sample(sorted(old_files), int(round(nfiles * churn))):
+        lines = new_files[name].splitlines(True)
+        for j in rng.sample(range(len(lines)), max(1, len(lines) // 10)):
+            lines[j] = b"%016x%015x\n" % (rng.getrandbits(64), j)
+        new_files[name] = b"".join(lines)
+    return old_files, new_files
+
+
+class BenchmarkDatabase:
+    """In-memory replacement for the run lookups the differ does."""
+
+    def __init__(self, runs=None) -> None:
+        self.runs: dict[str, dict] = dict(runs or {})
+
+    def add_run(self, run_id, source, version):
+        self.runs[run_id] = {
+            "result_code": "success",
+            "build_source": source,
+            "campaign": CAMPAIGN,
+            "id": run_id,
+            "build_version": version,
+            "main_branch_revision": None,
+        }
+
+    async def fetchrow(self, query, run_id, *args):
+        return self.runs.get(run_id)
+
+    @asynccontextmanager
+    async def acquire(self):
+        yield self
+
+
+async def create_pairs(artifact_manager, db, args):
+    rng = random.Random(args.seed)
+    pairs = []
+    for i in range(args.pairs):
+        package = f"bench{i}"
+        old_files, new_files = generate_pair(
+            rng, package, size=args.size * 1024, nfiles=args.files, churn=args.churn
+        )
+        run_ids = []
+        for version, files in [("1.0-1", old_files), ("1.0-2", new_files)]:
+            run_id = f"{package}-{version}"
+            with tempfile.TemporaryDirectory() as td:
+                with open(os.path.join(td, f"{package}_{version}_all.deb"), "wb") as f:
+                    f.write(build_deb(package, version, files))
+                await artifact_manager.store_artifacts(run_id, td)
+            db.add_run(run_id, package, version)
+            run_ids.append(run_id)
+        pairs.append(tuple(run_ids))
+    return pairs
+
+
+def summarize(latencies):
+    if not latencies:
+        return None
+    latencies = sorted(latencies)
+
+    def percentile(p):
+        return latencies[min(len(latencies) - 1, int(p * len(latencies)))]
+
+    return {
+        "count": len(latencies),
+        "mean": statistics.mean(latencies),
+        "p50": percentile(0.5),
+        "p90": percentile(0.9),
+        "p99": percentile(0.99),
+        "max": latencies[-1],
+    }
+
+
+async def fetch(session, url, kind, old_id, new_id, accept):
+    start = time.monotonic()
+    async with session.get(
+        url / kind / old_id / new_id,
+        params={"filter_boring": "1"},
+        headers={"Accept": accept},
+    ) as resp:
+        await resp.read()
+        if resp.status != 200:
+            raise RuntimeError(
+                f"{kind} for {old_id}/{new_id} failed with status {resp.status}"
+            )
+    return time.monotonic() - start
+
+
+async def measure_throughput(
+    session, url, kind, accept, pairs, *, concurrency, requests
+):
+    sem = asyncio.Semaphore(concurrency)
+
+    async def limited(old_id, new_id):
+        async with sem:
+            return await fetch(session, url, kind, old_id, new_id, accept)
+
+    start = time.monotonic()
+    latencies = await asyncio.gather(
+        *[limited(*pairs[i % len(pairs)]) for i in range(requests)]
+    )
+    elapsed = time.monotonic() - start
+    return {
+        "kind": kind,
+        "concurrency": concurrency,
+        "requests": requests,
+        "seconds": elapsed,
+        "requests_per_second": requests / elapsed,
+        "latency": summarize(latencies),
+    }
+
+
+def serve_differ(conn, runs, artifacts_path, path, args):
+    """Run the differ, until told to stop through conn.
+
+    This runs in a process of its own. The port the differ listens on is
+    sent through conn when it is ready, and the peak memory use of the
+    process and of its children (diff commands and render processes) when
+    it has stopped.
+    """
+    logging.basicConfig(level=logging.WARNING)
+
+    async def serve():
+        app = create_app(
+            os.path.join(path, "cache"),
+            LocalArtifactManager(artifacts_path),
+            db=BenchmarkDatabase(runs),
+            task_memory_limit=args.task_memory_limit,
+            task_timeout=args.task_timeout,
+            diffoscope_command=args.diffoscope_command,
+            render_processes=args.render_processes,
+            artifact_cache_path=(
+                os.path.join(path, "artifact-cache") if args.artifact_cache else None
+            ),
+        )
+        runner = web.AppRunner(app)
+        await runner.setup()
+        try:
+            site = web.TCPSite(runner, "127.0.0.1", 0)
+            await site.start()
+            conn.send(runner.addresses[0][1])
+            await asyncio.to_thread(conn.recv)
+        finally:
+            await runner.cleanup()
+
+    asyncio.run(serve())
+    # ru_maxrss is in kilobytes on Linux
+    conn.send(
+        {
+            "differ": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+            "differ_children": (
+                resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * 1024
+            ),
+        }
+    )
+
+
+def _receive(conn, process):
+    multiprocessing.connection.wait([conn, process.sentinel])
+    if not conn.poll():
+        process.join()
+        raise RuntimeError(f"differ exited with code {process.exitcode}")
+    return conn.recv()
+
+
+@asynccontextmanager
+async def differ_process(runs, artifacts_path, path, args, peak_rss):
+    """Start a differ with an empty cache in a separate process.
+
+    Args:
+      runs: Run details to serve
+      artifacts_path: Path of the artifacts for the runs
+      path: Directory for the caches of this differ (in the benchmark's
+        temporary directory)
+      args: Benchmark options
+      peak_rss: Dictionary to record the peak memory use of the differ in
+    """
+    # Don't fork, as the child would then start out with the memory of the
+    # benchmark process.
+    context = multiprocessing.get_context("spawn")
+    conn, child_conn = context.Pipe()
+    process = context.Process(
+        target=serve_differ, args=(child_conn, runs, artifacts_path, path, args)
+    )
+    process.start()
+    try:
+        port = await asyncio.to_thread(_receive, conn, process)
+        yield URL(f"http://127.0.0.1:{port}/")
+        conn.send(None)
+        for name, rss in (await asyncio.to_thread(_receive, conn, process)).items():
+            peak_rss[name] = max(peak_rss.get(name, 0), rss)
+    finally:
+        if process.is_alive():
+            await asyncio.to_thread(process.join, 30)
+        if process.is_alive():
+            process.terminate()
+            await asyncio.to_thread(process.join)
+
+
+async def run_benchmark(args):
+    kinds = [("debdiff", "text/plain")]
+    if not args.skip_diffoscope:
+        kinds.append(("diffoscope", "text/html"))
+
+    results = {
+        "parameters": vars(args),
+        "cold": {},
+        "warm": {},
+        "throughput": [],
+        "peak_rss": {},
+    }
+
+    with tempfile.TemporaryDirectory() as td:
+        artifacts_path = os.path.join(td, "artifacts")
+        artifact_manager = LocalArtifactManager(artifacts_path)
+        db = BenchmarkDatabase()
+        pairs = await create_pairs(artifact_manager, db, args)
+        differ_dirs = (os.path.join(td, f"differ{i}") for i in itertools.count())
+
+        async with ClientSession() as session:
+            async with differ_process(
+                db.runs, artifacts_path, next(differ_dirs), args, results["peak_rss"]
+            ) as url:
+                for kind, accept in kinds:
+                    for phase in ["cold", "warm"]:
+                        latencies = []
+                        for old_id, new_id in pairs:
+                            latencies.append(
+                                await fetch(session, url, kind, old_id, new_id, accept)
+                            )
+                        results[phase][kind] = summarize(latencies)
+
+                for kind, accept in kinds:
+                    for concurrency in args.concurrency:
+                        results["throughput"].append(
+                            {
+                                "phase": "warm",
+                                **await measure_throughput(
+                                    session,
+                                    url,
+                                    kind,
+                                    accept,
+                                    pairs,
+                                    concurrency=concurrency,
+                                    requests=args.requests,
+                                ),
+                            }
+                        )
+
+            # Every pair can only be diffed once with a cold cache, so use a
+            # new differ for every measurement.
+            for kind, accept in kinds:
+                for concurrency in args.concurrency:
+                    async with differ_process(
+                        db.runs,
+                        artifacts_path,
+                        next(differ_dirs),
+                        args,
+                        results["peak_rss"],
+                    ) as url:
+                        results["throughput"].append(
+                            {
+                                "phase": "cold",
+                                **await measure_throughput(
+                                    session,
+                                    url,
+                                    kind,
+                                    accept,
+                                    pairs,
+                                    concurrency=concurrency,
+                                    requests=len(pairs),
+                                ),
+                            }
+                        )
+
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+    parser.add_argument(
+        "--pairs", type=int, default=5, help="Number of package pairs to generate"
+    )
+    parser.add_argument(
+        "--size", type=int, default=1024, help="Size of each package (in KB)"
+    )
+    parser.add_argument(
+        "--files", type=int, default=20, help="Number of files in each package"
+    )
+    parser.add_argument(
+        "--churn",
+        type=float,
+        default=0.2,
+        help="Fraction of files that differ between old and new packages",
+    )
+    parser.add_argument(
+        "--concurrency",
+        type=lambda v: [int(c) for c in v.split(",")],
+        default=[1, 4, 16],
+        help="Comma-separated concurrency levels to measure throughput at",
+    )
+    parser.add_argument(
+        "--requests",
+        type=int,
+        default=50,
+        help="Number of requests per concurrency level with a warm cache "
+        "(with a cold cache, every pair is requested once)",
+    )
+    parser.add_argument("--seed", type=int, default=0, help="Random seed")
+    parser.add_argument("--diffoscope-command", type=str, default="diffoscope")
+    parser.add_argument("--skip-diffoscope", action="store_true")
+    parser.add_argument("--task-memory-limit", type=int, default=1500)
+    parser.add_argument("--task-timeout", type=int, default=300)
+    parser.add_argument("--render-processes", type=int, default=2)
+    parser.add_argument(
+        "--artifact-cache",
+        action="store_true",
+        help="Keep retrieved artifacts in a local artifact cache",
+    )
+    parser.add_argument(
+        "--output", type=str, default="-", help="File to write JSON results to"
+    )
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.WARNING)
+
+    results = asyncio.run(run_benchmark(args))
+
+    if args.output == "-":
+        json.dump(results, sys.stdout, indent=2)
+        sys.stdout.write("\n")
+    else:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
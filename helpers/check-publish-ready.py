@@ -0,0 +1,47 @@
+#!/usr/bin/python3
+"""Check the publish_ready table against the publish_ready_view definition.
+
+The publish_ready table is maintained incrementally by triggers; this
+reports (and optionally repairs) any codebase/campaign combinations for
+which it has drifted from the reference view. Running it with --repair
+against an empty publish_ready table populates it from scratch.
+"""
+
+import argparse
+import asyncio
+import logging
+import sys
+
+from janitor import state
+from janitor.config import read_config
+
+
+async def main(db_location, repair):
+    async with state.create_pool(db_location) as pool, pool.acquire() as conn:
+        inconsistent = await state.check_publish_ready(conn, repair=repair)
+    for codebase, campaign in inconsistent:
+        logging.warning("publish_ready out of date for %s/%s", codebase, campaign)
+    if inconsistent and not repair:
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--config", type=str, default="janitor.conf", help="Path to configuration."
+    )
+    parser.add_argument(
+        "--repair", action="store_true", help="Refresh out of date entries."
+    )
+    args = parser.parse_args()
+
+    logging.basicConfig(format="%(message)s")
+
+    try:
+        with open(args.config) as f:
+            config = read_config(f)
+    except FileNotFoundError:
+        parser.error(f"config path {args.config} does not exist")
+
+    sys.exit(asyncio.run(main(config.database_location, args.repair)))
@@ -0,0 +1,271 @@
+#!/usr/bin/python3
+# Copyright (C) 2024 Jelmer Vernooij <jelmer@jelmer.uk>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+"""Local cache of run artifacts.
+
+Artifacts are stored content-addressed, so that identical files shared
+between runs are only stored once. Checked out artifacts are hardlinked into
+the working directory where possible.
+"""
+
+__all__ = [
+    "ArtifactCache",
+]
+
+import asyncio
+import errno
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+from collections import OrderedDict
+from collections.abc import AsyncIterator
+from contextlib import asynccontextmanager
+from functools import partial
+from typing import TYPE_CHECKING, Callable, Optional
+
+from aiohttp_openmetrics import Counter, Gauge
+
+from .singleflight import SingleFlight
+
+if TYPE_CHECKING:
+    from .artifacts import ArtifactManager
+
+artifact_cache_hit_count = Counter(
+    "artifact_cache_hit_count", "Number of artifact cache hits"
+)
+artifact_cache_miss_count = Counter(
+    "artifact_cache_miss_count", "Number of artifact cache misses"
+)
+artifact_cache_eviction_count = Counter(
+    "artifact_cache_eviction_count", "Number of runs evicted from the artifact cache"
+)
+artifact_cache_size = Gauge(
+    "artifact_cache_size", "Size of the artifact cache, in bytes"
+)
+
+# Mapping from file name to (sha256 digest, size)
+Manifest = dict[str, tuple[str, int]]
+
+
+def _hash_files(path: str) -> dict[str, tuple[str, int, str]]:
+    ret = {}
+    for entry in os.scandir(path):
+        h = hashlib.sha256()
+        with open(entry.path, "rb") as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                h.update(chunk)
+        ret[entry.name] = (h.hexdigest(), entry.stat().st_size, entry.path)
+    return ret
+
+
+def _link_or_copy(source: str, target: str) -> None:
+    try:
+        os.link(source, target)
+    except OSError as e:
+        if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+            raise
+        shutil.copyfile(source, target)
+
+
+class ArtifactCache:
+    """Cache of artifacts retrieved from an artifact manager, keyed by run id.
+
+    Runs are evicted in least recently used order once the cache grows beyond
+    its maximum size, except while they are checked out.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        artifact_manager: "ArtifactManager",
+        *,
+        max_size: Optional[int] = None,
+        filter_fn: Optional[Callable[[str], bool]] = None,
+    ) -> None:
+        """Create an artifact cache.
+
+        Args:
+          path: Directory to store the cache in
+          artifact_manager: Artifact manager to retrieve artifacts from
+          max_size: Maximum size of the cache, in bytes
+          filter_fn: Function to select which artifacts to cache
+        """
+        self.path = path
+        self.artifact_manager = artifact_manager
+        self.max_size = max_size
+        self.filter_fn = filter_fn
+        self._runs: OrderedDict[str, Manifest] = OrderedDict()
+        self._refcounts: dict[str, int] = {}
+        self._object_refs: dict[str, set[str]] = {}
+        self._object_sizes: dict[str, int] = {}
+        self._size = 0
+        self._downloads: SingleFlight[Manifest] = SingleFlight()
+        os.makedirs(os.path.join(self.path, "runs"), exist_ok=True)
+        os.makedirs(os.path.join(self.path, "objects"), exist_ok=True)
+        self._load()
+
+    def _object_path(self, digest: str) -> str:
+        return os.path.join(self.path, "objects", digest[:2], digest)
+
+    def _manifest_path(self, run_id: str) -> str:
+        return os.path.join(self.path, "runs", run_id + ".json")
+
+    def _load(self) -> None:
+        for entry in os.scandir(self.path):
+            # Left over from an interrupted download
+            if entry.name.startswith(".tmp"):
+                shutil.rmtree(entry.path, ignore_errors=True)
+        manifests = []
+        for entry in os.scandir(os.path.join(self.path, "runs")):
+            if not entry.name.endswith(".json"):
+                continue
+            try:
+                with open(entry.path) as f:
+                    files = {
+                        name: (digest, size)
+                        for name, (digest, size) in json.load(f).items()
+                    }
+            except (OSError, ValueError, TypeError):
+                logging.warning("Removing corrupt artifact cache entry %s", entry.path)
+                os.unlink(entry.path)
+                continue
+            if not all(
+                os.path.exists(self._object_path(digest))
+                for (digest, size) in files.values()
+            ):
+                os.unlink(entry.path)
+                continue
+            manifests.append(
+                (entry.stat().st_mtime, entry.name[: -len(".json")], files)
+            )
+        for mtime, run_id, files in sorted(manifests, key=lambda m: m[0]):
+            self._register(run_id, files)
+        # Remove objects that are no longer referenced by any run
+        for prefix in os.scandir(os.path.join(self.path, "objects")):
+            for entry in os.scandir(prefix.path):
+                if entry.name not in self._object_refs:
+                    os.unlink(entry.path)
+        artifact_cache_size.set(self._size)
+
+    def _register(self, run_id: str, files: Manifest) -> None:
+        self._runs[run_id] = files
+        for digest, size in files.values():
+            refs = self._object_refs.setdefault(digest, set())
+            if not refs:
+                self._object_sizes[digest] = size
+                self._size += size
+            refs.add(run_id)
+
+    def _remove_run(self, run_id: str) -> None:
+        files = self._runs.pop(run_id)
+        try:
+            os.unlink(self._manifest_path(run_id))
+        except FileNotFoundError:
+            pass
+        for digest, size in files.values():
+            refs = self._object_refs[digest]
+            refs.discard(run_id)
+            if refs:
+                continue
+            del self._object_refs[digest]
+            self._size -= self._object_sizes.pop(digest)
+            try:
+                os.unlink(self._object_path(digest))
+            except FileNotFoundError:
+                pass
+        artifact_cache_size.set(self._size)
+
+    def _evict(self) -> None:
+        if self.max_size is None:
+            return
+        for run_id in list(self._runs):
+            if self._size <= self.max_size:
+                break
+            if self._refcounts.get(run_id):
+                continue
+            logging.debug("Evicting artifacts for %s from cache", run_id)
+            self._remove_run(run_id)
+            artifact_cache_eviction_count.inc()
+
+    async def _fetch(self, run_id: str) -> Manifest:
+        staging = tempfile.mkdtemp(prefix=".tmp", dir=self.path)
+        try:
+            await self.artifact_manager.retrieve_artifacts(
+                run_id, staging, filter_fn=self.filter_fn
+            )
+            hashed = await asyncio.to_thread(_hash_files, staging)
+            # Don't cache the absence of artifacts; they may still appear
+            if not hashed:
+                return {}
+            files = {}
+            for name, (digest, size, staged_path) in hashed.items():
+                object_path = self._object_path(digest)
+                os.makedirs(os.path.dirname(object_path), exist_ok=True)
+                os.chmod(staged_path, 0o444)
+                os.replace(staged_path, object_path)
+                files[name] = (digest, size)
+        finally:
+            shutil.rmtree(staging, ignore_errors=True)
+        with open(self._manifest_path(run_id), "w") as f:
+            json.dump(files, f)
+        if run_id in self._runs:
+            self._remove_run(run_id)
+        self._register(run_id, files)
+        artifact_cache_size.set(self._size)
+        return files
+
+    @asynccontextmanager
+    async def checkout(self, run_id: str, local_path: str) -> AsyncIterator[None]:
+        """Make the artifacts for a run available in a directory.
+
+        The artifacts are protected from eviction until the context is exited.
+
+        Args:
+          run_id: Run to retrieve artifacts for
+          local_path: Directory to place the artifacts in
+        Raises:
+          ArtifactsMissing: if the artifacts for the run are missing
+        """
+        if run_id in self._runs:
+            artifact_cache_hit_count.inc()
+            self._runs.move_to_end(run_id)
+            try:
+                os.utime(self._manifest_path(run_id))
+            except FileNotFoundError:
+                pass
+        else:
+            artifact_cache_miss_count.inc()
+            # The run may be evicted again before we get to check it out
+            while run_id not in self._runs:
+                files = await self._downloads.do(run_id, partial(self._fetch, run_id))
+                if not files:
+                    yield
+                    return
+        files = self._runs[run_id]
+        self._refcounts[run_id] = self._refcounts.get(run_id, 0) + 1
+        try:
+            for name, (digest, size) in files.items():
+                _link_or_copy(self._object_path(digest), os.path.join(local_path, name))
+            yield
+        finally:
+            self._refcounts[run_id] -= 1
+            if not self._refcounts[run_id]:
+                del self._refcounts[run_id]
+            self._evict()
@@ -17,35 +17,43 @@
 
 import asyncio
 import bz2
+import collections
+import errno
 import gzip
 import hashlib
-import io
+import itertools
 import json
 import logging
+import lzma
 import os
 import re
 import shutil
 import sys
 import tempfile
+import threading
 import time
+from concurrent.futures import Executor, ThreadPoolExecutor
 from contextlib import ExitStack
 from datetime import datetime
-from email.utils import formatdate, parsedate_to_datetime
+from email.utils import formatdate
 from functools import partial
 from time import mktime
-from typing import TYPE_CHECKING, Any, Optional
+from typing import TYPE_CHECKING, Any, Callable, Optional
 
 import aiozipkin
 from aiohttp import web
 from aiohttp.web_middlewares import normalize_path_middleware
-from aiohttp_openmetrics import Gauge, setup_metrics
+from aiohttp_openmetrics import Counter, Gauge, Histogram, setup_metrics
 from aiojobs import Job, Scheduler
-from debian.deb822 import Packages, Release, Sources
+from debian.deb822 import Release
 
 from .. import state
 from ..artifacts import ArtifactsMissing, get_artifact_manager
 from ..config import AptRepository as AptRepositoryConfig
 from ..config import get_campaign_config, get_distribution, read_config
+from ..singleflight import SingleFlight
+from .scan import run_directory, scan_packages, scan_sources
+from .suite_index import SuiteIndex
 
 if TYPE_CHECKING:
     import gpg
@@ -61,6 +69,47 @@ last_publish_success = Gauge(
     "Last time publishing a suite succeeded",
     labelnames=("suite",),
 )
+publish_pending_count = Gauge(
+    "suite_publish_pending_count",
+    "Number of changes to a suite that have not been published yet",
+    labelnames=("suite",),
+)
+
+
+package_info_cache_hit_count = Counter(
+    "package_info_cache_hit_count",
+    "Number of package info disk cache hits",
+    labelnames=("kind",),
+)
+package_info_cache_miss_count = Counter(
+    "package_info_cache_miss_count",
+    "Number of package info disk cache misses",
+    labelnames=("kind",),
+)
+package_info_cache_eviction_count = Counter(
+    "package_info_cache_eviction_count",
+    "Number of entries evicted from the package info disk cache",
+)
+package_info_cache_size = Gauge(
+    "package_info_cache_size", "Size of the package info disk cache, in bytes"
+)
+release_sign_duration = Histogram(
+    "release_sign_duration", "Time spent signing Release files, in seconds"
+)
+release_sign_count = Counter(
+    "release_sign_count",
+    "Number of Release files written, by whether they had to be signed",
+    labelnames=("result",),
+)
+on_demand_dists_refresh_count = Counter(
+    "on_demand_dists_refresh_count",
+    "Number of on-demand suite refreshes",
+    labelnames=("result",),
+)
+on_demand_dists_eviction_count = Counter(
+    "on_demand_dists_eviction_count",
+    "Number of on-demand suites removed to stay below the maximum",
+)
 
 
 logger = logging.getLogger("janitor.debian.archive")
@@ -71,7 +120,32 @@ routes = web.RouteTableDef()
 # TODO(jelmer): Generate contents file
 
 
+async def prefetch_ordered(items, fn, concurrency):
+    """Apply an async function to items concurrently, yielding results in order.
+
+    At most ``concurrency`` calls are in progress at any time.
+    """
+    pending: collections.deque[asyncio.Task] = collections.deque()
+    it = iter(items)
+    try:
+        for item in itertools.islice(it, max(concurrency, 1)):
+            pending.append(asyncio.create_task(fn(item)))
+        while pending:
+            result = await pending.popleft()
+            for item in itertools.islice(it, 1):
+                pending.append(asyncio.create_task(fn(item)))
+            yield result
+    finally:
+        for task in pending:
+            task.cancel()
+
+
 class PackageInfoProvider:
+    # Number of runs to retrieve package info for concurrently
+    concurrency: int = 1
+    # Maximum time to spend retrieving package info for a single run
+    timeout: Optional[float] = None
+
     async def __aenter__(self):
         return self
 
@@ -84,60 +158,80 @@ class PackageInfoProvider:
     async def sources_for_run(self, run_id, suite_name, package):
         raise NotImplementedError(self.sources_for_run)
 
+    async def _prefetch(self, rows, stanzas_for_row):
+        async def fetch(row):
+            return await read_stanzas(
+                stanzas_for_row(row), row[1], row[0], timeout=self.timeout
+            )
 
-async def scan_packages(td, arch: Optional[str] = None):
-    args = []
-    if arch:
-        args.extend(["-a", arch])
-    proc = await asyncio.create_subprocess_exec(
-        "dpkg-scanpackages",
-        td,
-        *args,
-        stdout=asyncio.subprocess.PIPE,
-        stderr=asyncio.subprocess.PIPE,
-    )
-    stdout, stderr = await proc.communicate()
-    for para in Packages.iter_paragraphs(stdout, use_apt_pkg=False):
-        yield para
-    for line in stderr.splitlines(keepends=False):
-        if line.startswith(b"dpkg-scanpackages: "):
-            line = line[len(b"dpkg-scanpackages: ") :]
-        if line.startswith(b"info: "):
-            logging.debug("%s", line.rstrip(b"\n").decode())
-        elif line.startswith(b"warning: "):
-            logging.warning("%s", line.rstrip(b"\n").decode())
-        elif line.startswith(b"error: "):
-            logging.error("%s", line.rstrip(b"\n").decode())
-        else:
-            logging.info("dpkg-scanpackages error: %s", line.rstrip(b"\n").decode())
+        async for data in prefetch_ordered(rows, fetch, self.concurrency):
+            if data is not None:
+                yield data
 
+    async def packages_for_runs(self, rows, arch):
+        """Return the Packages stanzas for a set of builds.
 
-async def scan_sources(td):
-    proc = await asyncio.create_subprocess_exec(
-        "dpkg-scansources",
-        td,
-        stdout=asyncio.subprocess.PIPE,
-        stderr=asyncio.subprocess.PIPE,
-    )
-    stdout, stderr = await proc.communicate()
-    for para in Sources.iter_paragraphs(stdout, use_apt_pkg=False):
-        yield para
-    for line in stderr.splitlines(keepends=False):
-        if line.startswith(b"dpkg-scansources: "):
-            line = line[len(b"dpkg-scansources: ") :]
-        if line.startswith(b"info: "):
-            logging.debug("%s", line.rstrip(b"\n").decode())
-        elif line.startswith(b"warning: "):
-            logging.warning("%s", line.rstrip(b"\n").decode())
-        elif line.startswith(b"error: "):
-            logging.error("%s", line.rstrip(b"\n").decode())
-        else:
-            logging.info("dpkg-scansources error: %s", line.rstrip(b"\n").decode())
+        Package info for up to ``concurrency`` builds is retrieved in
+        parallel. Builds whose artifacts are missing or can not be retrieved
+        within ``timeout`` are skipped.
+
+        Args:
+          rows: (package, run_id, build_distribution, build_version) tuples
+          arch: Architecture to return stanzas for
+        """
+        async for chunk in self._prefetch(
+            rows,
+            lambda row: self.packages_for_run(row[1], row[2], row[0], arch=arch),
+        ):
+            yield chunk
+
+    async def sources_for_runs(self, rows):
+        """Return the Sources stanzas for a set of builds.
+
+        See packages_for_runs for details.
+
+        Args:
+          rows: (package, run_id, build_distribution, build_version) tuples
+        """
+        async for chunk in self._prefetch(
+            rows, lambda row: self.sources_for_run(row[1], row[2], row[0])
+        ):
+            yield chunk
+
+
+async def read_stanzas(stanzas, run_id, package, *, timeout=None):
+    """Read all stanzas for a run.
+
+    Returns:
+      the stanzas, or None if the artifacts for the run are missing or
+      could not be retrieved within the timeout
+    """
+
+    async def join():
+        return b"".join([chunk async for chunk in stanzas])
+
+    try:
+        return await asyncio.wait_for(join(), timeout)
+    except ArtifactsMissing:
+        logger.warning("Artifacts missing for %s (%s), skipping", package, run_id)
+    except asyncio.TimeoutError:
+        logger.warning(
+            "Timeout retrieving package info for %s (%s), skipping", package, run_id
+        )
+    return None
 
 
 class GeneratingPackageInfoProvider(PackageInfoProvider):
-    def __init__(self, artifact_manager) -> None:
+    def __init__(
+        self,
+        artifact_manager,
+        *,
+        concurrency: int = 1,
+        timeout: Optional[float] = DEFAULT_GCS_TIMEOUT,
+    ) -> None:
         self.artifact_manager = artifact_manager
+        self.concurrency = concurrency
+        self.timeout = timeout
 
     async def __aenter__(self):
         await self.artifact_manager.__aenter__()
@@ -148,15 +242,10 @@ class GeneratingPackageInfoProvider(PackageInfoProvider):
 
     async def packages_for_run(self, run_id, suite_name, package, arch):
         with tempfile.TemporaryDirectory(prefix=TMP_PREFIX) as td:
-            await self.artifact_manager.retrieve_artifacts(
-                run_id, td, timeout=DEFAULT_GCS_TIMEOUT
-            )
+            await self.artifact_manager.retrieve_artifacts(run_id, td)
             async for para in scan_packages(td):
                 para["Filename"] = os.path.join(
-                    suite_name,
-                    "pkg",
-                    package,
-                    run_id,
+                    run_directory(suite_name, package, run_id),
                     os.path.basename(para["Filename"]),
                 )
                 yield bytes(para)
@@ -166,16 +255,9 @@ class GeneratingPackageInfoProvider(PackageInfoProvider):
 
     async def sources_for_run(self, run_id, suite_name, package):
         with tempfile.TemporaryDirectory(prefix=TMP_PREFIX) as td:
-            await self.artifact_manager.retrieve_artifacts(
-                run_id, td, timeout=DEFAULT_GCS_TIMEOUT
-            )
+            await self.artifact_manager.retrieve_artifacts(run_id, td)
             async for para in scan_sources(td):
-                para["Directory"] = os.path.join(
-                    suite_name,
-                    "pkg",
-                    package,
-                    run_id,
-                )
+                para["Directory"] = run_directory(suite_name, package, run_id)
                 yield bytes(para)
                 yield b"\n"
 
@@ -183,9 +265,32 @@ class GeneratingPackageInfoProvider(PackageInfoProvider):
 
 
 class DiskCachingPackageInfoProvider(PackageInfoProvider):
-    def __init__(self, primary_info_provider, cache_directory) -> None:
+    """Package info provider that caches stanzas on local disk.
+
+    Entries are stored in directories sharded by the first two characters of
+    the run id, and written atomically. Each entry starts with the SHA256
+    digest of its contents, which is verified when it is read; corrupt
+    entries are discarded. When ``max_size`` (in bytes) is set, the least
+    recently used entries are evicted to stay below it.
+    """
+
+    def __init__(
+        self,
+        primary_info_provider,
+        cache_directory,
+        *,
+        max_size: Optional[int] = None,
+    ) -> None:
         self.primary_info_provider = primary_info_provider
         self.cache_directory = cache_directory
+        self.max_size = max_size
+        self.concurrency = primary_info_provider.concurrency
+        self.timeout = primary_info_provider.timeout
+        # Maps paths of cache entries to their size, least recently used first
+        self._entries: collections.OrderedDict[str, int] = collections.OrderedDict()
+        self._size = 0
+        os.makedirs(self.cache_directory, exist_ok=True)
+        self._scan()
 
     async def __aenter__(self):
         await self.primary_info_provider.__aenter__()
@@ -194,41 +299,125 @@ class DiskCachingPackageInfoProvider(PackageInfoProvider):
         await self.primary_info_provider.__aexit__(exc_tp, exc_val, exc_tb)
         return False
 
-    async def packages_for_run(self, run_id, suite_name, package, arch):
-        cache_path = os.path.join(self.cache_directory, f"binary-{arch}", run_id)
-        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+    def _scan(self) -> None:
+        entries = []
+        for kind in os.scandir(self.cache_directory):
+            if not kind.is_dir() or not (
+                kind.name == "source" or kind.name.startswith("binary-")
+            ):
+                continue
+            for shard in os.scandir(kind.path):
+                if not shard.is_dir():
+                    # Unsharded entry from an older version, without checksum
+                    os.unlink(shard.path)
+                    continue
+                for entry in os.scandir(shard.path):
+                    if entry.name.startswith(".tmp"):
+                        # Left behind by an interrupted write
+                        os.unlink(entry.path)
+                        continue
+                    st = entry.stat()
+                    entries.append((st.st_mtime, entry.path, st.st_size))
+        for _mtime, path, size in sorted(entries):
+            self._entries[path] = size
+            self._size += size
+        package_info_cache_size.set(self._size)
+        self._evict()
+
+    def _path(self, kind: str, run_id: str) -> str:
+        if "/" in run_id or run_id.startswith("."):
+            raise ValueError(f"invalid run id: {run_id!r}")
+        return os.path.join(self.cache_directory, kind, run_id[:2], run_id)
+
+    def _forget(self, path: str) -> None:
+        size = self._entries.pop(path, None)
+        if size is not None:
+            self._size -= size
+            package_info_cache_size.set(self._size)
+
+    def _evict(self) -> None:
+        if self.max_size is None:
+            return
+        while self._size > self.max_size and self._entries:
+            path, size = self._entries.popitem(last=False)
+            self._size -= size
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+            package_info_cache_eviction_count.inc()
+        package_info_cache_size.set(self._size)
+
+    def _read(self, path: str) -> Optional[bytes]:
         try:
-            with open(cache_path, "rb") as f:
-                for chunk in f:
-                    yield chunk
+            with open(path, "rb") as f:
+                header = f.readline()
+                data = f.read()
         except FileNotFoundError:
-            logger.debug(
-                "Retrieving artifacts for %s/%s (%s)", suite_name, package, run_id
-            )
-            with open(cache_path, "wb") as f:
-                async for chunk in self.primary_info_provider.packages_for_run(
-                    run_id, suite_name, package, arch=arch
-                ):
-                    f.write(chunk)
-                    yield chunk
+            return None
+        if header.rstrip(b"\n").decode("ascii", "replace") != (
+            hashlib.sha256(data).hexdigest()
+        ):
+            logger.warning("Removing corrupt package info cache entry %s", path)
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+            return None
+        os.utime(path)
+        return data
 
-    async def sources_for_run(self, run_id, suite_name, package):
-        cache_path = os.path.join(self.cache_directory, "source", run_id)
-        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+    def _write(self, path: str, data: bytes) -> int:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".tmp")
         try:
-            with open(cache_path, "rb") as f:
-                for chunk in f:
-                    yield chunk
-        except FileNotFoundError:
-            logger.debug(
-                "Retrieving artifacts for %s/%s (%s)", suite_name, package, run_id
-            )
-            with open(cache_path, "wb") as f:
-                async for chunk in self.primary_info_provider.sources_for_run(
-                    run_id, suite_name, package
-                ):
-                    f.write(chunk)
-                    yield chunk
+            with os.fdopen(fd, "wb") as f:
+                f.write(hashlib.sha256(data).hexdigest().encode("ascii") + b"\n")
+                f.write(data)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+        return os.path.getsize(path)
+
+    async def _cached(self, label, path, stanzas):
+        data = await asyncio.to_thread(self._read, path)
+        if data is not None:
+            package_info_cache_hit_count.labels(kind=label).inc()
+            if path in self._entries:
+                self._entries.move_to_end(path)
+            yield data
+            return
+        package_info_cache_miss_count.labels(kind=label).inc()
+        logger.debug("Package info cache miss for %s", path)
+        self._forget(path)
+        # Only complete stanzas are cached, so a failed retrieval doesn't
+        # leave a truncated entry behind.
+        data = b"".join([chunk async for chunk in stanzas])
+        size = await asyncio.to_thread(self._write, path, data)
+        self._forget(path)
+        self._entries[path] = size
+        self._size += size
+        self._evict()
+        yield data
+
+    async def packages_for_run(self, run_id, suite_name, package, arch):
+        async for chunk in self._cached(
+            "packages",
+            self._path(f"binary-{arch}", run_id),
+            self.primary_info_provider.packages_for_run(
+                run_id, suite_name, package, arch=arch
+            ),
+        ):
+            yield chunk
+
+    async def sources_for_run(self, run_id, suite_name, package):
+        async for chunk in self._cached(
+            "sources",
+            self._path("source", run_id),
+            self.primary_info_provider.sources_for_run(run_id, suite_name, package),
+        ):
+            yield chunk
 
     async def cache_run(self, run_id, suite_name, package, arches):
         async for _ in self.sources_for_run(run_id, suite_name, package):
@@ -238,34 +427,206 @@ class DiskCachingPackageInfoProvider(PackageInfoProvider):
                 pass
 
 
+class DatabasePackageInfoProvider(PackageInfoProvider):
+    """Package info provider that uses the stanzas stored by the runner.
+
+    Builds that were imported before the runner started storing stanzas are
+    handled by the primary info provider.
+    """
+
+    def __init__(self, db, primary_info_provider) -> None:
+        self.db = db
+        self.primary_info_provider = primary_info_provider
+        self.concurrency = primary_info_provider.concurrency
+        self.timeout = primary_info_provider.timeout
+
+    async def __aenter__(self):
+        await self.primary_info_provider.__aenter__()
+
+    async def __aexit__(self, exc_tp, exc_val, exc_tb):
+        await self.primary_info_provider.__aexit__(exc_tp, exc_val, exc_tb)
+        return False
+
+    async def _fetch(self, run_id):
+        async with self.db.acquire() as conn:
+            return {
+                row["architecture"]: row["stanzas"]
+                for row in await conn.fetch(
+                    "SELECT architecture, stanzas FROM debian_package_index "
+                    "WHERE run_id = $1",
+                    run_id,
+                )
+            }
+
+    async def packages_for_run(self, run_id, suite_name, package, arch):
+        index = await self._fetch(run_id)
+        if not index:
+            async for chunk in self.primary_info_provider.packages_for_run(
+                run_id, suite_name, package, arch=arch
+            ):
+                yield chunk
+            return
+        for stanza_arch in (arch, "all"):
+            if stanza_arch in index:
+                yield index[stanza_arch]
+
+    async def sources_for_run(self, run_id, suite_name, package):
+        index = await self._fetch(run_id)
+        if not index:
+            async for chunk in self.primary_info_provider.sources_for_run(
+                run_id, suite_name, package
+            ):
+                yield chunk
+            return
+        if "source" in index:
+            yield index["source"]
+
+    async def _for_runs(self, rows, architectures, stanzas_for_row):
+        """Return the stored stanzas for a set of builds, in order.
+
+        Stanzas for builds that predate the stored stanzas are retrieved from
+        the primary info provider, concurrently with reading the stored
+        stanzas, and merged in at their position in rows.
+        """
+        run_ids = [row[1] for row in rows]
+        async with self.db.acquire() as conn:
+            indexed = {
+                row[0]
+                for row in await conn.fetch(
+                    "SELECT DISTINCT run_id FROM debian_package_index "
+                    "WHERE run_id = ANY($1::text[])",
+                    run_ids,
+                )
+            }
+            missing = [
+                (position, row)
+                for (position, row) in enumerate(rows)
+                if row[1] not in indexed
+            ]
+            if missing:
+                logger.debug("%d builds without stored stanzas", len(missing))
+
+            async def fetch(item):
+                position, row = item
+                return position, await read_stanzas(
+                    stanzas_for_row(row), row[1], row[0], timeout=self.timeout
+                )
+
+            fallback = prefetch_ordered(missing, fetch, self.concurrency)
+
+            async def next_fallback():
+                try:
+                    return await fallback.__anext__()
+                except StopAsyncIteration:
+                    return None
+
+            try:
+                pending = await next_fallback()
+                async with conn.transaction():
+                    async for row in conn.cursor(
+                        "SELECT r.ord, i.stanzas "
+                        "FROM unnest($1::text[]) WITH ORDINALITY AS r(run_id, ord) "
+                        "INNER JOIN debian_package_index AS i "
+                        "ON i.run_id = r.run_id "
+                        "WHERE i.architecture = ANY($2::text[]) "
+                        "ORDER BY r.ord, array_position($2::text[], i.architecture)",
+                        run_ids,
+                        architectures,
+                    ):
+                        # ord is 1-based
+                        while pending is not None and pending[0] < row[0] - 1:
+                            if pending[1] is not None:
+                                yield pending[1]
+                            pending = await next_fallback()
+                        yield row[1]
+                while pending is not None:
+                    if pending[1] is not None:
+                        yield pending[1]
+                    pending = await next_fallback()
+            finally:
+                await fallback.aclose()
+
+    async def packages_for_runs(self, rows, arch):
+        async for chunk in self._for_runs(
+            rows,
+            [arch, "all"],
+            lambda row: self.primary_info_provider.packages_for_run(
+                row[1], row[2], row[0], arch=arch
+            ),
+        ):
+            yield chunk
+
+    async def sources_for_runs(self, rows):
+        async for chunk in self._for_runs(
+            rows,
+            ["source"],
+            lambda row: self.primary_info_provider.sources_for_run(
+                row[1], row[2], row[0]
+            ),
+        ):
+            yield chunk
+
+
 async def retrieve_packages(info_provider, rows, suite_name, component, arch):
     logger.debug(
         "Need to process %d rows for %s/%s/%s", len(rows), suite_name, component, arch
     )
-    for package, run_id, build_distribution, _build_version in rows:
-        try:
-            async for chunk in info_provider.packages_for_run(
-                run_id, build_distribution, package, arch=arch
-            ):
-                yield chunk
-                await asyncio.sleep(0)
-        except ArtifactsMissing:
-            logger.warning("Artifacts missing for %s (%s), skipping", package, run_id)
-            continue
+    async for chunk in info_provider.packages_for_runs(rows, arch):
+        yield chunk
 
 
 async def retrieve_sources(info_provider, rows, suite_name, component):
     logger.debug("Need to process %d rows for %s/%s", len(rows), suite_name, component)
-    for package, run_id, build_distribution, _build_version in rows:
-        try:
-            async for chunk in info_provider.sources_for_run(
-                run_id, build_distribution, package
-            ):
-                yield chunk
-                await asyncio.sleep(0)
-        except ArtifactsMissing:
-            logger.warning("Artifacts missing for %s (%s), skipping", package, run_id)
-            continue
+    async for chunk in info_provider.sources_for_runs(rows):
+        yield chunk
+
+
+async def retrieve_packages_incremental(
+    info_provider, index_directory, rows, suite_name, component, arch
+):
+    """Like retrieve_packages, but reuse stanzas from the previous publish."""
+    builds = {row[1]: row for row in rows}
+
+    async def fetch(run_id):
+        package, run_id, build_distribution, _build_version = builds[run_id]
+        return await read_stanzas(
+            info_provider.packages_for_run(
+                run_id, build_distribution, package, arch=arch
+            ),
+            run_id,
+            package,
+            timeout=info_provider.timeout,
+        )
+
+    index = SuiteIndex(
+        os.path.join(index_directory, suite_name, component, f"binary-{arch}")
+    )
+    for chunk in await index.update(
+        builds, fetch, concurrency=info_provider.concurrency
+    ):
+        yield chunk
+
+
+async def retrieve_sources_incremental(
+    info_provider, index_directory, rows, suite_name, component
+):
+    """Like retrieve_sources, but reuse stanzas from the previous publish."""
+    builds = {row[1]: row for row in rows}
+
+    async def fetch(run_id):
+        package, run_id, build_distribution, _build_version = builds[run_id]
+        return await read_stanzas(
+            info_provider.sources_for_run(run_id, build_distribution, package),
+            run_id,
+            package,
+            timeout=info_provider.timeout,
+        )
+
+    index = SuiteIndex(os.path.join(index_directory, suite_name, component, "source"))
+    for chunk in await index.update(
+        builds, fetch, concurrency=info_provider.concurrency
+    ):
+        yield chunk
 
 
 async def get_builds_for_suite(db, build_distribution):
@@ -315,23 +676,80 @@ HASHES = {
 }
 
 
-def cleanup_by_hash_files(base, number_to_keep):
+# Minimum time to keep by-hash files around after they were last published,
+# so that clients with an older Release file can still retrieve them.
+BY_HASH_MAX_AGE = 60 * 60 * 24
+
+
+def cleanup_by_hash_files(base, max_age=BY_HASH_MAX_AGE):
+    """Remove by-hash files that have not been published for max_age seconds."""
+    cutoff = time.time() - max_age
     for h in HASHES:
-        ages = []
-        for entry in os.scandir(os.path.join(base, "by-hash", h)):
-            ages.append((entry, time.time() - entry.stat().st_mtime))
+        try:
+            entries = list(os.scandir(os.path.join(base, "by-hash", h)))
+        except FileNotFoundError:
+            continue
+        for entry in entries:
+            if entry.stat().st_mtime < cutoff:
+                os.unlink(entry.path)
+
 
-        ages.sort(key=lambda k: k[1])
+def _link_by_hash(source, target):
+    """Make source available as target, replacing any existing file."""
+    if os.path.exists(target):
+        # Same contents; refresh its age
+        os.utime(target)
+        return
+    tmp_target = target + ".tmp"
+    try:
+        os.link(source, tmp_target)
+    except FileExistsError:
+        os.unlink(tmp_target)
+        os.link(source, tmp_target)
+    except OSError as e:
+        if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+            raise
+        shutil.copyfile(source, tmp_target)
+    os.replace(tmp_target, target)
+
+
+class _HashingFile:
+    """Write-only file wrapper that hashes data as it is written."""
+
+    def __init__(self, f) -> None:
+        self.f = f
+        self.hashes = {n: kls() for (n, kls) in HASHES.items()}
+        self.size = 0
 
-        for entry, _age in ages[number_to_keep:]:
-            os.unlink(entry.path)
+    def write(self, chunk):
+        self.f.write(chunk)
+        for h in self.hashes.values():
+            h.update(chunk)
+        self.size += len(chunk)
+        return len(chunk)
 
+    def flush(self):
+        self.f.flush()
 
-class HashedFileWriter:
-    """File write wrapper that writes by-hash files."""
 
-    def __init__(self, release, base, path, open=open) -> None:
-        self.open = open
+class HashedFileWriter:
+    """File write wrapper that writes by-hash files.
+
+    The written data is hashed as it is written; by-hash files are hardlinks
+    to the published file.
+    """
+
+    def __init__(self, release, base, path, compressor=None) -> None:
+        """Create a new writer.
+
+        Args:
+          release: Release file (or dictionary) to add the hashes of the file to
+          base: Base directory of the suite
+          path: Path of the file, relative to base
+          compressor: Optional function that wraps a file object in a
+            compressing writer
+        """
+        self.compressor = compressor
         self.release = release
         self.base = base
         self.path = path
@@ -339,51 +757,187 @@ class HashedFileWriter:
     def __enter__(self):
         dir = os.path.join(self.base, os.path.dirname(self.path))
         os.makedirs(dir, exist_ok=True)
-        fd, self._tmpf_path = tempfile.mkstemp(
+        fd, self.tmp_path = tempfile.mkstemp(
             dir=dir, prefix=os.path.basename(self.path)
         )
-        self._tmpf = self.open(self._tmpf_path, "wb")
-        os.close(fd)
+        self._rawf = os.fdopen(fd, "wb")
+        self._hashf = _HashingFile(self._rawf)
+        if self.compressor is not None:
+            self._tmpf = self.compressor(self._hashf)
+        else:
+            self._tmpf = self._hashf
         return self
 
     def done(self):
-        """Mark the file as done, close it and calculate size/hash."""
-        self._tmpf.flush()
-        self._tmpf.close()
-
-        hashes = {n: kls() for (n, kls) in HASHES.items()}
-
-        self.size = 0
-        with open(self._tmpf_path, "rb") as f:
-            while True:
-                chunk = f.read(io.DEFAULT_BUFFER_SIZE)
-                if not chunk:
-                    break
-                for h in hashes.values():
-                    h.update(chunk)
-                self.size += len(chunk)
+        """Mark the file as done, close it and create the by-hash files."""
+        if self._tmpf is not self._hashf:
+            self._tmpf.close()
+        self._rawf.close()
 
+        self.size = self._hashf.size
         d, n = os.path.split(self.path)
-        for hn, v in hashes.items():
+        for hn, v in self._hashf.hashes.items():
             os.makedirs(os.path.join(self.base, d, "by-hash", hn), exist_ok=True)
             hash_path = os.path.join(self.base, d, "by-hash", hn, v.hexdigest())
-            shutil.copy(self._tmpf_path, hash_path)
+            _link_by_hash(self.tmp_path, hash_path)
             self.release.setdefault(hn, []).append(
                 {hn.lower(): v.hexdigest(), "size": self.size, "name": self.path}
             )
-            assert self.size == os.path.getsize(hash_path)
 
     def __exit__(self, exc_type, exc_val, exc_tb):
         if exc_type:
+            self._rawf.close()
+            os.unlink(self.tmp_path)
             return False
-        os.rename(self._tmpf_path, os.path.join(self.base, self.path))
-        assert self.size == os.path.getsize(os.path.join(self.base, self.path))
+        os.rename(self.tmp_path, os.path.join(self.base, self.path))
         return False
 
     def write(self, chunk):
         self._tmpf.write(chunk)
 
 
+def _zstd_compressor(f, level=None):
+    import zstandard
+
+    return zstandard.ZstdCompressor(level=3 if level is None else level).stream_writer(
+        f, closefd=False
+    )
+
+
+# Compressed variants of index files, by file extension. Each entry is a
+# function that wraps a file object in a compressing writer at the given level,
+# or at the default level for the format if it is None.
+COMPRESSORS: dict[str, Callable[..., Any]] = {
+    "gz": lambda f, level=None: gzip.GzipFile(
+        fileobj=f, mode="wb", mtime=0, compresslevel=9 if level is None else level
+    ),
+    "bz2": lambda f, level=None: bz2.BZ2File(
+        f, "wb", compresslevel=9 if level is None else level
+    ),
+    "xz": lambda f, level=None: lzma.LZMAFile(f, "wb", preset=level),
+    "zst": _zstd_compressor,
+}
+
+DEFAULT_COMPRESSION: dict[str, Optional[int]] = {"gz": None, "bz2": None}
+
+
+def parse_compression(formats: str, levels: list[str]) -> dict[str, Optional[int]]:
+    """Parse the compression settings for index files.
+
+    Args:
+      formats: Comma-separated list of compression formats
+      levels: List of "<format>=<level>" strings
+    Returns:
+      dictionary mapping compression formats to levels
+    """
+    ret: dict[str, Optional[int]] = {}
+    for fmt in formats.split(","):
+        fmt = fmt.strip()
+        if not fmt:
+            continue
+        if fmt not in COMPRESSORS:
+            raise ValueError(f"unknown compression format: {fmt}")
+        ret[fmt] = None
+    for entry in levels:
+        fmt, sep, level = entry.partition("=")
+        if not sep:
+            raise ValueError(f"invalid compression level: {entry}")
+        if fmt not in ret:
+            raise ValueError(f"compression format {fmt} is not enabled")
+        ret[fmt] = int(level)
+    return ret
+
+
+def _compress_file(source, writer):
+    with open(source, "rb") as f:
+        shutil.copyfileobj(f, writer)
+    writer.done()
+
+
+class ReleaseSigner:
+    """Signs Release files in a pool of worker threads.
+
+    Each worker thread keeps its own gpg context, so that contexts (and
+    their connection to gpg-agent) are reused across suites without being
+    shared between threads.
+    """
+
+    def __init__(
+        self,
+        context_factory: Callable[[], "gpg.Context"],
+        *,
+        max_workers: Optional[int] = None,
+    ) -> None:
+        self._context_factory = context_factory
+        self._local = threading.local()
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="sign"
+        )
+
+    def _context(self) -> "gpg.Context":
+        try:
+            return self._local.context
+        except AttributeError:
+            self._local.context = self._context_factory()
+            return self._local.context
+
+    def _sign(self, data: bytes) -> tuple[bytes, bytes]:
+        import gpg
+        from gpg.constants.sig import mode as gpg_mode
+
+        context = self._context()
+        detached, result = context.sign(gpg.Data(data), mode=gpg_mode.DETACH)
+        clear, result = context.sign(gpg.Data(data), mode=gpg_mode.CLEAR)
+        return detached, clear
+
+    async def sign(self, data: bytes) -> tuple[bytes, bytes]:
+        """Sign a Release file.
+
+        Returns:
+          tuple with detached signature (Release.gpg) and clearsigned
+          contents (InRelease)
+        """
+        loop = asyncio.get_running_loop()
+        with release_sign_duration.time():
+            return await loop.run_in_executor(self._executor, self._sign, data)
+
+
+def _release_contents(data: bytes) -> bytes:
+    # The Date field changes on every publish, even if nothing else does
+    return b"".join(
+        line for line in data.splitlines(True) if not line.startswith(b"Date:")
+    )
+
+
+def _release_unchanged(base_path, data: bytes, signed: bool) -> bool:
+    try:
+        with open(os.path.join(base_path, "Release"), "rb") as f:
+            old = f.read()
+    except FileNotFoundError:
+        return False
+    if _release_contents(old) != _release_contents(data):
+        return False
+    if signed:
+        return all(
+            os.path.exists(os.path.join(base_path, n))
+            for n in ("Release.gpg", "InRelease")
+        )
+    return True
+
+
+def _write_atomic(path, data: bytes) -> None:
+    fd, tmp_path = tempfile.mkstemp(
+        dir=os.path.dirname(path), prefix="." + os.path.basename(path)
+    )
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
 async def write_suite_files(
     base_path,
     *,
@@ -394,14 +948,13 @@ async def write_suite_files(
     components,
     arches,
     origin,
-    gpg_context: Optional["gpg.Context"],
+    signer: Optional[ReleaseSigner],
     timestamp: Optional[datetime] = None,
+    compression: Optional[dict[str, Optional[int]]] = None,
+    executor: Optional[Executor] = None,
 ):
-    SUFFIXES: dict[str, Any] = {
-        "": open,
-        ".gz": gzip.GzipFile,
-        ".bz2": bz2.BZ2File,
-    }
+    if compression is None:
+        compression = DEFAULT_COMPRESSION
 
     if timestamp is None:
         timestamp = datetime.utcnow()
@@ -420,73 +973,83 @@ async def write_suite_files(
     r["Description"] = "Generated by the Janitor"
     r["Acquire-By-Hash"] = "yes"
 
+    loop = asyncio.get_running_loop()
+    # Release entries for each file, in the order in which they are listed
+    entries: list[dict[str, list[dict[str, Any]]]] = []
+    compress_jobs = []
+    index_dirs = []
+
     with ExitStack() as es:
-        for component in components:
-            logger.debug("Publishing component %s/%s", suite_name, component)
-            component_dir = component
-            os.makedirs(os.path.join(base_path, component_dir), exist_ok=True)
-            for arch in arches:
-                arch_dir = os.path.join(component_dir, f"binary-{arch}")
-                os.makedirs(os.path.join(base_path, arch_dir), exist_ok=True)
-
-                packages_path = os.path.join(arch_dir, "Packages")
-                fs = []
-                for suffix, fn in SUFFIXES.items():
-                    fs.append(
-                        es.enter_context(
-                            HashedFileWriter(r, base_path, packages_path + suffix, fn)
-                        )
+
+        async def write_index(path, chunks):
+            file_entries: dict[str, list[dict[str, Any]]] = {}
+            entries.append(file_entries)
+            f = es.enter_context(HashedFileWriter(file_entries, base_path, path))
+            async for chunk in chunks:
+                f.write(chunk)
+            f.done()
+            # The compressed variants are generated from the uncompressed
+            # file, in parallel and outside of the event loop.
+            for fmt, level in compression.items():
+                file_entries = {}
+                entries.append(file_entries)
+                cf = es.enter_context(
+                    HashedFileWriter(
+                        file_entries,
+                        base_path,
+                        path + "." + fmt,
+                        partial(COMPRESSORS[fmt], level=level),
                     )
-                async for chunk in get_packages(suite_name, component, arch):
-                    for f in fs:
-                        f.write(chunk)
-                for f in fs:
-                    f.done()
-                cleanup_by_hash_files(
-                    os.path.join(base_path, arch_dir), 4 * len(SUFFIXES)
                 )
-                await asyncio.sleep(0)
-            source_dir = os.path.join(component_dir, "source")
-            os.makedirs(os.path.join(base_path, source_dir), exist_ok=True)
-
-            sources_path = os.path.join(source_dir, "Sources")
-            fs = []
-            for suffix, fn in SUFFIXES.items():
-                fs.append(
-                    es.enter_context(
-                        HashedFileWriter(r, base_path, sources_path + suffix, fn)
+                compress_jobs.append(
+                    loop.run_in_executor(executor, _compress_file, f.tmp_path, cf)
+                )
+            index_dirs.append(os.path.join(base_path, os.path.dirname(path)))
+
+        try:
+            for component in components:
+                logger.debug("Publishing component %s/%s", suite_name, component)
+                for arch in arches:
+                    await write_index(
+                        os.path.join(component, f"binary-{arch}", "Packages"),
+                        get_packages(suite_name, component, arch),
                     )
+                await write_index(
+                    os.path.join(component, "source", "Sources"),
+                    get_sources(suite_name, component),
                 )
-            async for chunk in get_sources(suite_name, component):
-                for f in fs:
-                    f.write(chunk)
-            for f in fs:
-                f.done()
-            cleanup_by_hash_files(
-                os.path.join(base_path, source_dir), 4 * len(SUFFIXES)
-            )
+        finally:
+            # Wait for all compression jobs to finish before any of the
+            # temporary files are removed.
+            results = await asyncio.gather(*compress_jobs, return_exceptions=True)
+        for result in results:
+            if isinstance(result, BaseException):
+                raise result
+
+    for file_entries in entries:
+        for hn, hash_entries in file_entries.items():
+            r.setdefault(hn, []).extend(hash_entries)
+
+    for index_dir in index_dirs:
+        cleanup_by_hash_files(index_dir)
+
+    data = r.dump().encode("utf-8")
+    if _release_unchanged(base_path, data, signed=signer is not None):
+        # Keep the existing Release file and signatures, so that they
+        # don't have to be signed again.
+        logger.debug("Release file for %s unchanged", suite_name)
+        release_sign_count.labels(result="unchanged").inc()
+        return
 
-            await asyncio.sleep(0)
+    if signer is not None:
+        logger.debug("Signing Release file for %s", suite_name)
+        detached, clear = await signer.sign(data)
+        release_sign_count.labels(result="signed").inc()
+        _write_atomic(os.path.join(base_path, "Release.gpg"), detached)
+        _write_atomic(os.path.join(base_path, "InRelease"), clear)
 
     logger.debug("Writing Release file for %s", suite_name)
-    with open(os.path.join(base_path, "Release"), "wb") as f:
-        r.dump(f)
-
-    logger.debug("Writing Release.gpg file for %s", suite_name)
-
-    if gpg_context:
-        from gpg.constants.sig import mode as gpg_mode
-
-        data = gpg.Data(r.dump())
-        with open(os.path.join(base_path, "Release.gpg"), "wb") as f:
-            signature, result = gpg_context.sign(data, mode=gpg_mode.DETACH)
-            f.write(signature)
-
-        logger.debug("Writing InRelease file for %s", suite_name)
-        data = gpg.Data(r.dump())
-        with open(os.path.join(base_path, "InRelease"), "wb") as f:
-            signature, result = gpg_context.sign(data, mode=gpg_mode.CLEAR)
-            f.write(signature)
+    _write_atomic(os.path.join(base_path, "Release"), data)
 
 
 # TODO(jelmer): Don't hardcode this
@@ -502,7 +1065,9 @@ async def handle_publish(request):
             continue
         if campaign is not None and campaign != campaign_config.name:
             continue
-        await request.app["generator_manager"].trigger_campaign(campaign_config.name)
+        await request.app["generator_manager"].trigger_campaign(
+            campaign_config.name, immediate=True
+        )
 
     return web.json_response({})
 
@@ -587,104 +1152,219 @@ async def serve_dists_component_hash_file(request):
     return web.FileResponse(path)
 
 
-async def refresh_on_demand_dists(
-    dists_dir,
-    db,
-    config,
-    package_info_provider,
-    gpg_context: Optional["gpg.Context"],
-    kind,
-    id,
-) -> None:
-    os.makedirs(os.path.join(dists_dir, kind, id), exist_ok=True)
-    release_path = os.path.join(dists_dir, kind, id, "Release")
-    try:
-        with open(release_path) as f:
-            release = Release(f)
-    except FileNotFoundError:
-        stamp = None
-    else:
-        stamp = parsedate_to_datetime(release["Date"])
-    async with db.acquire() as conn:
-        if kind == "run":
-            # /run/{run_id}
-            row = await conn.fetchrow(
-                "SELECT suite, max(finish_time) FROM run WHERE id = $1", id
-            )
-            if row is None:
-                raise web.HTTPNotFound(text=f"no such run: {id}")
-            campaign, max_finish_time = row
-            builds = await get_builds_for_run(db, id)
-            campaign_config = get_campaign_config(config, campaign)
-        elif kind == "cs":
-            # /cs/{change_set_id}
-            campaign = await conn.fetchval(
-                "SELECT campaign FROM change_set WHERE id = $1", id
-            )
-            if campaign is None:
-                raise web.HTTPNotFound(text=f"no such changeset: {id}")
-            max_finish_time = await conn.fetchval(
-                "SELECT max(finish_time) FROM run WHERE change_set = $1", id
-            )
-            builds = await get_builds_for_changeset(db, id)
-            description = f"Change set {id}"
-            campaign_config = get_campaign_config(config, campaign)
+def builds_fingerprint(builds, components, arches) -> str:
+    """Fingerprint the inputs of an on-demand suite.
+
+    Args:
+      builds: (source, run_id, distribution, version) rows of the builds in
+        the suite
+      components: Components in the suite
+      arches: Architectures in the suite
+    Returns:
+      hex digest that changes whenever the generated suite would
+    """
+    h = hashlib.sha256()
+    h.update(json.dumps([list(components), list(arches)]).encode("utf-8"))
+    for row in sorted(tuple(row) for row in builds):
+        h.update(json.dumps([str(v) for v in row]).encode("utf-8"))
+    return h.hexdigest()
+
+
+class OnDemandDists:
+    """Generator for the on-demand suites for runs, change sets and codebases.
+
+    Each generated suite is tagged with a fingerprint of the set of builds
+    it was generated from, and only regenerated when that changes. The
+    builds are looked up at most once every ``ttl`` seconds per suite, and
+    concurrent requests for the same suite share a single refresh. At most
+    ``max_entries`` suites are kept; the least recently used are removed.
+    """
+
+    FINGERPRINT_NAME = ".fingerprint"
+
+    def __init__(
+        self,
+        dists_dir,
+        db,
+        config,
+        package_info_provider,
+        signer: Optional[ReleaseSigner],
+        *,
+        max_entries: Optional[int] = None,
+        ttl: float = 60.0,
+        compression: Optional[dict[str, Optional[int]]] = None,
+        executor: Optional[Executor] = None,
+    ) -> None:
+        self.dists_dir = dists_dir
+        self.db = db
+        self.config = config
+        self.package_info_provider = package_info_provider
+        self.signer = signer
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.compression = compression
+        self.executor = executor
+        self._refreshes: SingleFlight[None] = SingleFlight()
+        # Maps (kind, id) to the time the suite was last checked, least
+        # recently used first
+        self._entries: collections.OrderedDict[tuple[str, str], float] = (
+            collections.OrderedDict()
+        )
+        self._scan()
+
+    def _path(self, kind: str, id: str) -> str:
+        if "/" in id or id.startswith("."):
+            raise web.HTTPNotFound(text=f"invalid id: {id}")
+        return os.path.join(self.dists_dir, kind, id)
+
+    def _scan(self) -> None:
+        entries = []
+        try:
+            kinds = list(os.scandir(self.dists_dir))
+        except FileNotFoundError:
+            return
+        for kind in kinds:
+            if not kind.is_dir():
+                continue
+            for entry in os.scandir(kind.path):
+                try:
+                    st = os.stat(os.path.join(entry.path, self.FINGERPRINT_NAME))
+                except (FileNotFoundError, NotADirectoryError):
+                    continue
+                entries.append((st.st_mtime, kind.name, entry.name))
+        for _mtime, kind_name, id in sorted(entries):
+            # Not checked since startup
+            self._entries[(kind_name, id)] = float("-inf")
+
+    def _evict(self) -> None:
+        if self.max_entries is None:
+            return
+        for key in list(self._entries):
+            if len(self._entries) <= self.max_entries:
+                break
+            if ("on-demand-dists", *key) in self._refreshes:
+                continue
+            del self._entries[key]
+            logger.debug("Removing on-demand suite %s/%s", *key)
+            shutil.rmtree(self._path(*key), ignore_errors=True)
+            on_demand_dists_eviction_count.inc()
+
+    async def refresh(self, kind: str, id: str) -> None:
+        """Make sure the on-demand suite for kind/id is up to date.
+
+        Raises:
+          web.HTTPNotFound: if there is no such run, change set or codebase
+        """
+        path = self._path(kind, id)
+        loop = asyncio.get_running_loop()
+        key = (kind, id)
+        checked = self._entries.get(key)
+        if checked is not None and loop.time() - checked < self.ttl:
+            self._entries.move_to_end(key)
+            on_demand_dists_refresh_count.labels(result="recent").inc()
+            return
+        await self._refreshes.do(
+            ("on-demand-dists", kind, id), partial(self._refresh, kind, id, path)
+        )
+        self._evict()
+
+    async def _lookup(self, kind, id):
+        async with self.db.acquire() as conn:
+            if kind == "run":
+                # /run/{run_id}
+                campaign = await conn.fetchval(
+                    "SELECT suite FROM run WHERE id = $1", id
+                )
+                if campaign is None:
+                    raise web.HTTPNotFound(text=f"no such run: {id}")
+                builds = await get_builds_for_run(self.db, id)
+                description = f"Run {id}"
+            elif kind == "cs":
+                # /cs/{change_set_id}
+                campaign = await conn.fetchval(
+                    "SELECT campaign FROM change_set WHERE id = $1", id
+                )
+                if campaign is None:
+                    raise web.HTTPNotFound(text=f"no such changeset: {id}")
+                builds = await get_builds_for_changeset(self.db, id)
+                description = f"Change set {id}"
+            else:
+                # /{suite}/{codebase}
+                campaign = kind
+                try:
+                    get_campaign_config(self.config, kind)
+                except KeyError as e:
+                    raise web.HTTPNotFound(text=f"No such campaign: {kind}") from e
+                cs_id = await conn.fetchval(
+                    "SELECT run.change_set FROM run "
+                    "INNER JOIN change_set ON change_set.id = run.change_set "
+                    "WHERE run.suite = $1 AND run.codebase = $2 "
+                    "AND change_set.state in "
+                    "('working', 'ready', 'publishing', 'done') AND "
+                    "run.result_code = 'success' "
+                    "ORDER BY run.finish_time DESC",
+                    kind,
+                    id,
+                )
+                if cs_id is None:
+                    if not (
+                        await conn.fetchrow(
+                            "SELECT 1 FROM debian_build WHERE source = $1", id
+                        )
+                    ):
+                        raise web.HTTPNotFound(text=f"No such source package: {id}")
+                builds = await get_builds_for_changeset(self.db, cs_id)
+                description = f"Campaign {kind} for {id}"
+        campaign_config = get_campaign_config(self.config, campaign)
+        distribution = get_distribution(
+            self.config, campaign_config.debian_build.base_distribution
+        )
+        return distribution, builds, description
+
+    async def _refresh(self, kind, id, path) -> None:
+        distribution, builds, description = await self._lookup(kind, id)
+        fingerprint = builds_fingerprint(builds, distribution.component, ARCHES)
+        fingerprint_path = os.path.join(path, self.FINGERPRINT_NAME)
+        try:
+            with open(fingerprint_path) as f:
+                existing = f.read().strip()
+        except FileNotFoundError:
+            existing = None
+        if existing == fingerprint:
+            on_demand_dists_refresh_count.labels(result="unchanged").inc()
+            os.utime(fingerprint_path)
         else:
-            # /{suite}/{codebase}
-            try:
-                campaign_config = get_campaign_config(config, kind)
-            except KeyError as e:
-                raise web.HTTPNotFound(text=f"No such campaign: {kind}") from e
-            cs_id = await conn.fetchval(
-                "SELECT run.change_set FROM run "
-                "INNER JOIN change_set ON change_set.id = run.change_set "
-                "WHERE run.suite = $1 AND run.codebase = $2 "
-                "AND change_set.state in ('working', 'ready', 'publishing', 'done') AND "
-                "run.result_code = 'success' "
-                "ORDER BY run.finish_time DESC",
-                kind,
-                id,
+            logger.info("Generating metadata for %s/%s", kind, id, extra={"run_id": id})
+            os.makedirs(path, exist_ok=True)
+            await write_suite_files(
+                path,
+                get_packages=partial(
+                    retrieve_packages, self.package_info_provider, builds
+                ),
+                get_sources=partial(
+                    retrieve_sources, self.package_info_provider, builds
+                ),
+                suite_name=f"{kind}/{id}",
+                archive_description=description,
+                components=distribution.component,
+                arches=ARCHES,
+                origin=self.config.origin,
+                signer=self.signer,
+                compression=self.compression,
+                executor=self.executor,
             )
-            if cs_id is None:
-                if not (
-                    await conn.fetchrow(
-                        "SELECT 1 FROM debian_build WHERE source = $1", id
-                    )
-                ):
-                    raise web.HTTPNotFound(text=f"No such source package: {id}")
-            max_finish_time = await conn.fetchval(
-                "SELECT max(finish_time) FROM run WHERE change_set = $1", cs_id
-            )
-            builds = await get_builds_for_changeset(db, cs_id)
-            description = f"Campaign {kind} for {id}"
-    if stamp is not None and max_finish_time and max_finish_time.astimezone() < stamp:
-        return
-    logging.info("Generating metadata for %s/%s", kind, id, extra={"run_id": id})
-    distribution = get_distribution(
-        config, campaign_config.debian_build.base_distribution
-    )
-    await write_suite_files(
-        os.path.join(dists_dir, kind, id),
-        get_packages=partial(retrieve_packages, package_info_provider, builds),
-        get_sources=partial(retrieve_sources, package_info_provider, builds),
-        suite_name=f"{kind}/{id}",
-        archive_description=description,
-        components=distribution.component,
-        arches=ARCHES,
-        origin=config.origin,
-        gpg_context=gpg_context,
-    )
+            fd, tmp_path = tempfile.mkstemp(dir=path, prefix=".tmp")
+            with os.fdopen(fd, "w") as f:
+                f.write(fingerprint + "\n")
+            os.replace(tmp_path, fingerprint_path)
+            on_demand_dists_refresh_count.labels(result="generated").inc()
+        self._entries[(kind, id)] = asyncio.get_running_loop().time()
+        self._entries.move_to_end((kind, id))
 
 
 async def serve_on_demand_dists_release_file(request):
-    await refresh_on_demand_dists(
-        request.app["dists_dir"],
-        request.app["db"],
-        request.app["config"],
-        request.app["generator_manager"].package_info_provider,
-        request.app["gpg"],
-        request.match_info["kind"],
-        request.match_info["id"],
+    await request.app["on_demand_dists"].refresh(
+        request.match_info["kind"], request.match_info["id"]
     )
 
     path = os.path.join(
@@ -699,14 +1379,8 @@ async def serve_on_demand_dists_release_file(request):
 
 
 async def serve_on_demand_dists_component_file(request):
-    await refresh_on_demand_dists(
-        request.app["dists_dir"],
-        request.app["db"],
-        request.app["config"],
-        request.app["generator_manager"].package_info_provider,
-        request.app["gpg"],
-        request.match_info["kind"],
-        request.match_info["id"],
+    await request.app["on_demand_dists"].refresh(
+        request.match_info["kind"], request.match_info["id"]
     )
 
     path = os.path.join(
@@ -723,14 +1397,8 @@ async def serve_on_demand_dists_component_file(request):
 
 
 async def serve_on_demand_dists_component_hash_file(request):
-    await refresh_on_demand_dists(
-        request.app["dists_dir"],
-        request.app["db"],
-        request.app["config"],
-        request.app["generator_manager"].package_info_provider,
-        request.app["gpg"],
-        request.match_info["kind"],
-        request.match_info["id"],
+    await request.app["on_demand_dists"].refresh(
+        request.match_info["kind"], request.match_info["id"]
     )
 
     path = os.path.join(
@@ -754,6 +1422,7 @@ async def create_app(
     dists_dir,
     db,
     gpg_context: Optional["gpg.Context"] = None,
+    on_demand_dists: Optional[OnDemandDists] = None,
 ) -> web.Application:
     trailing_slash_redirect = normalize_path_middleware(append_slash=True)
     app = web.Application(
@@ -764,6 +1433,17 @@ async def create_app(
     app["config"] = config
     app["generator_manager"] = generator_manager
     app["db"] = db
+    if on_demand_dists is None and generator_manager is not None:
+        on_demand_dists = OnDemandDists(
+            dists_dir,
+            db,
+            config,
+            generator_manager.package_info_provider,
+            generator_manager.signer,
+            compression=generator_manager.compression,
+            executor=generator_manager.compression_executor,
+        )
+    app["on_demand_dists"] = on_demand_dists
     setup_metrics(app)
     app.router.add_routes(routes)
     app.router.add_get(
@@ -811,9 +1491,15 @@ async def run_web_server(
     generator_manager,
     tracer,
     gpg_context: Optional["gpg.Context"] = None,
+    on_demand_dists: Optional[OnDemandDists] = None,
 ) -> None:
     app = await create_app(
-        generator_manager, config, dists_dir, db, gpg_context=gpg_context
+        generator_manager,
+        config,
+        dists_dir,
+        db,
+        gpg_context=gpg_context,
+        on_demand_dists=on_demand_dists,
     )
     aiozipkin.setup(app, tracer)
     runner = web.AppRunner(app)
@@ -845,7 +1531,10 @@ async def publish_repository(
     package_info_provider,
     config,
     apt_repository_config,
-    gpg_context: Optional["gpg.Context"],
+    signer: Optional[ReleaseSigner],
+    index_directory: Optional[str] = None,
+    compression: Optional[dict[str, Optional[int]]] = None,
+    compression_executor: Optional[Executor] = None,
 ) -> None:
     start_time = datetime.utcnow()
     logger.info("Publishing %s", apt_repository_config.name)
@@ -862,16 +1551,34 @@ async def publish_repository(
                 db, campaign_config.debian_build.build_distribution
             )
         )
+    if index_directory is not None:
+        get_packages = partial(
+            retrieve_packages_incremental,
+            package_info_provider,
+            index_directory,
+            builds,
+        )
+        get_sources = partial(
+            retrieve_sources_incremental,
+            package_info_provider,
+            index_directory,
+            builds,
+        )
+    else:
+        get_packages = partial(retrieve_packages, package_info_provider, builds)
+        get_sources = partial(retrieve_sources, package_info_provider, builds)
     await write_suite_files(
         suite_path,
-        get_packages=partial(retrieve_packages, package_info_provider, builds),
-        get_sources=partial(retrieve_sources, package_info_provider, builds),
+        get_packages=get_packages,
+        get_sources=get_sources,
         suite_name=apt_repository_config.name,
         archive_description=apt_repository_config.description,
         components=distribution.component,
         arches=ARCHES,
         origin=config.origin,
-        gpg_context=gpg_context,
+        signer=signer,
+        compression=compression,
+        executor=compression_executor,
     )
 
     logger.info(
@@ -884,21 +1591,59 @@ async def publish_repository(
 
 
 class GeneratorManager:
+    """Publishes suites when the builds in them change.
+
+    Suites are marked dirty when a build for one of their campaigns
+    finishes. A dirty suite is published once no new builds have come in for
+    ``coalesce_window`` seconds, so that a burst of builds results in a single
+    publish, but at most ``max_staleness`` seconds after the first build that
+    has not been published yet.
+
+    If publishing fails, the suite stays dirty and is retried with an
+    exponential backoff, starting at ``retry_delay`` seconds and capped at
+    ``max_retry_delay`` seconds.
+    """
+
     def __init__(
         self,
         dists_dir,
         db,
         config,
         package_info_provider,
-        gpg_context: Optional["gpg.Context"],
+        signer: Optional[ReleaseSigner],
+        index_directory: Optional[str] = None,
+        compression: Optional[dict[str, Optional[int]]] = None,
+        compression_executor: Optional[Executor] = None,
+        *,
+        coalesce_window: float = 60.0,
+        max_staleness: float = 15 * 60.0,
+        retry_delay: float = 60.0,
+        max_retry_delay: float = 60 * 60.0,
     ) -> None:
         self.dists_dir = dists_dir
         self.db = db
         self.config = config
         self.package_info_provider = package_info_provider
-        self.gpg_context = gpg_context
+        self.signer = signer
+        self.index_directory = index_directory
+        self.compression = compression
+        self.compression_executor = compression_executor
+        self.coalesce_window = coalesce_window
+        self.max_staleness = max_staleness
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
         self.scheduler = Scheduler()
         self.jobs: dict[str, Job] = {}
+        # Maps suite names to the times of the first and last change that
+        # have not been published yet
+        self._dirty: dict[str, tuple[float, float]] = {}
+        self._pending: dict[str, int] = {}
+        # Number of consecutive failed publishes, and the time until which
+        # publishing is backed off
+        self._failures: dict[str, int] = {}
+        self._retry_after: dict[str, float] = {}
+        self._wakeups: dict[str, asyncio.Event] = {}
+        self._running: set[str] = set()
         self._campaign_to_repository: dict[str, list[AptRepositoryConfig]] = {}
         for apt_repo in self.config.apt_repository:
             for select in apt_repo.select:
@@ -906,36 +1651,109 @@ class GeneratorManager:
                     apt_repo
                 )
 
-    async def trigger_campaign(self, campaign_name):
+    async def trigger_campaign(self, campaign_name, *, immediate: bool = False):
         for apt_repo in self._campaign_to_repository.get(campaign_name, []):
-            await self.trigger(apt_repo)
-
-    async def trigger(self, apt_repository_config: AptRepositoryConfig):
+            await self.trigger(apt_repo, immediate=immediate)
+
+    async def trigger(
+        self, apt_repository_config: AptRepositoryConfig, *, immediate: bool = False
+    ):
+        """Mark a suite as dirty.
+
+        Args:
+          apt_repository_config: Suite to publish
+          immediate: Publish the suite without waiting for further changes
+        """
+        name = apt_repository_config.name
+        now = asyncio.get_running_loop().time()
+        first = self._dirty.get(name, (now, now))[0]
+        if immediate:
+            first = min(first, now - self.max_staleness)
+        self._dirty[name] = (first, now)
+        self._pending[name] = self._pending.get(name, 0) + 1
+        publish_pending_count.labels(suite=name).set(self._pending[name])
         try:
-            job = self.jobs[apt_repository_config.name]
+            self._wakeups[name].set()
         except KeyError:
             pass
-        else:
-            if not job.closed:
-                return
-        self.jobs[apt_repository_config.name] = await self.scheduler.spawn(
-            publish_repository(
-                self.dists_dir,
-                self.db,
-                self.package_info_provider,
-                self.config,
-                apt_repository_config,
-                self.gpg_context,
+        if name not in self._running:
+            self._running.add(name)
+            self.jobs[name] = await self.scheduler.spawn(
+                self._run(apt_repository_config)
             )
+
+    async def _run(self, apt_repository_config: AptRepositoryConfig) -> None:
+        name = apt_repository_config.name
+        loop = asyncio.get_running_loop()
+        try:
+            while name in self._dirty:
+                first, last = self._dirty[name]
+                delay = (
+                    min(last + self.coalesce_window, first + self.max_staleness)
+                    - loop.time()
+                )
+                delay = max(delay, self._retry_after.get(name, 0) - loop.time())
+                if delay > 0:
+                    wakeup = self._wakeups[name] = asyncio.Event()
+                    try:
+                        await asyncio.wait_for(wakeup.wait(), delay)
+                    except asyncio.TimeoutError:
+                        pass
+                    continue
+                del self._dirty[name]
+                pending = self._pending.pop(name, 0)
+                publish_pending_count.labels(suite=name).set(0)
+                logger.debug("Publishing %s for %d changes", name, pending)
+                try:
+                    await self._publish(apt_repository_config)
+                except Exception:
+                    failures = self._failures[name] = self._failures.get(name, 0) + 1
+                    backoff = min(
+                        self.retry_delay * 2 ** (failures - 1), self.max_retry_delay
+                    )
+                    logger.exception(
+                        "Failed to publish %s; retrying in %d seconds", name, backoff
+                    )
+                    # Keep the suite dirty, merged with any changes that came
+                    # in while publishing
+                    new_first, new_last = self._dirty.get(name, (first, last))
+                    self._dirty[name] = (min(first, new_first), max(last, new_last))
+                    self._pending[name] = self._pending.get(name, 0) + pending
+                    publish_pending_count.labels(suite=name).set(self._pending[name])
+                    self._retry_after[name] = loop.time() + backoff
+                else:
+                    self._failures.pop(name, None)
+                    self._retry_after.pop(name, None)
+        finally:
+            self._wakeups.pop(name, None)
+            self._running.discard(name)
+
+    async def _publish(self, apt_repository_config: AptRepositoryConfig) -> None:
+        await publish_repository(
+            self.dists_dir,
+            self.db,
+            self.package_info_provider,
+            self.config,
+            apt_repository_config,
+            self.signer,
+            index_directory=self.index_directory,
+            compression=self.compression,
+            compression_executor=self.compression_executor,
         )
 
 
-async def loop_publish(config, generator_manager: GeneratorManager) -> None:
+async def loop_publish(
+    config, generator_manager: GeneratorManager, interval: float = 60 * 60 * 12
+) -> None:
+    """Periodically publish all suites.
+
+    Suites are normally published when builds finish; this makes sure they
+    are published on startup, and catches up on any missed changes.
+    """
     while True:
         for apt_repo in config.apt_repository:
-            await generator_manager.trigger(apt_repo)
-        # every 12 hours
-        await asyncio.sleep(60 * 60 * 12)
+            await generator_manager.trigger(apt_repo, immediate=True)
+        await asyncio.sleep(interval)
 
 
 async def main_async(argv=None):
@@ -955,7 +1773,52 @@ async def main_async(argv=None):
         "--config", type=str, default="janitor.conf", help="Path to configuration"
     )
     parser.add_argument("--cache-directory", type=str, help="Cache directory")
+    parser.add_argument(
+        "--cache-max-size",
+        type=int,
+        default=None,
+        help="Maximum size of the package info cache (in MB)",
+    )
+    parser.add_argument(
+        "--fetch-concurrency",
+        type=int,
+        default=8,
+        help="Number of runs to retrieve artifacts for in parallel",
+    )
+    parser.add_argument(
+        "--fetch-timeout",
+        type=int,
+        default=DEFAULT_GCS_TIMEOUT,
+        help="Timeout for retrieving the artifacts for a single run (in seconds)",
+    )
+    parser.add_argument(
+        "--index-directory",
+        type=str,
+        help="Directory to keep per-suite stanza indexes in, so that suites "
+        "can be regenerated incrementally. Defaults to a subdirectory of "
+        "the cache directory.",
+    )
     parser.add_argument("--dists-directory", type=str, help="Dists directory")
+    parser.add_argument(
+        "--compression",
+        type=str,
+        default=",".join(DEFAULT_COMPRESSION),
+        help="Comma-separated list of compressed variants of index files to "
+        "generate (supported: {})".format(", ".join(COMPRESSORS)),
+    )
+    parser.add_argument(
+        "--compression-level",
+        type=str,
+        action="append",
+        default=[],
+        metavar="FORMAT=LEVEL",
+        help="Compression level to use for a format",
+    )
+    parser.add_argument(
+        "--compression-workers",
+        type=int,
+        help="Number of threads to use for compressing index files",
+    )
     parser.add_argument(
         "--gcp-logging", action="store_true", help="Use Google cloud logging"
     )
@@ -963,6 +1826,46 @@ async def main_async(argv=None):
         "--verbose", action="store_true", help="Show more detailed output"
     )
     parser.add_argument("--no-gpg", action="store_true", help="Don't sign with GPG")
+    parser.add_argument(
+        "--signing-workers",
+        type=int,
+        default=4,
+        help="Number of Release files to sign in parallel",
+    )
+    parser.add_argument(
+        "--publish-coalesce-window",
+        type=float,
+        default=60.0,
+        help="Time (in seconds) to wait for further builds before publishing "
+        "a suite that has changed",
+    )
+    parser.add_argument(
+        "--publish-max-staleness",
+        type=float,
+        default=15 * 60.0,
+        help="Maximum time (in seconds) between a build finishing and its "
+        "suite being published",
+    )
+    parser.add_argument(
+        "--publish-interval",
+        type=float,
+        default=60 * 60 * 12,
+        help="Interval (in seconds) at which all suites are published, "
+        "regardless of whether they have changed",
+    )
+    parser.add_argument(
+        "--on-demand-max-entries",
+        type=int,
+        default=1000,
+        help="Maximum number of on-demand suites to keep",
+    )
+    parser.add_argument(
+        "--on-demand-ttl",
+        type=float,
+        default=60.0,
+        help="Time (in seconds) for which a generated on-demand suite is "
+        "served without checking whether its builds have changed",
+    )
 
     args = parser.parse_args()
     if not args.dists_directory:
@@ -986,6 +1889,16 @@ async def main_async(argv=None):
     except FileNotFoundError:
         parser.error(f"config path {args.config} does not exist")
 
+    try:
+        compression = parse_compression(args.compression, args.compression_level)
+    except ValueError as e:
+        parser.error(str(e))
+    if "zst" in compression:
+        try:
+            import zstandard  # noqa: F401
+        except ModuleNotFoundError:
+            parser.error("zstd compression requires the zstandard module")
+
     os.makedirs(args.dists_directory, exist_ok=True)
 
     db = await state.create_pool(config.database_location)
@@ -1006,27 +1919,67 @@ async def main_async(argv=None):
         # ruff incorrectly thinks quotes can be removed
         "gpg.Context"  # noqa: UP037
     ]
+    signer: Optional[ReleaseSigner]
     if not args.no_gpg:
         import gpg
 
         gpg_context = gpg.Context(armor=True)
+        signer = ReleaseSigner(
+            partial(gpg.Context, armor=True), max_workers=args.signing_workers
+        )
     else:
         gpg_context = None
+        signer = None
 
     package_info_provider: PackageInfoProvider
-    package_info_provider = GeneratingPackageInfoProvider(artifact_manager)
+    package_info_provider = GeneratingPackageInfoProvider(
+        artifact_manager,
+        concurrency=args.fetch_concurrency,
+        timeout=args.fetch_timeout,
+    )
     if args.cache_directory:
         os.makedirs(args.cache_directory, exist_ok=True)
         package_info_provider = DiskCachingPackageInfoProvider(
-            package_info_provider, args.cache_directory
+            package_info_provider,
+            args.cache_directory,
+            max_size=(
+                args.cache_max_size * 1024**2
+                if args.cache_max_size is not None
+                else None
+            ),
         )
+    package_info_provider = DatabasePackageInfoProvider(db, package_info_provider)
+
+    index_directory = args.index_directory
+    if index_directory is None and args.cache_directory:
+        index_directory = os.path.join(args.cache_directory, "suites")
 
     generator_manager = GeneratorManager(
         args.dists_directory,
         db,
         config,
         package_info_provider,
-        gpg_context,
+        signer,
+        index_directory=index_directory,
+        compression=compression,
+        compression_executor=ThreadPoolExecutor(
+            max_workers=args.compression_workers,
+            thread_name_prefix="compress",
+        ),
+        coalesce_window=args.publish_coalesce_window,
+        max_staleness=args.publish_max_staleness,
+    )
+
+    on_demand_dists = OnDemandDists(
+        args.dists_directory,
+        db,
+        config,
+        package_info_provider,
+        signer,
+        max_entries=args.on_demand_max_entries,
+        ttl=args.on_demand_ttl,
+        compression=generator_manager.compression,
+        executor=generator_manager.compression_executor,
     )
 
     loop = asyncio.get_event_loop()
@@ -1041,9 +1994,12 @@ async def main_async(argv=None):
                 generator_manager,
                 tracer,
                 gpg_context=gpg_context,
+                on_demand_dists=on_demand_dists,
             )
         ),
-        loop.create_task(loop_publish(config, generator_manager)),
+        loop.create_task(
+            loop_publish(config, generator_manager, args.publish_interval)
+        ),
     ]
 
     redis = Redis.from_url(config.redis_location)
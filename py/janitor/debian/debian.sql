@@ -14,3 +14,13 @@ CREATE INDEX ON debian_build (distribution, source, version);
 
 
 
+-- Packages and Sources stanzas for the packages built by a run, generated
+-- when the build is imported so that the archive doesn't have to retrieve
+-- and scan artifacts.
+CREATE TABLE debian_package_index (
+ run_id text not null references run (id),
+ -- Architecture of the binary packages, or "source" for source packages
+ architecture text not null,
+ stanzas bytea not null,
+ primary key (run_id, architecture)
+);
@@ -0,0 +1,540 @@
+#!/usr/bin/python3
+# Copyright (C) 2024 Jelmer Vernooij <jelmer@jelmer.uk>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+"""Generate Packages and Sources stanzas for binary and source packages.
+
+This produces the same output as dpkg-scanpackages and dpkg-scansources
+(without override files), but without spawning a process per directory:
+control information is extracted in-process, while the package is hashed
+in the same pass.
+"""
+
+__all__ = [
+    "ControlStanza",
+    "package_index",
+    "run_directory",
+    "scan_deb",
+    "scan_dsc",
+    "scan_packages",
+    "scan_sources",
+]
+
+import asyncio
+import hashlib
+import io
+import logging
+import os
+import re
+import subprocess
+import tarfile
+from collections.abc import AsyncIterator, Iterable, Iterator
+from typing import BinaryIO, Optional
+
+from debian.debian_support import version_compare
+
+# Field order used by dpkg for Packages and Sources files.
+PACKAGES_FIELD_ORDER = [
+    "Package",
+    "Package-Type",
+    "Source",
+    "Version",
+    "Kernel-Version",
+    "Built-For-Profiles",
+    "Auto-Built-Package",
+    "Architecture",
+    "Subarchitecture",
+    "Installer-Menu-Item",
+    "Build-Essential",
+    "Essential",
+    "Protected",
+    "Origin",
+    "Bugs",
+    "Maintainer",
+    "Installed-Size",
+    "Pre-Depends",
+    "Depends",
+    "Recommends",
+    "Suggests",
+    "Enhances",
+    "Conflicts",
+    "Breaks",
+    "Replaces",
+    "Provides",
+    "Built-Using",
+    "Static-Built-Using",
+    "Filename",
+    "Size",
+    "MD5sum",
+    "SHA1",
+    "SHA256",
+    "Section",
+    "Priority",
+    "Multi-Arch",
+    "Homepage",
+    "Description",
+    "Tag",
+    "Task",
+]
+
+SOURCES_FIELD_ORDER = [
+    "Format",
+    "Package",
+    "Binary",
+    "Architecture",
+    "Version",
+    "Priority",
+    "Section",
+    "Origin",
+    "Maintainer",
+    "Uploaders",
+    "Homepage",
+    "Description",
+    "Standards-Version",
+    "Vcs-Browser",
+    "Vcs-Arch",
+    "Vcs-Bzr",
+    "Vcs-Cvs",
+    "Vcs-Darcs",
+    "Vcs-Git",
+    "Vcs-Hg",
+    "Vcs-Mtn",
+    "Vcs-Svn",
+    "Testsuite",
+    "Testsuite-Triggers",
+    "Build-Depends",
+    "Build-Depends-Arch",
+    "Build-Depends-Indep",
+    "Build-Conflicts",
+    "Build-Conflicts-Arch",
+    "Build-Conflicts-Indep",
+    "Package-List",
+    "Directory",
+    "Checksums-Md5",
+    "Checksums-Sha1",
+    "Checksums-Sha256",
+    "Files",
+]
+
+# Known fields whose canonical spelling doesn't follow the usual
+# capitalization rules.
+_FIELD_NAMES = {
+    name.lower(): name
+    for name in [
+        "ButAutomaticUpgrades",
+        "MD5sum",
+        "No-Support-for-Architecture-all",
+        "NotAutomatic",
+        "SHA1",
+        "SHA256",
+    ]
+}
+
+# Checksum algorithms, in the order dpkg processes them.
+CHECKSUMS = {
+    "md5": hashlib.md5,
+    "sha1": hashlib.sha1,
+    "sha256": hashlib.sha256,
+}
+
+_WHITESPACE = " \t\n\r\f\v"
+
+_CHECKSUM_LINE_RE = re.compile(
+    r"^([0-9a-f]+)\s+(\d+)\s+([0-9a-zA-Z][-+:.,=0-9a-zA-Z_~]+)$"
+)
+
+
+def capitalize_field(name: str) -> str:
+    name = name.lower()
+    try:
+        return _FIELD_NAMES[name]
+    except KeyError:
+        pass
+    parts = name.split("-")
+    while parts and not parts[-1]:
+        parts.pop()
+    return "-".join(p[:1].upper() + p[1:] for p in parts)
+
+
+class ControlStanza:
+    """A control file stanza, formatted the way dpkg formats index files.
+
+    Field names are case-insensitive. Fields in the output order come first;
+    any other fields follow in alphabetical order.
+    """
+
+    def __init__(self, order: Iterable[str] = ()) -> None:
+        self.order = {name: i for (i, name) in enumerate(order)}
+        # Lowercased field name to (canonical name, value)
+        self._fields: dict[str, tuple[str, str]] = {}
+
+    def __getitem__(self, name: str) -> str:
+        return self._fields[name.lower()][1]
+
+    def __setitem__(self, name: str, value: str) -> None:
+        key = name.lower()
+        try:
+            name = self._fields[key][0]
+        except KeyError:
+            name = capitalize_field(name)
+        self._fields[key] = (name, value)
+
+    def __delitem__(self, name: str) -> None:
+        del self._fields[name.lower()]
+
+    def __contains__(self, name: str) -> bool:
+        return name.lower() in self._fields
+
+    def get(self, name: str, default: Optional[str] = None) -> Optional[str]:
+        try:
+            return self[name]
+        except KeyError:
+            return default
+
+    def _sort_key(self, name: str) -> tuple[int, str]:
+        try:
+            return (self.order[name], "")
+        except KeyError:
+            return (len(self.order), name)
+
+    def dump(self) -> bytes:
+        ret = []
+        for name, value in sorted(
+            self._fields.values(), key=lambda f: self._sort_key(f[0])
+        ):
+            # Empty fields are dropped from index files
+            if not value.strip(_WHITESPACE):
+                continue
+            lines = value.split("\n")
+            while len(lines) > 1 and lines[-1] == "":
+                lines.pop()
+            first_line, lines = lines[0], lines[1:]
+            ret.append(f"{name}: {first_line}\n" if first_line else f"{name}:\n")
+            for line in lines:
+                line = line.rstrip(_WHITESPACE)
+                if not line or not line.strip("."):
+                    ret.append(f" .{line}\n")
+                else:
+                    ret.append(f" {line}\n")
+        return "".join(ret).encode("utf-8", "surrogateescape")
+
+    def __bytes__(self) -> bytes:
+        return self.dump()
+
+
+def parse_control(data: bytes, order: Iterable[str] = ()) -> ControlStanza:
+    """Parse the first stanza in a control file, the way dpkg does.
+
+    Raises:
+      ValueError: if the control file can not be parsed
+    """
+    stanza = ControlStanza(order)
+    lines = iter(data.decode("utf-8", "surrogateescape").split("\n"))
+    current = None
+    in_body = False
+    signed = False
+    for armor in lines:
+        line = armor.rstrip(_WHITESPACE)
+        if not line and current is None:
+            continue
+        if line.startswith("#"):
+            continue
+        name, sep, value = line.partition(":")
+        name = name.rstrip(_WHITESPACE)
+        if sep and name and not any(c in _WHITESPACE for c in name):
+            in_body = True
+            if name.startswith("-"):
+                raise ValueError("field cannot start with a hyphen")
+            if name in stanza:
+                raise ValueError(f"duplicate field {name} found")
+            stanza[name] = value.lstrip(_WHITESPACE)
+            current = name
+        elif line[:1] in tuple(_WHITESPACE) and line.strip(_WHITESPACE):
+            if current is None:
+                raise ValueError("continued value line not in field")
+            cont = line[1:]
+            if not cont.strip("."):
+                cont = cont[1:]
+            stanza[current] = stanza[current] + "\n" + cont
+        elif not line or (
+            signed and re.match(r"^-----BEGIN PGP SIGNATURE-----[\r\t ]*$", armor)
+        ):
+            break
+        elif re.match(r"^-----BEGIN PGP SIGNED MESSAGE-----[\r\t ]*$", armor):
+            if in_body:
+                raise ValueError("OpenPGP signature not allowed here")
+            signed = True
+            # Skip the armor headers
+            for header in lines:
+                if not header.strip(_WHITESPACE):
+                    break
+        else:
+            raise ValueError("line with unknown format (not field-colon-value)")
+    return stanza
+
+
+class _HashingReader:
+    """Wrapper around a file that hashes everything that is read from it."""
+
+    def __init__(self, f: BinaryIO) -> None:
+        self.f = f
+        self.hashes = {alg: kls() for (alg, kls) in CHECKSUMS.items()}
+        self.size = 0
+
+    def read(self, n: int) -> bytes:
+        data = self.f.read(n)
+        for h in self.hashes.values():
+            h.update(data)
+        self.size += len(data)
+        return data
+
+    def exhaust(self) -> None:
+        while self.read(1024 * 1024):
+            pass
+
+
+def _read_ar_members(f: _HashingReader) -> Iterator[tuple[str, int]]:
+    if f.read(8) != b"!<arch>\n":
+        raise ValueError("not an ar archive")
+    while True:
+        header = f.read(60)
+        if not header:
+            return
+        if len(header) != 60 or header[58:60] != b"`\n":
+            raise ValueError("invalid ar member header")
+        name = header[:16].decode("ascii").rstrip(" ").rstrip("/")
+        size = int(header[48:58])
+        yield name, size
+
+
+def _extract_control_tarball(name: str, data: bytes) -> bytes:
+    if name.endswith(".zst"):
+        import zstandard
+
+        data = zstandard.ZstdDecompressor().stream_reader(io.BytesIO(data)).read()
+    with tarfile.open(fileobj=io.BytesIO(data), mode="r:*") as tf:
+        for member in tf:
+            if member.name in ("control", "./control"):
+                f = tf.extractfile(member)
+                assert f is not None
+                return f.read()
+    raise ValueError("no control file in control.tar")
+
+
+def scan_deb(path: str, filename: Optional[str] = None) -> ControlStanza:
+    """Generate the Packages stanza for a binary package.
+
+    Args:
+      path: Path to the .deb
+      filename: Value for the Filename field; defaults to path
+    """
+    control = None
+    with open(path, "rb") as raw:
+        f = _HashingReader(raw)
+        for name, size in _read_ar_members(f):
+            if name.startswith("control.tar"):
+                data = f.read(size)
+                try:
+                    control = _extract_control_tarball(name, data)
+                except ImportError:
+                    control = None
+            else:
+                f.read(size)
+            if size % 2:
+                f.read(1)
+            if control is not None:
+                break
+        f.exhaust()
+    if control is None:
+        # Compressed in a format we don't support natively
+        control = subprocess.run(
+            ["dpkg-deb", "-I", path, "control"], capture_output=True, check=True
+        ).stdout
+    stanza = parse_control(control, PACKAGES_FIELD_ORDER)
+    if "Package" not in stanza:
+        raise ValueError(f"no Package field in control file of {path}")
+    if "Filename" in stanza:
+        logging.warning(
+            "package %s (filename %s) has Filename field!", stanza["Package"], path
+        )
+    stanza["Filename"] = filename if filename is not None else path
+    for alg, h in f.hashes.items():
+        stanza["MD5sum" if alg == "md5" else alg] = h.hexdigest()
+    stanza["Size"] = str(f.size)
+    return stanza
+
+
+def scan_dsc(path: str, directory: Optional[str] = None) -> ControlStanza:
+    """Generate the Sources stanza for a source package.
+
+    Args:
+      path: Path to the .dsc
+      directory: Value for the Directory field; defaults to the directory
+        containing the .dsc
+    """
+    with open(path, "rb") as raw:
+        f = _HashingReader(raw)
+        data = f.read(-1)
+    stanza = parse_control(data, SOURCES_FIELD_ORDER)
+    if not stanza.get("Binary"):
+        raise ValueError(f"no binary packages specified in {path}")
+
+    # Mapping from filename to (size, {alg: checksum})
+    checksums: dict[str, tuple[str, dict[str, str]]] = {
+        os.path.basename(path): (
+            str(f.size),
+            {alg: h.hexdigest() for (alg, h) in f.hashes.items()},
+        )
+    }
+    for alg in CHECKSUMS:
+        field = "Files" if alg == "md5" else f"Checksums-{alg}"
+        for line in stanza.get(field, "").split("\n"):
+            line = line.lstrip(" ")
+            if not line:
+                continue
+            m = _CHECKSUM_LINE_RE.match(line)
+            if not m:
+                raise ValueError(f"invalid line in {alg} checksums string: {line}")
+            checksum, size, name = m.groups()
+            existing = checksums.setdefault(name, (size, {}))
+            if int(existing[0]) != int(size):
+                raise ValueError(f"conflicting file sizes for file {name}")
+            existing[1].setdefault(alg, checksum)
+
+    stanza["Package"] = stanza["Source"]
+    del stanza["Source"]
+    if directory is None:
+        directory = os.path.dirname(path).rstrip("/") or "."
+    stanza["Directory"] = directory
+    for alg in CHECKSUMS:
+        field = "Files" if alg == "md5" else f"Checksums-{alg}"
+        stanza[field] = "".join(
+            f"\n{sums[alg]} {size} {name}"
+            for (name, (size, sums)) in checksums.items()
+            if alg in sums
+        )
+    return stanza
+
+
+def _find(path: str, suffix: str) -> list[str]:
+    ret = []
+    for dirpath, _dirnames, filenames in os.walk(path, followlinks=True):
+        for name in filenames:
+            if name.endswith(suffix):
+                ret.append(os.path.join(dirpath, name))
+    return ret
+
+
+async def _scan_all(scan, paths: Iterable[str]) -> list[ControlStanza]:
+    """Scan files in parallel, logging and skipping those that can't be read."""
+    results = await asyncio.gather(
+        *[asyncio.to_thread(scan, p) for p in paths],
+        return_exceptions=True,
+    )
+    stanzas = []
+    for result in results:
+        if isinstance(
+            result,
+            (OSError, ValueError, tarfile.TarError, subprocess.CalledProcessError),
+        ):
+            logging.warning("%s", result)
+            continue
+        elif isinstance(result, BaseException):
+            raise result
+        stanzas.append(result)
+    return stanzas
+
+
+async def scan_packages(
+    path: str, arch: Optional[str] = None
+) -> AsyncIterator[ControlStanza]:
+    """Generate Packages stanzas for all binary packages in a directory.
+
+    Like dpkg-scanpackages, only the newest version of each package is
+    included.
+
+    Args:
+      path: Directory to scan
+      arch: If set, only include packages for this architecture (and
+        architecture-independent packages)
+    """
+    stanzas = await _scan_all(scan_deb, _find(path, ".deb"))
+    if arch:
+        stanzas = [s for s in stanzas if s.get("Architecture") in (arch, "all")]
+    packages: dict[str, ControlStanza] = {}
+    for stanza in stanzas:
+        existing = packages.get(stanza["Package"])
+        if existing is not None:
+            if version_compare(stanza["Version"], existing["Version"]) <= 0:
+                logging.warning(
+                    "package %s (filename %s) is repeat; ignored that one and "
+                    "using data from %s!",
+                    stanza["Package"],
+                    stanza["Filename"],
+                    existing["Filename"],
+                )
+                continue
+            logging.warning(
+                "package %s (filename %s) is repeat but newer version; used "
+                "that one and ignored data from %s!",
+                stanza["Package"],
+                stanza["Filename"],
+                existing["Filename"],
+            )
+        packages[stanza["Package"]] = stanza
+    for name in sorted(packages):
+        yield packages[name]
+
+
+async def scan_sources(path: str) -> AsyncIterator[ControlStanza]:
+    """Generate Sources stanzas for all source packages in a directory."""
+    stanzas = await _scan_all(scan_dsc, _find(path, ".dsc"))
+    stanzas.sort(key=lambda s: s["Package"] + s["Version"])
+    for stanza in stanzas:
+        yield stanza
+
+
+def run_directory(suite_name: str, package: str, run_id: str) -> str:
+    """Return the directory in the archive that holds the files of a run."""
+    return os.path.join(suite_name, "pkg", package, run_id)
+
+
+def package_index(
+    binary_stanzas: Iterable[ControlStanza],
+    source_stanzas: Iterable[ControlStanza],
+    directory: str,
+) -> dict[str, bytes]:
+    """Render the index stanzas for the packages built by a run.
+
+    Args:
+      binary_stanzas: Stanzas returned by scan_deb
+      source_stanzas: Stanzas returned by scan_dsc
+      directory: Directory in the archive that holds the files of the run
+    Returns:
+      dictionary mapping architecture (or "source") to the stanzas for that
+      architecture
+    """
+    ret = {"source": b""}
+    for stanza in sorted(binary_stanzas, key=lambda s: s["Package"]):
+        stanza["Filename"] = os.path.join(
+            directory, os.path.basename(stanza["Filename"])
+        )
+        arch = stanza["Architecture"]
+        ret[arch] = ret.get(arch, b"") + bytes(stanza) + b"\n"
+    for stanza in sorted(source_stanzas, key=lambda s: s["Package"] + s["Version"]):
+        stanza["Directory"] = directory
+        ret["source"] += bytes(stanza) + b"\n"
+    return ret
@@ -0,0 +1,150 @@
+#!/usr/bin/python3
+# Copyright (C) 2024 Jelmer Vernooij <jelmer@jelmer.uk>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+"""Persistent index of the package stanzas in a suite.
+
+Regenerating the Packages or Sources file for a suite requires the stanzas of
+every build in it. Rather than retrieving all of them on every publish, the
+stanzas are kept in a per-suite index file, and only the stanzas of builds
+that were added since the previous publish are retrieved.
+"""
+
+__all__ = [
+    "SuiteIndex",
+]
+
+import asyncio
+import logging
+import os
+import tempfile
+from collections.abc import Awaitable, Iterable
+from typing import Callable, Optional
+
+from aiohttp_openmetrics import Counter
+
+suite_index_stanza_count = Counter(
+    "suite_index_stanza_count",
+    "Number of build stanzas processed when updating suite indexes",
+    labelnames=("result",),
+)
+
+
+class SuiteIndex:
+    """Stanzas for the builds in a suite, keyed by run id.
+
+    The index is stored as a sequence of entries, each consisting of a
+    "<run id> <size>" header line followed by the stanza data.
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+
+    def load(self) -> dict[str, bytes]:
+        entries: dict[str, bytes] = {}
+        try:
+            f = open(self.path, "rb")
+        except FileNotFoundError:
+            return entries
+        with f:
+            while True:
+                header = f.readline()
+                if not header:
+                    break
+                try:
+                    key, size = header.rstrip(b"\n").rsplit(b" ", 1)
+                    data = f.read(int(size))
+                    if len(data) != int(size):
+                        raise ValueError("truncated entry")
+                except ValueError as e:
+                    logging.warning("Ignoring corrupt suite index %s: %s", self.path, e)
+                    return {}
+                entries[key.decode("utf-8")] = data
+        return entries
+
+    def save(self, entries: dict[str, bytes]) -> None:
+        dirname = os.path.dirname(self.path)
+        os.makedirs(dirname, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(
+            dir=dirname, prefix="." + os.path.basename(self.path)
+        )
+        try:
+            with os.fdopen(fd, "wb") as f:
+                for key, data in entries.items():
+                    f.write(b"%s %d\n" % (key.encode("utf-8"), len(data)))
+                    f.write(data)
+            os.replace(tmp_path, self.path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+    async def update(
+        self,
+        keys: Iterable[str],
+        fetch: Callable[[str], Awaitable[Optional[bytes]]],
+        *,
+        concurrency: int = 1,
+    ) -> list[bytes]:
+        """Bring the index up to date with a new set of builds.
+
+        Stanzas for builds that are already in the index are reused; builds
+        that are no longer present are dropped.
+
+        Args:
+          keys: Run ids of the builds in the suite, in the order in which
+            their stanzas should appear
+          fetch: Function to retrieve the stanzas for a build that is not in
+            the index yet; returns None if they are not available
+          concurrency: Number of builds to retrieve stanzas for in parallel
+        Returns:
+          list with the stanzas for each build, in order
+        """
+        old = await asyncio.to_thread(self.load)
+        keys = list(dict.fromkeys(keys))
+        sem = asyncio.Semaphore(max(concurrency, 1))
+
+        async def limited_fetch(key):
+            async with sem:
+                return await fetch(key)
+
+        missing = [key for key in keys if key not in old]
+        fetched = dict(
+            zip(missing, await asyncio.gather(*[limited_fetch(k) for k in missing]))
+        )
+        new: dict[str, bytes] = {}
+        added = 0
+        for key in keys:
+            data = old.get(key)
+            if data is None:
+                data = fetched[key]
+                if data is None:
+                    # Not recorded, so that it is retried next time
+                    continue
+                added += 1
+            new[key] = data
+        removed = len(old.keys() - new.keys())
+        suite_index_stanza_count.labels(result="reused").inc(len(new) - added)
+        suite_index_stanza_count.labels(result="added").inc(added)
+        suite_index_stanza_count.labels(result="removed").inc(removed)
+        if list(old) != list(new):
+            logging.debug(
+                "Updating suite index %s: %d added, %d removed",
+                self.path,
+                added,
+                removed,
+            )
+            await asyncio.to_thread(self.save, new)
+        return list(new.values())
@@ -0,0 +1,496 @@
+#!/usr/bin/python3
+# Copyright (C) 2024 Jelmer Vernooij <jelmer@jelmer.uk>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+"""Cache for diffs generated by the differ."""
+
+__all__ = [
+    "DiffCache",
+    "LocalDiffCache",
+    "GCSDiffCache",
+    "S3DiffCache",
+    "ReadThroughDiffCache",
+    "get_diff_cache",
+]
+
+import asyncio
+import gzip
+import logging
+import os
+import tempfile
+import time
+import zlib
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from typing import TYPE_CHECKING, Optional
+
+from aiohttp import ClientResponseError, ClientSession, ServerDisconnectedError
+from aiohttp_openmetrics import Counter, Gauge
+from yarl import URL
+
+if TYPE_CHECKING:
+    import gcloud.aio.storage
+
+diff_cache_hit_count = Counter(
+    "diff_cache_hit_count", "Number of diff cache hits", labelnames=("kind",)
+)
+diff_cache_miss_count = Counter(
+    "diff_cache_miss_count", "Number of diff cache misses", labelnames=("kind",)
+)
+diff_cache_eviction_count = Counter(
+    "diff_cache_eviction_count", "Number of evicted diff cache entries"
+)
+diff_cache_size = Gauge("diff_cache_size", "Size of the diff cache, in bytes")
+
+# Age after which temporary files are assumed to be left behind by an
+# interrupted write, rather than in use by another process sharing the cache
+STALE_TEMPORARY_FILE_AGE = 24 * 60 * 60
+
+
+class IdentityCodec:
+    suffix = ""
+    content_encoding = None
+
+    def compress(self, data: bytes) -> bytes:
+        return data
+
+    def decompress(self, data: bytes) -> bytes:
+        return data
+
+
+class GzipCodec:
+    suffix = ".gz"
+    content_encoding = "gzip"
+
+    def compress(self, data: bytes) -> bytes:
+        return gzip.compress(data, mtime=0)
+
+    def decompress(self, data: bytes) -> bytes:
+        try:
+            return gzip.decompress(data)
+        except zlib.error as e:
+            # A damaged deflate stream rather than a damaged gzip header
+            raise OSError(str(e)) from e
+
+
+class ZstdCodec:
+    suffix = ".zst"
+    content_encoding = "zstd"
+
+    def __init__(self) -> None:
+        import zstandard
+
+        self._zstandard = zstandard
+
+    def compress(self, data: bytes) -> bytes:
+        return self._zstandard.ZstdCompressor().compress(data)
+
+    def decompress(self, data: bytes) -> bytes:
+        try:
+            return self._zstandard.ZstdDecompressor().decompress(data)
+        except self._zstandard.ZstdError as e:
+            raise OSError(str(e)) from e
+
+
+CODECS = {"none": IdentityCodec, "gzip": GzipCodec, "zstd": ZstdCodec}
+
+
+class ServiceUnavailable(Exception):
+    """The remote cache is temporarily unavailable."""
+
+
+class DiffCache(ABC):
+    """Cache of diffs, keyed by kind ("debdiff", "diffoscope") and run ids."""
+
+    @abstractmethod
+    async def get(self, kind: str, old_id: str, new_id: str) -> Optional[bytes]:
+        raise NotImplementedError(self.get)
+
+    @abstractmethod
+    async def put(self, kind: str, old_id: str, new_id: str, data: bytes) -> None:
+        raise NotImplementedError(self.put)
+
+    @abstractmethod
+    async def contains(self, kind: str, old_id: str, new_id: str) -> bool:
+        raise NotImplementedError(self.contains)
+
+    async def get_local_file(
+        self, kind: str, old_id: str, new_id: str
+    ) -> Optional[tuple[str, Optional[str]]]:
+        """Find a local file with the contents of a cache entry.
+
+        This allows serving the entry without reading it into memory.
+
+        Returns:
+          tuple with path and content encoding (e.g. "gzip") of the file,
+          or None if the entry is not available as a local file
+        """
+        return None
+
+    async def __aexit__(self, exc_typ, exc_val, exc_tb):
+        return False
+
+    async def __aenter__(self):
+        return self
+
+
+class LocalDiffCache(DiffCache):
+    """Local, size-bounded cache of diffs.
+
+    Entries are stored compressed, one file per (kind, old_id, new_id), and
+    written atomically. When ``max_size`` (in bytes) is set, the least
+    recently used entries are evicted to stay below it.
+    """
+
+    def __init__(
+        self, path: str, *, max_size: Optional[int] = None, compression: str = "gzip"
+    ) -> None:
+        self.path = path
+        self.max_size = max_size
+        self.codec = CODECS[compression]()
+        # Maps paths of cache entries to their size, least recently used first
+        self._entries: OrderedDict[str, int] = OrderedDict()
+        self._size = 0
+        os.makedirs(self.path, exist_ok=True)
+        self._scan()
+        self._evict()
+
+    def _scan(self) -> None:
+        now = time.time()
+        entries = []
+        for kind in os.scandir(self.path):
+            if not kind.is_dir():
+                continue
+            for entry in os.scandir(kind.path):
+                try:
+                    st = entry.stat()
+                except FileNotFoundError:
+                    continue
+                if entry.name.startswith(".tmp"):
+                    if st.st_mtime < now - STALE_TEMPORARY_FILE_AGE:
+                        try:
+                            os.unlink(entry.path)
+                        except FileNotFoundError:
+                            pass
+                    continue
+                if not entry.is_file():
+                    continue
+                # Files that can't be looked up with the current codec (left
+                # behind by a different --cache-compression setting, or by
+                # the uncompressed layout used before) count towards the size
+                # too. They are never accessed, so eviction removes them
+                # before any entry that is in use.
+                entries.append((st.st_mtime, entry.path, st.st_size))
+        for _mtime, path, size in sorted(entries):
+            self._entries[path] = size
+            self._size += size
+        diff_cache_size.set(self._size)
+
+    def _path(self, kind: str, old_id: str, new_id: str) -> str:
+        if "/" in kind or "/" in old_id or "/" in new_id:
+            raise ValueError("invalid cache key")
+        return os.path.join(self.path, kind, f"{old_id}_{new_id}{self.codec.suffix}")
+
+    def _touch(self, path: str) -> None:
+        self._entries.move_to_end(path)
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            pass
+
+    def _forget(self, path: str) -> None:
+        size = self._entries.pop(path, None)
+        if size is not None:
+            self._size -= size
+            diff_cache_size.set(self._size)
+
+    def _evict(self) -> None:
+        if self.max_size is None:
+            return
+        while self._size > self.max_size and self._entries:
+            path, size = self._entries.popitem(last=False)
+            self._size -= size
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+            diff_cache_eviction_count.inc()
+        diff_cache_size.set(self._size)
+
+    async def contains(self, kind: str, old_id: str, new_id: str) -> bool:
+        return os.path.exists(self._path(kind, old_id, new_id))
+
+    async def get(self, kind: str, old_id: str, new_id: str) -> Optional[bytes]:
+        path = self._path(kind, old_id, new_id)
+
+        def read():
+            with open(path, "rb") as f:
+                return self.codec.decompress(f.read())
+
+        try:
+            data = await asyncio.to_thread(read)
+        except FileNotFoundError:
+            self._forget(path)
+            diff_cache_miss_count.labels(kind=kind).inc()
+            return None
+        except (OSError, EOFError) as e:
+            logging.warning("Removing corrupt diff cache entry %s: %s", path, e)
+            self._forget(path)
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+            diff_cache_miss_count.labels(kind=kind).inc()
+            return None
+        if path in self._entries:
+            self._touch(path)
+        diff_cache_hit_count.labels(kind=kind).inc()
+        return data
+
+    async def get_local_file(self, kind, old_id, new_id):
+        path = self._path(kind, old_id, new_id)
+        if not os.path.exists(path):
+            self._forget(path)
+            diff_cache_miss_count.labels(kind=kind).inc()
+            return None
+        if path in self._entries:
+            self._touch(path)
+        diff_cache_hit_count.labels(kind=kind).inc()
+        return path, self.codec.content_encoding
+
+    async def put(self, kind: str, old_id: str, new_id: str, data: bytes) -> None:
+        path = self._path(kind, old_id, new_id)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        def write():
+            compressed = self.codec.compress(data)
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".tmp")
+            try:
+                with os.fdopen(fd, "wb") as f:
+                    f.write(compressed)
+                os.replace(tmp_path, path)
+            except BaseException:
+                os.unlink(tmp_path)
+                raise
+            return len(compressed)
+
+        size = await asyncio.to_thread(write)
+        self._forget(path)
+        self._entries[path] = size
+        self._size += size
+        self._evict()
+
+
+class GCSDiffCache(DiffCache):
+    session: "gcloud.aio.storage.storage.Session"
+
+    def __init__(self, location, creds_path=None, trace_configs=None) -> None:
+        hostname = URL(location).host
+        if hostname is None:
+            raise ValueError(f"invalid location missing bucket name: {location}")
+        self.bucket_name = hostname
+        self.trace_configs = trace_configs
+        self.creds_path = creds_path
+
+    async def __aenter__(self):
+        from gcloud.aio.storage import Storage
+
+        self.session = ClientSession(trace_configs=self.trace_configs)  # type: ignore
+        self.storage = Storage(service_file=self.creds_path, session=self.session)
+        self.bucket = self.storage.get_bucket(self.bucket_name)
+        return self
+
+    async def __aexit__(self, exc_typ, exc_val, exc_tb):
+        await self.session.close()
+        return False
+
+    def _get_object_name(self, kind, old_id, new_id):
+        return f"{kind}/{old_id}_{new_id}.gz"
+
+    async def contains(self, kind, old_id, new_id):
+        object_name = self._get_object_name(kind, old_id, new_id)
+        return await self.bucket.blob_exists(object_name, session=self.session)
+
+    async def get(self, kind, old_id, new_id):
+        object_name = self._get_object_name(kind, old_id, new_id)
+        try:
+            data = await self.storage.download(
+                self.bucket_name, object_name, session=self.session
+            )
+        except ClientResponseError as e:
+            if e.status == 404:
+                diff_cache_miss_count.labels(kind=kind).inc()
+                return None
+            raise ServiceUnavailable() from e
+        except ServerDisconnectedError as e:
+            raise ServiceUnavailable() from e
+        diff_cache_hit_count.labels(kind=kind).inc()
+        return await asyncio.to_thread(gzip.decompress, data)
+
+    async def put(self, kind, old_id, new_id, data):
+        object_name = self._get_object_name(kind, old_id, new_id)
+        compressed_data = await asyncio.to_thread(gzip.compress, data, mtime=0)
+        try:
+            await self.storage.upload(self.bucket_name, object_name, compressed_data)
+        except ClientResponseError as e:
+            raise ServiceUnavailable() from e
+
+
+class S3DiffCache(DiffCache):
+    def __init__(
+        self, endpoint_url, bucket_name="debian-janitor", trace_configs=None
+    ) -> None:
+        self.base_url = endpoint_url + (f"/{bucket_name}/")
+        self.trace_configs = trace_configs
+        self.bucket_name = bucket_name
+        self.endpoint_url = endpoint_url
+
+    async def __aenter__(self):
+        import boto3
+
+        self.session = ClientSession(trace_configs=self.trace_configs)
+        self.s3 = boto3.resource("s3", endpoint_url=self.endpoint_url)
+        self.s3_bucket = self.s3.Bucket(self.bucket_name)
+        return self
+
+    async def __aexit__(self, exc_typ, exc_val, exc_tb):
+        await self.session.close()
+        return False
+
+    def _get_key(self, kind, old_id, new_id):
+        return f"diffs/{kind}/{old_id}_{new_id}.gz"
+
+    async def contains(self, kind, old_id, new_id):
+        url = self.base_url + self._get_key(kind, old_id, new_id)
+        async with self.session.head(url) as resp:
+            if resp.status == 200:
+                return True
+            if resp.status in (403, 404):
+                return False
+            raise ServiceUnavailable()
+
+    async def get(self, kind, old_id, new_id):
+        url = self.base_url + self._get_key(kind, old_id, new_id)
+        async with self.session.get(url) as resp:
+            if resp.status in (403, 404):
+                diff_cache_miss_count.labels(kind=kind).inc()
+                return None
+            if resp.status != 200:
+                raise ServiceUnavailable()
+            data = await resp.read()
+        diff_cache_hit_count.labels(kind=kind).inc()
+        return await asyncio.to_thread(gzip.decompress, data)
+
+    async def put(self, kind, old_id, new_id, data):
+        compressed_data = await asyncio.to_thread(gzip.compress, data, mtime=0)
+        await asyncio.to_thread(
+            self.s3_bucket.put_object,
+            Key=self._get_key(kind, old_id, new_id),
+            Body=compressed_data,
+        )
+
+
+class ReadThroughDiffCache(DiffCache):
+    """Local cache tier in front of a shared cache.
+
+    Entries are looked up in the local cache first and copied there when
+    found in the shared cache. New entries are written to both.
+    """
+
+    def __init__(self, local: DiffCache, shared: DiffCache) -> None:
+        self.local = local
+        self.shared = shared
+
+    async def __aenter__(self):
+        await self.local.__aenter__()
+        await self.shared.__aenter__()
+        return self
+
+    async def __aexit__(self, exc_typ, exc_val, exc_tb):
+        await self.shared.__aexit__(exc_typ, exc_val, exc_tb)
+        await self.local.__aexit__(exc_typ, exc_val, exc_tb)
+        return False
+
+    async def contains(self, kind, old_id, new_id):
+        return await self.local.contains(
+            kind, old_id, new_id
+        ) or await self.shared.contains(kind, old_id, new_id)
+
+    async def get(self, kind, old_id, new_id):
+        data = await self.local.get(kind, old_id, new_id)
+        if data is not None:
+            return data
+        try:
+            data = await self.shared.get(kind, old_id, new_id)
+        except ServiceUnavailable as e:
+            logging.warning("Shared diff cache unavailable: %r", e)
+            return None
+        if data is not None:
+            await self.local.put(kind, old_id, new_id, data)
+        return data
+
+    async def get_local_file(self, kind, old_id, new_id):
+        ret = await self.local.get_local_file(kind, old_id, new_id)
+        if ret is not None:
+            return ret
+        # Copy the entry from the shared cache, if it's there
+        if await self.get(kind, old_id, new_id) is None:
+            return None
+        return await self.local.get_local_file(kind, old_id, new_id)
+
+    async def put(self, kind, old_id, new_id, data):
+        await self.local.put(kind, old_id, new_id, data)
+        try:
+            await self.shared.put(kind, old_id, new_id, data)
+        except ServiceUnavailable as e:
+            logging.warning("Unable to store diff in shared cache: %r", e)
+
+
+def get_diff_cache(
+    location: Optional[str] = None,
+    *,
+    local_path: Optional[str] = None,
+    max_size: Optional[int] = None,
+    compression: str = "gzip",
+    trace_configs=None,
+) -> Optional[DiffCache]:
+    """Create a diff cache.
+
+    Args:
+      location: Location of a shared cache; a gs:// URL, an S3 endpoint URL
+        or a local directory
+      local_path: Path to a local cache; if location is also specified,
+        this is used as a read-through tier in front of it
+      max_size: Maximum size of the local cache, in bytes
+      compression: Compression to use for the local cache
+    """
+    local: Optional[DiffCache]
+    if local_path is not None:
+        local = LocalDiffCache(local_path, max_size=max_size, compression=compression)
+    else:
+        local = None
+    shared: Optional[DiffCache]
+    if location is None:
+        shared = None
+    elif location.startswith("gs://"):
+        shared = GCSDiffCache(location, trace_configs=trace_configs)
+    elif location.startswith("http:") or location.startswith("https:"):
+        shared = S3DiffCache(location, trace_configs=trace_configs)
+    else:
+        shared = LocalDiffCache(location, compression=compression)
+    if local is not None and shared is not None:
+        return ReadThroughDiffCache(local, shared)
+    return local or shared
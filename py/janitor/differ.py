@@ -16,28 +16,34 @@
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
 
 import asyncio
+import hashlib
 import json
 import logging
+import multiprocessing
 import os
+import shutil
 import sys
 import traceback
 import warnings
-from contextlib import ExitStack
+from collections.abc import Awaitable
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import AsyncExitStack
 from functools import partial
-from tempfile import TemporaryDirectory
+from tempfile import TemporaryDirectory, gettempdir
 from typing import Callable, Optional
 
+import aioredlock
 import aiozipkin
 import mimeparse
 import uvloop
 from aiohttp import web
 from aiohttp.web_middlewares import normalize_path_middleware
-from aiohttp_openmetrics import setup_metrics
+from aiohttp_openmetrics import Gauge, setup_metrics
 from aiojobs.aiohttp import setup as setup_aiojobs
-from aiojobs.aiohttp import spawn
 from redis.asyncio import Redis
 
 from . import set_user_agent, state
+from .artifact_cache import ArtifactCache
 from .artifacts import ArtifactManager, ArtifactsMissing, get_artifact_manager
 from .config import read_config
 from .debian.debdiff import (
@@ -47,15 +53,45 @@ from .debian.debdiff import (
     run_debdiff,
 )
 from .debian.debdiff import filter_boring as filter_debdiff_boring
+from .diff_cache import DiffCache, get_diff_cache
 from .diffoscope import DiffoscopeError, format_diffoscope, run_diffoscope
 from .diffoscope import filter_boring as filter_diffoscope_boring
 from .diffoscope import filter_irrelevant as filter_diffoscope_irrelevant
+from .precache_queue import (
+    PRIORITY_BACKFILL,
+    PRIORITY_INTERACTIVE,
+    PRIORITY_RUNNER,
+    MemoryPrecacheQueue,
+    PrecacheScheduler,
+    RedisPrecacheQueue,
+)
+from .singleflight import SingleFlight
 
 # Common prefix for temporary directories
 TMP_PREFIX = "janitor-differ"
 PRECACHE_RETRIEVE_TIMEOUT = 300
+SERVE_CHUNK_SIZE = 256 * 1024
+# Names used in ETags for debdiff output, by content type
+RENDERED_DEBDIFF_FORMATS = {
+    "text/plain": "txt",
+    "text/markdown": "md",
+    "text/html": "html",
+}
+# Names used in the diff cache for rendered diffoscope output, by content type
+RENDERED_DIFFOSCOPE_FORMATS = {
+    "text/html": "html",
+    "text/markdown": "md",
+    "text/plain": "txt",
+    "application/json": "json",
+}
 routes = web.RouteTableDef()
 
+precache_pipeline_queue_depth = Gauge(
+    "precache_pipeline_queue_depth",
+    "Number of jobs waiting for a precache pipeline stage",
+    labelnames=("stage",),
+)
+
 
 def find_binaries(path: str) -> list[tuple[str, str]]:
     ret = []
@@ -98,120 +134,371 @@ class DiffCommandMemoryError(Exception):
     """Memory error while running diff command."""
 
 
+async def retrieve_binaries(
+    artifact_manager: ArtifactManager,
+    es: AsyncExitStack,
+    old_id: str,
+    new_id: str,
+    *,
+    artifact_cache: Optional[ArtifactCache] = None,
+    timeout: Optional[float] = None,
+) -> tuple[list[tuple[str, str]], list[tuple[str, str]]]:
+    """Retrieve the binaries for a pair of runs into temporary directories.
+
+    Args:
+      artifact_cache: Optional cache to retrieve artifacts through; the
+        artifacts are kept checked out until es is closed
+      timeout: Timeout for retrieving the artifacts, in seconds
+    Raises:
+      ArtifactsMissing: if there are no binaries for either run
+      ArtifactRetrievalTimeout: if retrieving the artifacts timed out
+    """
+    old_dir = es.enter_context(TemporaryDirectory(prefix=TMP_PREFIX))
+    new_dir = es.enter_context(TemporaryDirectory(prefix=TMP_PREFIX))
+
+    if artifact_cache is not None:
+        retrieve = asyncio.gather(
+            es.enter_async_context(artifact_cache.checkout(old_id, old_dir)),
+            es.enter_async_context(artifact_cache.checkout(new_id, new_dir)),
+        )
+    else:
+        retrieve = asyncio.gather(
+            artifact_manager.retrieve_artifacts(old_id, old_dir, filter_fn=is_binary),
+            artifact_manager.retrieve_artifacts(new_id, new_dir, filter_fn=is_binary),
+        )
+    if timeout is not None:
+        try:
+            await asyncio.wait_for(retrieve, timeout)
+        except asyncio.TimeoutError as e:
+            raise ArtifactRetrievalTimeout(
+                f"Timeout retrieving artifacts for {old_id}/{new_id}"
+            ) from e
+    else:
+        await retrieve
+
+    old_binaries = find_binaries(old_dir)
+    if not old_binaries:
+        raise ArtifactsMissing(old_id)
+
+    new_binaries = find_binaries(new_dir)
+    if not new_binaries:
+        raise ArtifactsMissing(new_id)
+
+    return old_binaries, new_binaries
+
+
+async def generate_debdiff(old_binaries, new_binaries) -> bytes:
+    try:
+        return await run_debdiff(
+            [p for (n, p) in old_binaries], [p for (n, p) in new_binaries]
+        )
+    except DebdiffError as e:
+        raise DiffCommandError("debdiff", e.args[0]) from e
+    except asyncio.TimeoutError as e:
+        raise DiffCommandTimeout("debdiff", None) from e
+
+
+async def generate_diffoscope(
+    old_binaries,
+    new_binaries,
+    *,
+    task_memory_limit: Optional[int] = None,
+    task_timeout: Optional[int] = None,
+    diffoscope_command: Optional[str] = None,
+) -> bytes:
+    try:
+        diffoscope_diff = await run_diffoscope(
+            old_binaries,
+            new_binaries,
+            preexec_fn=lambda: _set_limits(task_memory_limit),
+            timeout=task_timeout,
+            diffoscope_command=diffoscope_command,
+        )
+    except MemoryError as e:
+        raise DiffCommandMemoryError("diffoscope", task_memory_limit) from e
+    except asyncio.TimeoutError as e:
+        raise DiffCommandTimeout("diffoscope", task_timeout) from e
+    except DiffoscopeError as e:
+        raise DiffCommandError("diffoscope", e.args[0]) from e
+    return json.dumps(diffoscope_diff).encode("utf-8")
+
+
+def filtered_kind(kind: str, old_version: str, new_version: str) -> str:
+    """Return the diff cache kind for the filter_boring variant of a diff.
+
+    The result of filtering depends on the versions of both runs, so they are
+    part of the key.
+    """
+    digest = hashlib.sha256(f"{old_version}\0{new_version}".encode())
+    return f"{kind}-filtered-{digest.hexdigest()[:12]}"
+
+
+def filter_debdiff(debdiff: bytes, old_run, new_run) -> bytes:
+    return filter_debdiff_boring(
+        debdiff.decode(),
+        str(old_run["build_version"]),
+        str(new_run["build_version"]),
+    ).encode()
+
+
+def filter_diffoscope(diffoscope_diff: bytes, old_run, new_run) -> bytes:
+    diff = json.loads(diffoscope_diff)
+    filter_diffoscope_boring(
+        diff,
+        str(old_run["build_version"]),
+        str(new_run["build_version"]),
+        old_run["campaign"],
+        new_run["campaign"],
+    )
+    return json.dumps(diff).encode("utf-8")
+
+
+async def cached_diff(
+    diff_cache: Optional[DiffCache],
+    kind: str,
+    old_id: str,
+    new_id: str,
+    generate: Callable[[], Awaitable[bytes]],
+) -> bytes:
+    """Look up a diff in the cache, generating and storing it if it's missing.
+
+    This is run under single-flight, so the cache is checked again: another
+    request or differ instance may have just generated the same diff.
+    """
+    if diff_cache is not None:
+        data = await diff_cache.get(kind, old_id, new_id)
+        if data is not None:
+            return data
+    data = await generate()
+    if diff_cache is not None:
+        await diff_cache.put(kind, old_id, new_id, data)
+    return data
+
+
+def _accepts_encoding(request: web.Request, encoding: str) -> bool:
+    for entry in request.headers.get("Accept-Encoding", "").split(","):
+        name, _, params = entry.partition(";")
+        if name.strip().lower() != encoding:
+            continue
+        return params.replace(" ", "") not in ("q=0", "q=0.0", "q=0.00", "q=0.000")
+    return False
+
+
+def _not_modified(request: web.Request, etag: str) -> bool:
+    if request.if_none_match is None:
+        return False
+    return any(e.value in (etag, "*") for e in request.if_none_match)
+
+
+async def serve_diff(
+    request: web.Request,
+    etag: str,
+    content_type: str,
+    *,
+    body: Optional[bytes] = None,
+    path: Optional[str] = None,
+    content_encoding: Optional[str] = None,
+) -> web.StreamResponse:
+    """Serve a diff, with support for conditional and range requests.
+
+    The diff between two runs never changes, so strong ETags can be derived
+    from the run ids and the variant of the diff that is served.
+
+    Args:
+      etag: ETag for the diff variant (without encoding)
+      content_type: Content type of the diff
+      body: Contents of the diff
+      path: Path of a file with the contents of the diff (if body is None)
+      content_encoding: Content encoding of the file at path
+    """
+    if content_encoding:
+        etag += "-" + content_encoding
+    headers = {
+        "ETag": f'"{etag}"',
+        "Accept-Ranges": "bytes",
+        "Vary": "Accept, Accept-Encoding",
+    }
+    if _not_modified(request, etag):
+        return web.Response(status=304, headers=headers)
+    headers["Content-Type"] = f"{content_type}; charset=utf-8"
+    if content_encoding:
+        headers["Content-Encoding"] = content_encoding
+
+    if body is not None:
+        size = len(body)
+    else:
+        assert path is not None
+        size = os.stat(path).st_size
+
+    start, end = 0, size
+    status = 200
+    if_range = request.headers.get("If-Range")
+    if "Range" in request.headers and if_range in (None, headers["ETag"]):
+        try:
+            rng = request.http_range
+        except ValueError:
+            # Invalid range headers are ignored
+            rng = slice(None, None)
+        if rng.start is not None:
+            if rng.start < 0:
+                start = max(0, size + rng.start)
+            else:
+                start = rng.start
+                if rng.stop is not None:
+                    end = min(rng.stop, size)
+            if start >= end:
+                raise web.HTTPRequestRangeNotSatisfiable(
+                    headers={"Content-Range": f"bytes */{size}"}
+                )
+            status = 206
+            headers["Content-Range"] = f"bytes {start}-{end - 1}/{size}"
+
+    if body is not None:
+        return web.Response(status=status, body=body[start:end], headers=headers)
+
+    response = web.StreamResponse(status=status, headers=headers)
+    response.content_length = end - start
+    await response.prepare(request)
+    if request.method != "HEAD":
+        with open(path, "rb") as f:
+            f.seek(start)
+            remaining = end - start
+            while remaining > 0:
+                chunk = await asyncio.to_thread(
+                    f.read, min(remaining, SERVE_CHUNK_SIZE)
+                )
+                if not chunk:
+                    break
+                await response.write(chunk)
+                remaining -= len(chunk)
+    await response.write_eof()
+    return response
+
+
 @routes.get("/debdiff/{old_id}/{new_id}", name="debdiff")
 async def handle_debdiff(request):
     span = aiozipkin.request_span(request)
     old_id = request.match_info["old_id"]
     new_id = request.match_info["new_id"]
 
+    content_type = mimeparse.best_match(
+        ["text/x-diff", "text/plain", "text/markdown", "text/html"],
+        request.headers.get("Accept", "*/*"),
+    )
+    if content_type is None:
+        raise web.HTTPNotAcceptable(
+            text="Acceptable content types: text/html, text/plain, text/markdown"
+        )
+    if content_type == "text/x-diff":
+        content_type = "text/plain"
+
     old_run, new_run = await get_run_pair(request.app["pool"], old_id, new_id)
 
-    if request.app["debdiff_cache_path"]:
-        cache_path = request.app["debdiff_cache_path"](old_run["id"], new_run["id"])
-    else:
-        cache_path = None
-    if cache_path:
-        try:
-            with open(cache_path, "rb") as f:
-                debdiff = f.read()
-        except FileNotFoundError:
-            debdiff = None
+    filter_boring = "filter_boring" in request.query
+    variant = "debdiff-" + RENDERED_DEBDIFF_FORMATS[content_type]
+    if filter_boring:
+        variant += "-filtered"
+    etag = "{}-{}-{}".format(variant, old_run["id"], new_run["id"])
+    if _not_modified(request, etag):
+        return await serve_diff(request, etag, content_type)
+
+    diff_cache = request.app["diff_cache"]
+    if filter_boring:
+        cache_kind = filtered_kind(
+            "debdiff", str(old_run["build_version"]), str(new_run["build_version"])
+        )
     else:
-        debdiff = None
+        cache_kind = "debdiff"
+    if diff_cache is not None and content_type == "text/plain":
+        # Serve the debdiff straight from the cache
+        local_file = await diff_cache.get_local_file(
+            cache_kind, old_run["id"], new_run["id"]
+        )
+        if local_file is not None:
+            path, content_encoding = local_file
+            if content_encoding is None or _accepts_encoding(request, content_encoding):
+                return await serve_diff(
+                    request,
+                    etag,
+                    content_type,
+                    path=path,
+                    content_encoding=content_encoding,
+                )
+
+    debdiff = None
+    filtered = False
+    if diff_cache is not None:
+        if filter_boring:
+            debdiff = await diff_cache.get(cache_kind, old_run["id"], new_run["id"])
+            filtered = debdiff is not None
+        if debdiff is None:
+            debdiff = await diff_cache.get("debdiff", old_run["id"], new_run["id"])
 
     if debdiff is None:
-        logging.info(
-            "Generating debdiff between %s (%s/%s/%s) and %s (%s/%s/%s)",
-            old_run["id"],
-            old_run["build_source"],
-            old_run["build_version"],
-            old_run["campaign"],
-            new_run["id"],
-            new_run["build_source"],
-            new_run["build_version"],
-            new_run["campaign"],
-        )
-        with ExitStack() as es:
-            old_dir = es.enter_context(TemporaryDirectory(prefix=TMP_PREFIX))
-            new_dir = es.enter_context(TemporaryDirectory(prefix=TMP_PREFIX))
 
-            try:
+        async def generate():
+            logging.info(
+                "Generating debdiff between %s (%s/%s/%s) and %s (%s/%s/%s)",
+                old_run["id"],
+                old_run["build_source"],
+                old_run["build_version"],
+                old_run["campaign"],
+                new_run["id"],
+                new_run["build_source"],
+                new_run["build_version"],
+                new_run["campaign"],
+            )
+            async with AsyncExitStack() as es:
                 with span.new_child("fetch-artifacts"):
-                    await asyncio.gather(
-                        request.app["artifact_manager"].retrieve_artifacts(
-                            old_run["id"], old_dir, filter_fn=is_binary
-                        ),
-                        request.app["artifact_manager"].retrieve_artifacts(
-                            new_run["id"], new_dir, filter_fn=is_binary
-                        ),
+                    old_binaries, new_binaries = await retrieve_binaries(
+                        request.app["artifact_manager"],
+                        es,
+                        old_run["id"],
+                        new_run["id"],
+                        artifact_cache=request.app["artifact_cache"],
                     )
-            except ArtifactsMissing as e:
-                raise web.HTTPNotFound(
-                    text=f"No artifacts for run id: {e!r}",
-                    headers={"unavailable_run_id": e.args[0]},
-                ) from e
-            except asyncio.TimeoutError as e:
-                raise web.HTTPGatewayTimeout(text="Timeout retrieving artifacts") from e
-
-            old_binaries = find_binaries(old_dir)
-            if not old_binaries:
-                raise web.HTTPNotFound(
-                    text="No artifacts for run id: {}".format(old_run["id"]),
-                    headers={"unavailable_run_id": old_run["id"]},
-                )
-
-            new_binaries = find_binaries(new_dir)
-            if not new_binaries:
-                raise web.HTTPNotFound(
-                    text="No artifacts for run id: {}".format(new_run["id"]),
-                    headers={"unavailable_run_id": new_run["id"]},
-                )
-
-            try:
                 with span.new_child("run-debdiff"):
-                    debdiff = await run_debdiff(
-                        [p for (n, p) in old_binaries], [p for (n, p) in new_binaries]
-                    )
-            except DebdiffError as e:
-                return web.Response(status=400, text=e.args[0])
-            except asyncio.TimeoutError as e:
-                raise web.HTTPGatewayTimeout(text="Timeout running debdiff") from e
-        assert debdiff
+                    return await generate_debdiff(old_binaries, new_binaries)
 
-        if cache_path:
-            with open(cache_path, "wb") as f:
-                f.write(debdiff)
+        try:
+            debdiff = await request.app["single_flight"].do(
+                ("debdiff", old_run["id"], new_run["id"]),
+                partial(
+                    cached_diff,
+                    diff_cache,
+                    "debdiff",
+                    old_run["id"],
+                    new_run["id"],
+                    generate,
+                ),
+            )
+        except ArtifactsMissing as e:
+            raise web.HTTPNotFound(
+                text=f"No artifacts for run id: {e!r}",
+                headers={"unavailable_run_id": e.args[0]},
+            ) from e
+        except asyncio.TimeoutError as e:
+            raise web.HTTPGatewayTimeout(text="Timeout retrieving artifacts") from e
+        except DiffCommandTimeout as e:
+            raise web.HTTPGatewayTimeout(text="Timeout running debdiff") from e
+        except DiffCommandError as e:
+            return web.Response(status=400, text=e.reason)
 
     assert debdiff is not None
 
-    if "filter_boring" in request.query:
-        debdiff = filter_debdiff_boring(
-            debdiff.decode(),
-            str(old_run["build_version"]),
-            str(new_run["build_version"]),
-        ).encode()
-
-    assert debdiff is not None
+    if filter_boring and not filtered:
+        debdiff = filter_debdiff(debdiff, old_run, new_run)
+        if diff_cache is not None:
+            await diff_cache.put(cache_kind, old_run["id"], new_run["id"], debdiff)
 
-    content_type = mimeparse.best_match(
-        ["text/x-diff", "text/plain", "text/markdown", "text/html"],
-        request.headers.get("Accept", "*/*"),
-    )
-    if content_type in ("text/x-diff", "text/plain"):
-        return web.Response(body=debdiff, content_type="text/plain")
     if content_type == "text/markdown":
-        return web.Response(
-            text=markdownify_debdiff(debdiff.decode("utf-8", "replace")),
-            content_type="text/markdown",
+        debdiff = markdownify_debdiff(debdiff.decode("utf-8", "replace")).encode(
+            "utf-8"
         )
-    if content_type == "text/html":
-        return web.Response(
-            text=htmlize_debdiff(debdiff.decode("utf-8", "replace")),
-            content_type="text/html",
-        )
-    raise web.HTTPNotAcceptable(
-        text="Acceptable content types: text/html, text/plain, text/markdown"
-    )
+    elif content_type == "text/html":
+        debdiff = htmlize_debdiff(debdiff.decode("utf-8", "replace")).encode("utf-8")
+
+    return await serve_diff(request, etag, content_type, body=debdiff)
 
 
 async def get_run(conn, run_id: str):
@@ -270,6 +557,18 @@ def _set_limits(limit_mb):
     resource.setrlimit(resource.RLIMIT_AS, (int(0.8 * limit), limit))
 
 
+def rendered_diffoscope_kind(
+    content_type: str, filter_boring: bool, css_url: Optional[str] = None
+) -> str:
+    """Return the diff cache kind for a rendered diffoscope diff."""
+    kind = "diffoscope-" + RENDERED_DIFFOSCOPE_FORMATS[content_type]
+    if filter_boring:
+        kind += "-filtered"
+    if css_url and content_type == "text/html":
+        kind += "-" + hashlib.sha256(css_url.encode("utf-8")).hexdigest()[:12]
+    return kind
+
+
 @routes.get("/diffoscope/{old_id}/{new_id}", name="diffoscope")
 async def handle_diffoscope(request):
     span = aiozipkin.request_span(request)
@@ -291,94 +590,130 @@ async def handle_diffoscope(request):
 
     old_run, new_run = await get_run_pair(request.app["pool"], old_id, new_id)
 
-    if request.app["diffoscope_cache_path"]:
-        cache_path = request.app["diffoscope_cache_path"](old_run["id"], new_run["id"])
-    else:
-        cache_path = None
+    diff_cache = request.app["diff_cache"]
+    render_kind = rendered_diffoscope_kind(
+        content_type, "filter_boring" in request.query, request.query.get("css_url")
+    )
+    etag = "{}-{}-{}".format(render_kind, old_run["id"], new_run["id"])
+    if _not_modified(request, etag):
+        return await serve_diff(request, etag, content_type)
 
-    if cache_path:
-        try:
-            with open(cache_path, "rb") as f:
-                diffoscope_diff = json.load(f)
-        except FileNotFoundError:
-            diffoscope_diff = None
+    if diff_cache is not None:
+        local_file = await diff_cache.get_local_file(
+            render_kind, old_run["id"], new_run["id"]
+        )
+        if local_file is not None:
+            path, content_encoding = local_file
+            if content_encoding is None or _accepts_encoding(request, content_encoding):
+                return await serve_diff(
+                    request,
+                    etag,
+                    content_type,
+                    path=path,
+                    content_encoding=content_encoding,
+                )
+
+    filter_boring = "filter_boring" in request.query
+    if filter_boring:
+        cache_kind = filtered_kind(
+            "diffoscope", str(old_run["build_version"]), str(new_run["build_version"])
+        )
+    else:
+        cache_kind = "diffoscope"
+    cached = None
+    filtered = False
+    if diff_cache is not None:
+        if filter_boring:
+            cached = await diff_cache.get(cache_kind, old_run["id"], new_run["id"])
+            filtered = cached is not None
+        if cached is None:
+            cached = await diff_cache.get("diffoscope", old_run["id"], new_run["id"])
+
+    if cached is not None:
+        diffoscope_diff = json.loads(cached)
     else:
         diffoscope_diff = None
 
     if diffoscope_diff is None:
-        logging.info(
-            "Generating diffoscope between %s (%s/%s/%s) and %s (%s/%s/%s)",
-            old_run["id"],
-            old_run["build_source"],
-            old_run["build_version"],
-            old_run["campaign"],
-            new_run["id"],
-            new_run["build_source"],
-            new_run["build_version"],
-            new_run["campaign"],
-            extra={"old_run_id": old_run["id"], "new_run_id": new_run["id"]},
-        )
-        with ExitStack() as es:
-            old_dir = es.enter_context(TemporaryDirectory(prefix=TMP_PREFIX))
-            new_dir = es.enter_context(TemporaryDirectory(prefix=TMP_PREFIX))
 
-            try:
+        async def generate():
+            logging.info(
+                "Generating diffoscope between %s (%s/%s/%s) and %s (%s/%s/%s)",
+                old_run["id"],
+                old_run["build_source"],
+                old_run["build_version"],
+                old_run["campaign"],
+                new_run["id"],
+                new_run["build_source"],
+                new_run["build_version"],
+                new_run["campaign"],
+                extra={"old_run_id": old_run["id"], "new_run_id": new_run["id"]},
+            )
+            async with AsyncExitStack() as es:
                 with span.new_child("fetch-artifacts"):
-                    await asyncio.gather(
-                        request.app["artifact_manager"].retrieve_artifacts(
-                            old_run["id"], old_dir, filter_fn=is_binary
-                        ),
-                        request.app["artifact_manager"].retrieve_artifacts(
-                            new_run["id"], new_dir, filter_fn=is_binary
-                        ),
+                    old_binaries, new_binaries = await retrieve_binaries(
+                        request.app["artifact_manager"],
+                        es,
+                        old_run["id"],
+                        new_run["id"],
+                        artifact_cache=request.app["artifact_cache"],
                     )
-            except ArtifactsMissing as e:
-                raise web.HTTPNotFound(
-                    text=f"No artifacts for run id: {e!r}",
-                    headers={"unavailable_run_id": e.args[0]},
-                ) from e
-            except asyncio.TimeoutError as e:
-                raise web.HTTPGatewayTimeout(text="Timeout retrieving artifacts") from e
-
-            old_binaries = find_binaries(old_dir)
-            if not old_binaries:
-                raise web.HTTPNotFound(
-                    text="No artifacts for run id: {}".format(old_run["id"]),
-                    headers={"unavailable_run_id": old_run["id"]},
-                )
-
-            new_binaries = find_binaries(new_dir)
-            if not new_binaries:
-                raise web.HTTPNotFound(
-                    text="No artifacts for run id: {}".format(new_run["id"]),
-                    headers={"unavailable_run_id": new_run["id"]},
-                )
-
-            try:
                 with span.new_child("run-diffoscope"):
-                    diffoscope_diff = await run_diffoscope(
+                    return await generate_diffoscope(
                         old_binaries,
                         new_binaries,
-                        timeout=request.app["task_timeout"],
-                        preexec_fn=lambda: _set_limits(
-                            request.app["task_memory_limit"]
-                        ),
+                        task_memory_limit=request.app["task_memory_limit"],
+                        task_timeout=request.app["task_timeout"],
                         diffoscope_command=request.app["diffoscope_command"],
                     )
-            except MemoryError as e:
-                raise web.HTTPServiceUnavailable(
-                    text="diffoscope used too much memory"
-                ) from e
-            except asyncio.TimeoutError as e:
-                raise web.HTTPGatewayTimeout(text="diffoscope timed out") from e
-            except DiffoscopeError as e:
-                raise web.HTTPInternalServerError(
-                    reason="diffoscope error", text=e.args[0]
-                ) from e
-
-        if cache_path is not None:
-            with open(cache_path, "w") as f:
-                json.dump(diffoscope_diff, f)
+
+        try:
+            diffoscope_diff = json.loads(
+                await request.app["single_flight"].do(
+                    ("diffoscope", old_run["id"], new_run["id"]),
+                    partial(
+                        cached_diff,
+                        diff_cache,
+                        "diffoscope",
+                        old_run["id"],
+                        new_run["id"],
+                        generate,
+                    ),
+                )
+            )
+        except ArtifactsMissing as e:
+            raise web.HTTPNotFound(
+                text=f"No artifacts for run id: {e!r}",
+                headers={"unavailable_run_id": e.args[0]},
+            ) from e
+        except asyncio.TimeoutError as e:
+            raise web.HTTPGatewayTimeout(text="Timeout retrieving artifacts") from e
+        except DiffCommandMemoryError as e:
+            raise web.HTTPServiceUnavailable(
+                text="diffoscope used too much memory"
+            ) from e
+        except DiffCommandTimeout as e:
+            raise web.HTTPGatewayTimeout(text="diffoscope timed out") from e
+        except DiffCommandError as e:
+            raise web.HTTPInternalServerError(
+                reason="diffoscope error", text=e.reason
+            ) from e
+
+    if filter_boring and not filtered:
+        filter_diffoscope_boring(
+            diffoscope_diff,
+            str(old_run["build_version"]),
+            str(new_run["build_version"]),
+            old_run["campaign"],
+            new_run["campaign"],
+        )
+        if diff_cache is not None:
+            await diff_cache.put(
+                cache_kind,
+                old_run["id"],
+                new_run["id"],
+                json.dumps(diffoscope_diff).encode("utf-8"),
+            )
 
     diffoscope_diff["source1"] = "{} version {} ({})".format(
         old_run["build_source"],
@@ -397,122 +732,349 @@ async def handle_diffoscope(request):
         new_run["campaign"], new_run["build_source"]
     )
 
-    if "filter_boring" in request.query:
-        filter_diffoscope_boring(
-            diffoscope_diff,
-            str(old_run["build_version"]),
-            str(new_run["build_version"]),
-            old_run["campaign"],
-            new_run["campaign"],
-        )
+    if filter_boring:
         title += " (filtered)"
 
-    with span.new_child("format-diffoscope"):
-        debdiff = await format_diffoscope(
-            diffoscope_diff,
-            content_type,
-            title=title,
-            css_url=request.query.get("css_url"),
-        )
-
-    return web.Response(text=debdiff, content_type=content_type)
+    async def render():
+        with span.new_child("format-diffoscope"):
+            text = await format_diffoscope(
+                diffoscope_diff,
+                content_type,
+                title=title,
+                css_url=request.query.get("css_url"),
+                executor=request.app["render_executor"],
+            )
+        return text.encode("utf-8")
 
+    rendered = await request.app["single_flight"].do(
+        (render_kind, old_run["id"], new_run["id"]),
+        partial(
+            cached_diff, diff_cache, render_kind, old_run["id"], new_run["id"], render
+        ),
+    )
 
-async def precache(
-    artifact_manager: ArtifactManager,
+    return await serve_diff(request, etag, content_type, body=rendered)
+
+
+def _filter_versions(old_run, new_run) -> Optional[tuple[str, str]]:
+    if (
+        old_run is not None
+        and new_run is not None
+        and old_run["build_version"]
+        and new_run["build_version"]
+    ):
+        return (str(old_run["build_version"]), str(new_run["build_version"]))
+    return None
+
+
+PRECACHE_KINDS = {
+    "debdiff": filter_debdiff,
+    "diffoscope": filter_diffoscope,
+}
+
+
+async def precache_needed(
+    diff_cache: DiffCache, old_id: str, new_id: str, old_run=None, new_run=None
+) -> bool:
+    """Check whether any diffs for a pair of runs still need to be precached."""
+    filter_versions = _filter_versions(old_run, new_run)
+    for kind in PRECACHE_KINDS:
+        if not await diff_cache.contains(kind, old_id, new_id):
+            return True
+        if filter_versions is not None and not await diff_cache.contains(
+            filtered_kind(kind, *filter_versions), old_id, new_id
+        ):
+            return True
+    return False
+
+
+async def precache_kind(
+    diff_cache: DiffCache,
+    single_flight: SingleFlight[bytes],
+    kind: str,
     old_id: str,
     new_id: str,
-    *,
-    task_memory_limit: Optional[int] = None,
-    task_timeout: Optional[int] = None,
-    diffoscope_cache_path: Optional[Callable[[str, str], str]] = None,
-    debdiff_cache_path: Optional[Callable[[str, str], str]] = None,
-    diffoscope_command: Optional[str] = None,
+    generate: Callable[[], Awaitable[bytes]],
+    old_run=None,
+    new_run=None,
 ) -> None:
-    """Precache the diff between two runs.
-
-    Args:
-      old_id: Run id for old run
-      new_id: Run id for new run
-    Raises:
-      ArtifactsMissing: if either the old or new run artifacts are missing
-      ArtifactRetrievalTimeout: if retrieving artifacts resulted in a timeout
-      DiffCommandTimeout: if running the diff command triggered a timeout
-      DiffCommandMemoryError: if the diff command used too much memory
-      DiffCommandError: if a diff command failed
-    """
-    with ExitStack() as es:
-        old_dir = es.enter_context(TemporaryDirectory(prefix=TMP_PREFIX))
-        new_dir = es.enter_context(TemporaryDirectory(prefix=TMP_PREFIX))
-
-        await asyncio.gather(
-            artifact_manager.retrieve_artifacts(
-                old_id, old_dir, filter_fn=is_binary, timeout=PRECACHE_RETRIEVE_TIMEOUT
-            ),
-            artifact_manager.retrieve_artifacts(
-                new_id, new_dir, filter_fn=is_binary, timeout=PRECACHE_RETRIEVE_TIMEOUT
-            ),
+    """Precache one kind of diff, and its filter_boring variant."""
+    diff = None
+    if not await diff_cache.contains(kind, old_id, new_id):
+        diff = await single_flight.do(
+            (kind, old_id, new_id),
+            partial(cached_diff, diff_cache, kind, old_id, new_id, generate),
+        )
+        logging.info(
+            "Precached %s result for %s/%s",
+            kind,
+            old_id,
+            new_id,
+            extra={"old_run_id": old_id, "new_run_id": new_id},
         )
+    filter_versions = _filter_versions(old_run, new_run)
+    if filter_versions is None:
+        return
+    filtered = filtered_kind(kind, *filter_versions)
+    if await diff_cache.contains(filtered, old_id, new_id):
+        return
+    if diff is None:
+        diff = await diff_cache.get(kind, old_id, new_id)
+        if diff is None:
+            return
+    await diff_cache.put(
+        filtered,
+        old_id,
+        new_id,
+        await asyncio.to_thread(PRECACHE_KINDS[kind], diff, old_run, new_run),
+    )
 
-        old_binaries = find_binaries(old_dir)
-        if not old_binaries:
-            raise ArtifactsMissing(old_id)
 
-        new_binaries = find_binaries(new_dir)
-        if not new_binaries:
-            raise ArtifactsMissing(new_id)
+class PrecachePipeline:
+    """Staged pipeline for bulk precaching.
 
-        if debdiff_cache_path:
-            p = debdiff_cache_path(old_id, new_id)
-        else:
-            p = None
+    Jobs go through three stages: artifact retrieval, debdiff and diffoscope.
+    The stages are connected by bounded queues, so that the artifacts for the
+    next pairs of runs are retrieved while diffs are being generated for
+    earlier ones, without retrieving arbitrarily far ahead.
+    """
 
-        if p and not os.path.exists(p):
-            with open(p, "wb") as f:
-                f.write(
-                    await run_debdiff(
-                        [p for (n, p) in old_binaries], [p for (n, p) in new_binaries]
-                    )
-                )
-            logging.info(
-                "Precached debdiff result for %s/%s",
-                old_id,
-                new_id,
-                extra={"old_run_id": old_id, "new_run_id": new_id},
-            )
+    def __init__(
+        self,
+        app: web.Application,
+        *,
+        download_concurrency: int = 2,
+        diffoscope_concurrency: int = 1,
+        queue_size: int = 2,
+    ) -> None:
+        """Create a pipeline.
+
+        Args:
+          app: differ application, to take settings, caches and the artifact
+            manager from
+          download_concurrency: Number of pairs to retrieve artifacts for
+            concurrently
+          diffoscope_concurrency: Number of diffoscope processes to run
+            concurrently
+          queue_size: Number of pairs that can wait between two stages
+        """
+        self.app = app
+        self.download_concurrency = download_concurrency
+        self.diffoscope_concurrency = diffoscope_concurrency
+        self.queue_size = queue_size
+        self._download_queue: asyncio.Queue[_PipelineJob] = asyncio.Queue()
+        self._debdiff_queue: asyncio.Queue[_PipelineJob] = asyncio.Queue(queue_size)
+        self._diffoscope_queue: asyncio.Queue[_PipelineJob] = asyncio.Queue(queue_size)
+        self._tasks: list[asyncio.Task] = []
+
+    @property
+    def capacity(self) -> int:
+        """Number of jobs that can be in progress without waiting to start."""
+        return (
+            self.download_concurrency
+            + self.queue_size
+            + 1
+            + self.queue_size
+            + self.diffoscope_concurrency
+        )
 
-        if diffoscope_cache_path:
-            p = diffoscope_cache_path(old_id, new_id)
+    def _update_metrics(self) -> None:
+        for stage, queue in [
+            ("download", self._download_queue),
+            ("debdiff", self._debdiff_queue),
+            ("diffoscope", self._diffoscope_queue),
+        ]:
+            precache_pipeline_queue_depth.labels(stage=stage).set(queue.qsize())
+
+    async def run(
+        self,
+        old_id: str,
+        new_id: str,
+        *,
+        report_artifact_size: Optional[Callable[[str, int], None]] = None,
+        old_run=None,
+        new_run=None,
+    ) -> None:
+        """Precache the diffs for a pair of runs through the pipeline.
+
+        Raises:
+          ArtifactsMissing: if either the old or new run artifacts are missing
+          ArtifactRetrievalTimeout: if retrieving artifacts resulted in a timeout
+          DiffCommandTimeout: if running the diff command triggered a timeout
+          DiffCommandMemoryError: if the diff command used too much memory
+          DiffCommandError: if a diff command failed
+        """
+        job = _PipelineJob(old_id, new_id, old_run, new_run, report_artifact_size)
+        await self._download_queue.put(job)
+        self._update_metrics()
+        try:
+            await asyncio.shield(job.future)
+        except asyncio.CancelledError:
+            job.cancelled = True
+            raise
+
+    async def _finish(self, job, exc=None) -> None:
+        await job.es.aclose()
+        if job.future.done() or job.cancelled:
+            return
+        if exc is not None:
+            job.future.set_exception(exc)
         else:
-            p = None
+            job.future.set_result(None)
 
-        if p and not os.path.exists(p):
+    async def _download_worker(self) -> None:
+        while True:
+            job = await self._download_queue.get()
+            self._update_metrics()
+            if job.cancelled:
+                await self._finish(job)
+                continue
             try:
-                diffoscope_diff = await run_diffoscope(
-                    old_binaries,
-                    new_binaries,
-                    preexec_fn=lambda: _set_limits(task_memory_limit),
-                    timeout=task_timeout,
-                    diffoscope_command=diffoscope_command,
+                if not await precache_needed(
+                    self.app["diff_cache"],
+                    job.old_id,
+                    job.new_id,
+                    job.old_run,
+                    job.new_run,
+                ):
+                    await self._finish(job)
+                    continue
+                job.binaries = await retrieve_binaries(
+                    self.app["artifact_manager"],
+                    job.es,
+                    job.old_id,
+                    job.new_id,
+                    artifact_cache=self.app["artifact_cache"],
+                    timeout=PRECACHE_RETRIEVE_TIMEOUT,
                 )
-            except MemoryError as e:
-                raise DiffCommandMemoryError("diffoscope", task_memory_limit) from e
-            except asyncio.TimeoutError as e:
-                raise DiffCommandTimeout("diffoscope", task_timeout) from e
-            except DiffoscopeError as e:
-                raise DiffCommandError("diffoscope", e.args[0]) from e
+                if job.report_artifact_size is not None:
+                    for run_id, run_binaries in zip(
+                        (job.old_id, job.new_id), job.binaries
+                    ):
+                        job.report_artifact_size(
+                            run_id,
+                            sum(os.path.getsize(p) for (n, p) in run_binaries),
+                        )
+            except Exception as e:
+                await self._finish(job, e)
+                continue
+            await self._debdiff_queue.put(job)
+            self._update_metrics()
 
+    async def _debdiff_worker(self) -> None:
+        while True:
+            job = await self._debdiff_queue.get()
+            self._update_metrics()
             try:
-                with open(p, "w") as f:
-                    json.dump(diffoscope_diff, f)
-            except json.JSONDecodeError as e:
-                raise web.HTTPServerError(text=str(e)) from e
-            logging.info(
-                "Precached diffoscope result for %s/%s",
-                old_id,
-                new_id,
-                extra={"old_run_id": old_id, "new_run_id": new_id},
-            )
+                await precache_kind(
+                    self.app["diff_cache"],
+                    self.app["single_flight"],
+                    "debdiff",
+                    job.old_id,
+                    job.new_id,
+                    partial(generate_debdiff, *job.binaries),
+                    job.old_run,
+                    job.new_run,
+                )
+            except Exception as e:
+                await self._finish(job, e)
+                continue
+            await self._diffoscope_queue.put(job)
+            self._update_metrics()
+
+    async def _diffoscope_worker(self) -> None:
+        while True:
+            job = await self._diffoscope_queue.get()
+            self._update_metrics()
+            try:
+                await precache_kind(
+                    self.app["diff_cache"],
+                    self.app["single_flight"],
+                    "diffoscope",
+                    job.old_id,
+                    job.new_id,
+                    partial(
+                        generate_diffoscope,
+                        *job.binaries,
+                        task_memory_limit=self.app["task_memory_limit"],
+                        task_timeout=self.app["task_timeout"],
+                        diffoscope_command=self.app["diffoscope_command"],
+                    ),
+                    job.old_run,
+                    job.new_run,
+                )
+            except Exception as e:
+                await self._finish(job, e)
+            else:
+                await self._finish(job)
+
+    def start(self) -> None:
+        for _i in range(self.download_concurrency):
+            self._tasks.append(asyncio.create_task(self._download_worker()))
+        self._tasks.append(asyncio.create_task(self._debdiff_worker()))
+        for _i in range(self.diffoscope_concurrency):
+            self._tasks.append(asyncio.create_task(self._diffoscope_worker()))
+
+    async def stop(self) -> None:
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+
+class _PipelineJob:
+    def __init__(self, old_id, new_id, old_run, new_run, report_artifact_size):
+        self.old_id = old_id
+        self.new_id = new_id
+        self.old_run = old_run
+        self.new_run = new_run
+        self.report_artifact_size = report_artifact_size
+        self.binaries = None
+        self.es = AsyncExitStack()
+        self.future = asyncio.get_running_loop().create_future()
+        self.cancelled = False
+
+
+async def run_precache_job(
+    app: web.Application,
+    old_id: str,
+    new_id: str,
+    report_artifact_size: Callable[[str, int], None],
+) -> None:
+    async with app["pool"].acquire() as conn:
+        old_run = await get_run(conn, old_id)
+        new_run = await get_run(conn, new_id)
+    if app["diff_cache"] is None:
+        return
+    try:
+        await app["precache_pipeline"].run(
+            old_id,
+            new_id,
+            report_artifact_size=report_artifact_size,
+            old_run=old_run,
+            new_run=new_run,
+        )
+    except ArtifactsMissing as e:
+        logging.info(
+            "Artifacts missing while precaching diff for %s/%s: %r", old_id, new_id, e
+        )
+        raise
+    except ArtifactRetrievalTimeout as e:
+        logging.info("Timeout retrieving artifacts: %s", e)
+        raise
+    except DiffCommandTimeout as e:
+        logging.info("Timeout diffing artifacts: %s", e)
+        raise
+    except DiffCommandMemoryError as e:
+        logging.info("Memory error diffing artifacts: %s", e)
+        raise
+    except DiffCommandError as e:
+        logging.info("Error diff artifacts: %s", e)
+        raise
+    except Exception as e:
+        logging.info("Error precaching diff for %s/%s: %r", old_id, new_id, e)
+        traceback.print_exc()
+        raise
 
 
 @routes.post("/precache/{old_id}/{new_id}", name="precache")
@@ -522,18 +1084,8 @@ async def handle_precache(request):
 
     old_run, new_run = await get_run_pair(request.app["pool"], old_id, new_id)
 
-    await spawn(
-        request,
-        precache(
-            request.app["artifact_manager"],
-            old_run["id"],
-            new_run["id"],
-            task_memory_limit=request.app["task_memory_limit"],
-            task_timeout=request.app["task_timeout"],
-            diffoscope_cache_path=request.app["diffoscope_cache_path"],
-            debdiff_cache_path=request.app["debdiff_cache_path"],
-            diffoscope_command=request.app["diffoscope_command"],
-        ),
+    await request.app["precache_scheduler"].submit(
+        old_run["id"], new_run["id"], PRIORITY_INTERACTIVE
     )
 
     return web.Response(status=202, text="Precaching started")
@@ -555,26 +1107,25 @@ where
  order by run.finish_time desc, unchanged_run.finish_time desc
 """
         )
-        if not rows:
-            return web.json_response({"count": 0}, status=200)
-        for row in rows:
-            await spawn(
-                request,
-                precache(
-                    request.app["artifact_manager"],
-                    row[1],
-                    row[0],
-                    task_memory_limit=request.app["task_memory_limit"],
-                    task_timeout=request.app["task_timeout"],
-                    diffoscope_cache_path=request.app["diffoscope_cache_path"],
-                    debdiff_cache_path=request.app["debdiff_cache_path"],
-                    diffoscope_command=request.app["diffoscope_command"],
-                ),
-            )
+    if not rows:
+        return web.json_response({"count": 0}, status=200)
+    for row in rows:
+        await request.app["precache_scheduler"].submit(
+            row[1], row[0], PRIORITY_BACKFILL
+        )
 
     return web.json_response({"count": len(rows)}, status=202)
 
 
+@routes.get("/precache-queue", name="precache-queue")
+async def handle_precache_queue(request):
+    status = await request.app["precache_scheduler"].status()
+    status["diffoscope_concurrency"] = request.app[
+        "precache_pipeline"
+    ].diffoscope_concurrency
+    return web.json_response(status)
+
+
 @routes.get("/health", name="health")
 async def handle_health(request):
     return web.Response(text="ok")
@@ -585,21 +1136,6 @@ async def handle_ready(request):
     return web.Response(text="ok")
 
 
-def diffoscope_cache_path(cache_path, old_id: str, new_id: str) -> str:
-    base_path = os.path.join(cache_path, "diffoscope")
-    if not os.path.isdir(base_path):
-        os.mkdir(base_path)
-    return os.path.join(base_path, f"{old_id}_{new_id}.json")
-
-
-def debdiff_cache_path(cache_path, old_id: str, new_id: str) -> str:
-    base_path = os.path.join(cache_path, "debdiff")
-    # This can happen when the default branch changes
-    if not os.path.isdir(base_path):
-        os.mkdir(base_path)
-    return os.path.join(base_path, f"{old_id}_{new_id}")
-
-
 async def run_web_server(app, listen_addr, port):
     runner = web.AppRunner(app)
     await runner.setup()
@@ -634,37 +1170,8 @@ async def listen_to_runner(redis, db_location: str, app: web.Application):
                 )
                 if unchanged_run:
                     to_precache.append((unchanged_run["id"], result["log_id"]))
-        # This could be concurrent, but risks hitting resource constraints
-        # for large packages.
         for old_id, new_id in to_precache:
-            try:
-                await precache(
-                    app["artifact_manager"],
-                    old_id,
-                    new_id,
-                    task_memory_limit=app["task_memory_limit"],
-                    task_timeout=app["task_timeout"],
-                    diffoscope_cache_path=app["diffoscope_cache_path"],
-                    debdiff_cache_path=app["debdiff_cache_path"],
-                    diffoscope_command=app["diffoscope_command"],
-                )
-            except ArtifactsMissing as e:
-                logging.info(
-                    "Artifacts missing while precaching diff for new result %s: %r",
-                    result["log_id"],
-                    e,
-                )
-            except ArtifactRetrievalTimeout as e:
-                logging.info("Timeout retrieving artifacts: %s", e)
-            except DiffCommandTimeout as e:
-                logging.info("Timeout diffing artifacts: %s", e)
-            except DiffCommandMemoryError as e:
-                logging.info("Memory error diffing artifacts: %s", e)
-            except DiffCommandError as e:
-                logging.info("Error diff artifacts: %s", e)
-            except Exception as e:
-                logging.info("Error precaching diff for %s: %r", result["log_id"], e)
-                traceback.print_exc()
+            await app["precache_scheduler"].submit(old_id, new_id, PRIORITY_RUNNER)
 
     try:
         async with redis.pubsub(ignore_subscribe_messages=True) as ch:
@@ -683,6 +1190,18 @@ def create_app(
     task_timeout=None,
     db=None,
     diffoscope_command=None,
+    cache_max_size=None,
+    cache_compression="gzip",
+    cache_location=None,
+    lock_manager=None,
+    redis=None,
+    memory_budget=None,
+    disk_budget=None,
+    artifact_cache_path=None,
+    artifact_cache_max_size=None,
+    render_processes=None,
+    download_concurrency=2,
+    diffoscope_concurrency=None,
 ):
     trailing_slash_redirect = normalize_path_middleware(append_slash=True)
     app = web.Application(
@@ -690,23 +1209,88 @@ def create_app(
     )
     app.router.add_routes(routes)
     app["artifact_manager"] = artifact_manager
+    if artifact_cache_path is not None:
+        app["artifact_cache"] = ArtifactCache(
+            artifact_cache_path,
+            artifact_manager,
+            max_size=artifact_cache_max_size,
+            filter_fn=is_binary,
+        )
+    else:
+        app["artifact_cache"] = None
     app["task_memory_limit"] = task_memory_limit
     app["task_timeout"] = task_timeout
-    if cache_path is not None:
-        app["diffoscope_cache_path"] = partial(diffoscope_cache_path, cache_path)
-    else:
-        app["diffoscope_cache_path"] = None
-    if cache_path is not None:
-        app["debdiff_cache_path"] = partial(debdiff_cache_path, cache_path)
-    else:
-        app["debdiff_cache_path"] = None
+    app["diff_cache"] = get_diff_cache(
+        cache_location,
+        local_path=cache_path,
+        max_size=cache_max_size,
+        compression=cache_compression,
+    )
     app["diffoscope_command"] = diffoscope_command
+    if render_processes:
+        # Rendering is CPU-bound, and the diffoscope HTML presenter writes to
+        # sys.stdout; give each render a process of its own.
+        app["render_executor"] = ProcessPoolExecutor(
+            max_workers=render_processes,
+            mp_context=multiprocessing.get_context("forkserver"),
+        )
+
+        async def shutdown_render_executor(app):
+            app["render_executor"].shutdown(cancel_futures=True)
+
+        app.on_cleanup.append(shutdown_render_executor)
+    else:
+        app["render_executor"] = None
+    app["single_flight"] = SingleFlight(lock_manager, lock_prefix="differ")
+    if diffoscope_concurrency is None:
+        # diffoscope is mostly CPU-bound, so don't run more processes than
+        # there are CPUs, even if the memory budget would allow it.
+        diffoscope_concurrency = os.cpu_count() or 1
+        if memory_budget is not None and task_memory_limit:
+            diffoscope_concurrency = min(
+                diffoscope_concurrency,
+                memory_budget // (task_memory_limit * 1024**2),
+            )
+        diffoscope_concurrency = max(1, diffoscope_concurrency)
+    app["precache_pipeline"] = PrecachePipeline(
+        app,
+        download_concurrency=download_concurrency,
+        diffoscope_concurrency=diffoscope_concurrency,
+    )
+    # Don't take more jobs off the (persistent) queue than the pipeline can
+    # work on; anything beyond that would only wait in memory.
+    app["precache_scheduler"] = PrecacheScheduler(
+        RedisPrecacheQueue(redis) if redis is not None else MemoryPrecacheQueue(),
+        partial(run_precache_job, app),
+        memory_budget=memory_budget,
+        disk_budget=disk_budget,
+        job_memory=(task_memory_limit or 0) * 1024**2,
+        max_running=app["precache_pipeline"].capacity,
+    )
 
     async def connect_artifact_manager(app):
         await app["artifact_manager"].__aenter__()
 
     app.on_startup.append(connect_artifact_manager)
 
+    async def start_precache_scheduler(app):
+        app["precache_pipeline"].start()
+        app["precache_scheduler"].start()
+
+    async def stop_precache_scheduler(app):
+        await app["precache_scheduler"].stop()
+        await app["precache_pipeline"].stop()
+
+    app.on_startup.append(start_precache_scheduler)
+    app.on_cleanup.append(stop_precache_scheduler)
+
+    if app["diff_cache"] is not None:
+
+        async def connect_diff_cache(app):
+            await app["diff_cache"].__aenter__()
+
+        app.on_startup.append(connect_diff_cache)
+
     if db is None:
 
         async def connect_postgres(app):
@@ -735,6 +1319,39 @@ def main(argv=None):
         "--config", type=str, default="janitor.conf", help="Path to configuration"
     )
     parser.add_argument("--cache-path", type=str, default=None, help="Cache directory")
+    parser.add_argument(
+        "--cache-location",
+        type=str,
+        default=None,
+        help="Location of a cache shared between differ instances "
+        "(gs:// URL, S3 endpoint or directory). If --cache-path is also "
+        "specified, it is used as a local read-through cache",
+    )
+    parser.add_argument(
+        "--cache-max-size",
+        type=int,
+        default=None,
+        help="Maximum size of the cache (in MB)",
+    )
+    parser.add_argument(
+        "--cache-compression",
+        type=str,
+        choices=["none", "gzip", "zstd"],
+        default="gzip",
+        help="Compression to use for cache entries",
+    )
+    parser.add_argument(
+        "--artifact-cache-path",
+        type=str,
+        default=None,
+        help="Directory to cache retrieved artifacts in",
+    )
+    parser.add_argument(
+        "--artifact-cache-max-size",
+        type=int,
+        default=None,
+        help="Maximum size of the artifact cache (in MB)",
+    )
     parser.add_argument(
         "--task-memory-limit", help="Task memory limit (in MB)", type=int, default=1500
     )
@@ -742,6 +1359,44 @@ def main(argv=None):
         "--task-timeout", help="Task timeout (in seconds)", type=int, default=60
     )
     parser.add_argument("--diffoscope-command", type=str, default="diffoscope")
+    parser.add_argument(
+        "--download-concurrency",
+        type=int,
+        default=2,
+        help="Number of pairs of runs to retrieve artifacts for concurrently "
+        "while precaching",
+    )
+    parser.add_argument(
+        "--render-processes",
+        type=int,
+        default=2,
+        help="Number of processes to render diffoscope output in "
+        "(0 to render in the main process)",
+    )
+    parser.add_argument(
+        "--memory-budget",
+        type=int,
+        default=None,
+        help="Total memory available to precache jobs (in MB); every job "
+        "reserves --task-memory-limit, which also limits how many "
+        "diffoscope processes precaching runs concurrently. "
+        "Defaults to half of physical memory",
+    )
+    parser.add_argument(
+        "--diffoscope-concurrency",
+        type=int,
+        default=None,
+        help="Number of diffoscope processes to run concurrently while "
+        "precaching. Defaults to what fits in --memory-budget, but no more "
+        "than the number of CPUs",
+    )
+    parser.add_argument(
+        "--disk-budget",
+        type=int,
+        default=None,
+        help="Total disk space available to precache jobs (in MB). "
+        "Defaults to half of the free space in the temporary directory",
+    )
     parser.add_argument(
         "--gcp-logging", action="store_true", help="Use Google cloud logging"
     )
@@ -766,6 +1421,12 @@ def main(argv=None):
     except FileNotFoundError:
         parser.error(f"config path {args.config} does not exist")
 
+    if args.cache_compression == "zstd":
+        try:
+            import zstandard  # noqa: F401
+        except ModuleNotFoundError:
+            parser.error("zstd compression requires the zstandard module")
+
     set_user_agent(config.user_agent)
 
     loop = asyncio.get_event_loop()
@@ -787,8 +1448,27 @@ def main(argv=None):
 
     artifact_manager = get_artifact_manager(config.artifact_location)
 
-    if args.cache_path and not os.path.isdir(args.cache_path):
-        os.makedirs(args.cache_path)
+    if config.redis_location and args.cache_location:
+        # Coordinate with other differ instances sharing the same cache, so
+        # that they don't generate the same diffs concurrently.
+        lock_manager = aioredlock.Aioredlock([config.redis_location])
+    else:
+        lock_manager = None
+
+    if args.memory_budget is not None:
+        memory_budget = args.memory_budget * 1024**2
+    else:
+        memory_budget = (os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")) // 2
+
+    if args.disk_budget is not None:
+        disk_budget = args.disk_budget * 1024**2
+    else:
+        disk_budget = shutil.disk_usage(gettempdir()).free // 2
+
+    if config.redis_location:
+        redis = Redis.from_url(config.redis_location)
+    else:
+        redis = None
 
     app = create_app(
         args.cache_path,
@@ -797,6 +1477,24 @@ def main(argv=None):
         task_memory_limit=args.task_memory_limit,
         task_timeout=args.task_timeout,
         diffoscope_command=args.diffoscope_command,
+        cache_max_size=(
+            args.cache_max_size * 1024**2 if args.cache_max_size is not None else None
+        ),
+        cache_compression=args.cache_compression,
+        cache_location=args.cache_location,
+        lock_manager=lock_manager,
+        redis=redis,
+        memory_budget=memory_budget,
+        disk_budget=disk_budget,
+        render_processes=args.render_processes,
+        download_concurrency=args.download_concurrency,
+        diffoscope_concurrency=args.diffoscope_concurrency,
+        artifact_cache_path=args.artifact_cache_path,
+        artifact_cache_max_size=(
+            args.artifact_cache_max_size * 1024**2
+            if args.artifact_cache_max_size is not None
+            else None
+        ),
     )
     setup_metrics(app)
     setup_aiojobs(app)
@@ -807,8 +1505,7 @@ def main(argv=None):
     site = web.TCPSite(runner, args.listen_address, port=args.port)
     loop.run_until_complete(site.start())
 
-    if config.redis_location:
-        redis = Redis.from_url(config.redis_location)
+    if redis is not None:
         loop.create_task(listen_to_runner(redis, config.database_location, app))
 
     loop.run_forever()
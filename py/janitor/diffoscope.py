@@ -19,10 +19,12 @@ __all__ = [
     "run_diffoscope",
 ]
 
+import asyncio
 import json
 import logging
 import os
 import sys
+from contextlib import redirect_stdout
 from io import StringIO
 
 from breezy.patches import (
@@ -88,9 +90,7 @@ def filter_irrelevant(diff):
     diff["source2"] = os.path.basename(diff["source2"])
 
 
-async def format_diffoscope(root_difference, content_type, title, css_url=None):
-    if content_type == "application/json":
-        return json.dumps(root_difference)
+def _format_diffoscope(root_difference, content_type, title, css_url=None):
     from diffoscope.readers.json import JSONReaderV1
 
     root_difference = JSONReaderV1().load_rec(root_difference)
@@ -98,14 +98,16 @@ async def format_diffoscope(root_difference, content_type, title, css_url=None):
         from diffoscope.presenters.html.html import HTMLPresenter
 
         p = HTMLPresenter()
-        old_stdout = sys.stdout
-        sys.stdout = f = StringIO()
+        # HTMLPresenter writes to sys.stdout and takes the title from
+        # sys.argv; this is only safe when a process renders a single diff
+        # at a time.
+        f = StringIO()
         old_argv = sys.argv
         sys.argv = title.split(" ")
         try:
-            p.output_html("-", root_difference, css_url=css_url)
+            with redirect_stdout(f):
+                p.output_html("-", root_difference, css_url=css_url)
         finally:
-            sys.stdout = old_stdout
             sys.argv = old_argv
         return f.getvalue()
     if content_type == "text/markdown":
@@ -131,3 +133,26 @@ async def format_diffoscope(root_difference, content_type, title, css_url=None):
         p.start(root_difference)
         return "".join(out)
     raise AssertionError(f"unknown content type {content_type!r}")
+
+
+async def format_diffoscope(
+    root_difference, content_type, title, css_url=None, *, executor=None
+):
+    """Render a diffoscope diff.
+
+    Args:
+      root_difference: diffoscope JSON output
+      content_type: Content type to render to
+      title: Title for the rendered diff
+      css_url: URL of CSS to use for HTML output
+      executor: Process pool to render in. If None, rendering happens
+        inline, blocking the event loop.
+    """
+    if content_type == "application/json":
+        return json.dumps(root_difference)
+    if executor is None:
+        return _format_diffoscope(root_difference, content_type, title, css_url)
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(
+        executor, _format_diffoscope, root_difference, content_type, title, css_url
+    )
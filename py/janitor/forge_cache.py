@@ -0,0 +1,386 @@
+#!/usr/bin/python3
+# Copyright (C) 2024 Jelmer Vernooij <jelmer@jelmer.uk>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+"""Conditional-request cache for forge API calls.
+
+Forges like GitHub and GitLab support ETag/Last-Modified revalidation, and
+"304 Not Modified" responses don't count against their rate limits. This
+caches successful GET responses from forge APIs on disk, keyed by URL and
+the request headers that affect the response, and revalidates them with
+conditional requests. Other HTTP traffic (e.g. branch access) is passed
+through untouched.
+"""
+
+__all__ = [
+    "ForgeResponseCache",
+    "install_forge_response_cache",
+    "is_forge_api_url",
+]
+
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+from typing import Optional
+from urllib.parse import urlparse
+
+from aiohttp_openmetrics import Counter, Gauge
+from breezy.errors import UnexpectedHttpStatus
+from breezy.transport.http.urllib import HttpTransport
+
+forge_cache_hit_count = Counter(
+    "forge_cache_hit_count",
+    "Number of forge API requests answered from the response cache",
+    labelnames=("forge",),
+)
+forge_cache_miss_count = Counter(
+    "forge_cache_miss_count",
+    "Number of forge API requests that were not answered from the cache",
+    labelnames=("forge",),
+)
+forge_cache_eviction_count = Counter(
+    "forge_cache_eviction_count", "Number of evicted forge response cache entries"
+)
+forge_cache_size = Gauge(
+    "forge_cache_size", "Size of the forge response cache, in bytes"
+)
+
+# Hosts that only serve forge APIs
+FORGE_API_HOSTS = ("api.github.com",)
+
+# Path components of API endpoints on other hosts: GitHub Enterprise (v3),
+# GitLab (v4) and Gitea/Forgejo (v1)
+FORGE_API_PATHS = ("/api/v1/", "/api/v3/", "/api/v4/")
+
+# Request headers that select a different response, besides those listed in
+# the Vary header of the response
+KEY_HEADERS = ("accept", "authorization", "private-token")
+
+
+def is_forge_api_url(url: str) -> bool:
+    """Check whether a URL refers to a forge API endpoint."""
+    parsed = urlparse(url)
+    if parsed.hostname in FORGE_API_HOSTS:
+        return True
+    return any(p in parsed.path for p in FORGE_API_PATHS)
+
+
+class CachedResponse:
+    """Response object compatible with the one returned by HttpTransport."""
+
+    def __init__(self, status, reason, headers, data) -> None:
+        self.status = status
+        self.reason = reason
+        self._headers = headers
+        self.data = data
+        self._offset = 0
+
+    def getheader(self, name, default=None):
+        for key, value in self._headers:
+            if key.lower() == name.lower():
+                return value
+        return default
+
+    def getheaders(self):
+        return list(self._headers)
+
+    @property
+    def text(self):
+        if self.status == 204:
+            return None
+        from email.message import EmailMessage
+
+        msg = EmailMessage()
+        msg["content-type"] = self.getheader("Content-Type", "text/plain")
+        charset = msg["content-type"].params.get("charset")
+        return self.data.decode(charset or "utf-8")
+
+    def read(self, amt=None):
+        if amt is None:
+            ret = self.data[self._offset :]
+        else:
+            ret = self.data[self._offset : self._offset + amt]
+        self._offset += len(ret)
+        return ret
+
+    def readlines(self):
+        return self.read().splitlines(True)
+
+    def readline(self, size=-1):
+        data = self.data[self._offset :]
+        end = data.find(b"\n") + 1 or len(data)
+        if size >= 0:
+            end = min(end, size)
+        self._offset += end
+        return data[:end]
+
+
+class ForgeResponseCache:
+    """On-disk cache of forge API responses.
+
+    When ``max_size`` (in bytes) is set, the least recently used entries are
+    evicted to stay below it.
+    """
+
+    def __init__(self, path: str, *, max_size: Optional[int] = None) -> None:
+        self.path = path
+        self.max_size = max_size
+        # Requests are made from the publisher's worker threads
+        self._lock = threading.Lock()
+        # Maps cache keys to the size of their entry, least recently used first
+        self._entries: OrderedDict[str, int] = OrderedDict()
+        self._size = 0
+        os.makedirs(self.path, exist_ok=True)
+        self._scan()
+
+    def _scan(self) -> None:
+        entries: dict[str, tuple[float, int]] = {}
+        for shard in os.scandir(self.path):
+            if not shard.is_dir():
+                continue
+            for entry in os.scandir(shard.path):
+                key, ext = os.path.splitext(entry.name)
+                if ext not in (".json", ".body"):
+                    continue
+                try:
+                    st = entry.stat()
+                except FileNotFoundError:
+                    continue
+                mtime, size = entries.get(key, (0.0, 0))
+                entries[key] = (max(mtime, st.st_mtime), size + st.st_size)
+        for key, (_mtime, size) in sorted(entries.items(), key=lambda e: e[1][0]):
+            self._entries[key] = size
+            self._size += size
+        forge_cache_size.set(self._size)
+
+    def _key(self, url: str, headers: dict[str, str]) -> str:
+        h = hashlib.sha256(url.encode("utf-8"))
+        for name in KEY_HEADERS:
+            value = headers.get(name)
+            if value is not None:
+                h.update(f"\0{name}: {value}".encode())
+        return h.hexdigest()
+
+    def _paths(self, key: str) -> tuple[str, str]:
+        base = os.path.join(self.path, key[:2], key)
+        return base + ".json", base + ".body"
+
+    def _touch(self, key: str) -> None:
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+        try:
+            os.utime(self._paths(key)[0])
+        except FileNotFoundError:
+            pass
+
+    def _evict(self) -> None:
+        if self.max_size is None:
+            return
+        with self._lock:
+            evicted = []
+            while self._size > self.max_size and self._entries:
+                key, size = self._entries.popitem(last=False)
+                self._size -= size
+                evicted.append(key)
+            forge_cache_size.set(self._size)
+        for key in evicted:
+            for path in self._paths(key):
+                try:
+                    os.unlink(path)
+                except FileNotFoundError:
+                    pass
+            forge_cache_eviction_count.inc()
+
+    def get(self, url: str, headers: dict[str, str]):
+        """Look up a cached response.
+
+        Args:
+          url: URL of the request
+          headers: Request headers, with lowercase names
+        Returns:
+          tuple with metadata and body of the response, or None
+        """
+        key = self._key(url, headers)
+        meta_path, body_path = self._paths(key)
+        try:
+            with open(meta_path) as f:
+                meta = json.load(f)
+            with open(body_path, "rb") as f:
+                data = f.read()
+        except (FileNotFoundError, ValueError):
+            return None
+        if meta.get("url") != url:
+            return None
+        for name, value in meta.get("vary", {}).items():
+            if headers.get(name) != value:
+                return None
+        self._touch(key)
+        return meta, data
+
+    def _write_atomic(self, path: str, data: bytes) -> None:
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+    def store(
+        self,
+        url: str,
+        headers: dict[str, str],
+        *,
+        status: int,
+        reason: str,
+        response_headers: list[tuple[str, str]],
+        data: bytes,
+    ) -> None:
+        """Store a response.
+
+        Args:
+          url: URL of the request
+          headers: Request headers, with lowercase names
+          status: Response status code
+          reason: Response reason phrase
+          response_headers: Response headers
+          data: Response body
+        """
+        vary: dict[str, Optional[str]] = {}
+        for name, value in response_headers:
+            if name.lower() != "vary":
+                continue
+            for field in value.split(","):
+                field = field.strip().lower()
+                if field == "*":
+                    # The response can't be reused
+                    return
+                if field:
+                    vary[field] = headers.get(field)
+        meta = {
+            "url": url,
+            "status": status,
+            "reason": reason,
+            "headers": response_headers,
+            "vary": vary,
+        }
+        encoded_meta = json.dumps(meta).encode("utf-8")
+        size = len(encoded_meta) + len(data)
+        if self.max_size is not None and size > self.max_size:
+            return
+        key = self._key(url, headers)
+        meta_path, body_path = self._paths(key)
+        os.makedirs(os.path.dirname(meta_path), exist_ok=True)
+        # Write the body first, so that metadata never refers to a missing or
+        # stale body.
+        self._write_atomic(body_path, data)
+        self._write_atomic(meta_path, encoded_meta)
+        with self._lock:
+            self._size += size - self._entries.pop(key, 0)
+            self._entries[key] = size
+            forge_cache_size.set(self._size)
+        self._evict()
+
+    def request(self, orig_request, transport, method, url, headers=None, **kwargs):
+        """Perform a request through the cache.
+
+        Only plain GET requests to forge APIs are cached; everything else is
+        passed through unmodified.
+        """
+        if (
+            method != "GET"
+            or kwargs.get("fields")
+            or kwargs.get("body")
+            or not is_forge_api_url(url)
+        ):
+            return orig_request(transport, method, url, headers=headers, **kwargs)
+        forge = urlparse(url).hostname or "unknown"
+        headers = dict(headers or {})
+        key_headers = {k.lower(): v for (k, v) in headers.items()}
+        cached = self.get(url, key_headers)
+        if cached is not None:
+            meta, data = cached
+            cached_response = CachedResponse(
+                meta["status"], meta["reason"], meta["headers"], data
+            )
+            etag = cached_response.getheader("ETag")
+            last_modified = cached_response.getheader("Last-Modified")
+            if etag:
+                headers["If-None-Match"] = etag
+            if last_modified:
+                headers["If-Modified-Since"] = last_modified
+        try:
+            response = orig_request(transport, method, url, headers=headers, **kwargs)
+        except UnexpectedHttpStatus as e:
+            # HttpTransport doesn't accept 304 responses, so they are
+            # reported as errors.
+            if e.code != 304 or cached is None:
+                raise
+            forge_cache_hit_count.labels(forge=forge).inc()
+            return cached_response
+        forge_cache_miss_count.labels(forge=forge).inc()
+        if response.status != 200:
+            return response
+        response_headers = response.getheaders()
+        if not any(k.lower() in ("etag", "last-modified") for k, v in response_headers):
+            return response
+        content_length = response.getheader("Content-Length")
+        if (
+            self.max_size is not None
+            and content_length is not None
+            and content_length.isdigit()
+            and int(content_length) > self.max_size
+        ):
+            # Don't buffer responses that wouldn't fit in the cache anyway
+            return response
+        ret = CachedResponse(
+            response.status, response.reason, response_headers, response.data
+        )
+        try:
+            self.store(
+                url,
+                key_headers,
+                status=ret.status,
+                reason=ret.reason,
+                response_headers=ret.getheaders(),
+                data=ret.data,
+            )
+        except OSError as e:
+            logging.warning("Unable to store cached response for %s: %s", url, e)
+        return ret
+
+
+def install_forge_response_cache(cache: ForgeResponseCache) -> None:
+    """Route forge API requests made through breezy via the cache."""
+    orig_request = getattr(
+        HttpTransport.request, "_janitor_orig_request", HttpTransport.request
+    )
+
+    def request(self, method, url, fields=None, headers=None, **urlopen_kw):
+        if fields is not None:
+            urlopen_kw["fields"] = fields
+        return cache.request(
+            orig_request, self, method, url, headers=headers, **urlopen_kw
+        )
+
+    request._janitor_orig_request = orig_request  # type: ignore
+    HttpTransport.request = request  # type: ignore
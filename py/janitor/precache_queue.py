@@ -0,0 +1,394 @@
+#!/usr/bin/python3
+# Copyright (C) 2024 Jelmer Vernooij <jelmer@jelmer.uk>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+"""Prioritized, resource-budgeted queue for differ precache jobs."""
+
+__all__ = [
+    "PRIORITY_INTERACTIVE",
+    "PRIORITY_RUNNER",
+    "PRIORITY_BACKFILL",
+    "PrecacheQueue",
+    "MemoryPrecacheQueue",
+    "RedisPrecacheQueue",
+    "PrecacheScheduler",
+]
+
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from collections.abc import Awaitable
+from typing import Callable, Optional
+
+from aiohttp_openmetrics import Counter, Gauge
+
+# Lower values are processed first.
+PRIORITY_INTERACTIVE = 0
+PRIORITY_RUNNER = 1
+PRIORITY_BACKFILL = 2
+
+# Disk space to assume for the artifacts of a run whose size is not known yet.
+DEFAULT_ARTIFACT_SIZE = 200 * 1024**2
+
+# Number of artifact sizes to remember.
+MAX_ARTIFACT_SIZES = 10000
+
+precache_queue_length = Gauge(
+    "precache_queue_length", "Number of precache jobs waiting to be run"
+)
+precache_running_count = Gauge(
+    "precache_running_count", "Number of precache jobs currently running"
+)
+precache_reserved_memory = Gauge(
+    "precache_reserved_memory", "Memory reserved by running precache jobs, in bytes"
+)
+precache_reserved_disk = Gauge(
+    "precache_reserved_disk", "Disk space reserved by running precache jobs, in bytes"
+)
+precache_job_count = Counter(
+    "precache_job_count", "Number of finished precache jobs", labelnames=("result",)
+)
+
+Job = tuple[str, str]
+
+
+class PrecacheQueue(ABC):
+    """Queue of (old_id, new_id) pairs to precache diffs for."""
+
+    @abstractmethod
+    async def push(self, old_id: str, new_id: str, priority: int) -> bool:
+        """Add a job to the queue.
+
+        If the job is already queued, its priority is raised if necessary.
+
+        Returns:
+          whether the job was newly added
+        """
+        raise NotImplementedError(self.push)
+
+    @abstractmethod
+    async def peek(self) -> Optional[Job]:
+        """Return the job with the highest priority, without removing it."""
+        raise NotImplementedError(self.peek)
+
+    @abstractmethod
+    async def remove(self, old_id: str, new_id: str) -> bool:
+        """Remove a job from the queue.
+
+        Returns:
+          whether the job was still queued
+        """
+        raise NotImplementedError(self.remove)
+
+    @abstractmethod
+    async def size(self) -> int:
+        raise NotImplementedError(self.size)
+
+
+class MemoryPrecacheQueue(PrecacheQueue):
+    """Non-persistent queue."""
+
+    def __init__(self) -> None:
+        self._heap: list[tuple[int, int, Job]] = []
+        self._entries: dict[Job, tuple[int, int]] = {}
+        self._counter = itertools.count()
+
+    async def push(self, old_id, new_id, priority):
+        job = (old_id, new_id)
+        existing = self._entries.get(job)
+        if existing is not None and existing[0] <= priority:
+            return False
+        entry = (priority, next(self._counter))
+        self._entries[job] = entry
+        heapq.heappush(self._heap, entry + (job,))
+        return existing is None
+
+    async def peek(self):
+        # Entries are removed from the heap lazily
+        while self._heap and self._entries.get(self._heap[0][2]) != self._heap[0][:2]:
+            heapq.heappop(self._heap)
+        if not self._heap:
+            return None
+        return self._heap[0][2]
+
+    async def remove(self, old_id, new_id):
+        return self._entries.pop((old_id, new_id), None) is not None
+
+    async def size(self):
+        return len(self._entries)
+
+
+class RedisPrecacheQueue(PrecacheQueue):
+    """Queue stored in a Redis sorted set.
+
+    The queue survives restarts, and can be shared between differ instances.
+    """
+
+    def __init__(self, redis, key: str = "differ:precache-queue") -> None:
+        self.redis = redis
+        self.key = key
+
+    def _score(self, priority: int) -> float:
+        # Order by priority, then by submission time
+        return priority * 1e10 + time.time()
+
+    async def push(self, old_id, new_id, priority):
+        return bool(
+            await self.redis.zadd(
+                self.key, {f"{old_id}/{new_id}": self._score(priority)}, lt=True
+            )
+        )
+
+    async def peek(self):
+        members = await self.redis.zrange(self.key, 0, 0)
+        if not members:
+            return None
+        member = members[0]
+        if isinstance(member, bytes):
+            member = member.decode("utf-8")
+        old_id, new_id = member.split("/", 1)
+        return (old_id, new_id)
+
+    async def remove(self, old_id, new_id):
+        return bool(await self.redis.zrem(self.key, f"{old_id}/{new_id}"))
+
+    async def size(self):
+        return await self.redis.zcard(self.key)
+
+
+class PrecacheScheduler:
+    """Run queued precache jobs within a memory and disk budget.
+
+    Every job reserves ``job_memory`` bytes of memory and an estimate of the
+    disk space needed for the artifacts of both runs. Jobs are started in
+    priority order for as long as their reservations fit in the budget; a job
+    is always allowed to run if nothing else is running, so that oversized
+    jobs don't block the queue forever.
+
+    Jobs are removed from the queue when they are started, so at most
+    ``max_running`` jobs are started at a time; the rest stay in the
+    (possibly persistent) queue.
+    """
+
+    def __init__(
+        self,
+        queue: PrecacheQueue,
+        run_job: Callable[[str, str, Callable[[str, int], None]], Awaitable[None]],
+        *,
+        memory_budget: Optional[int] = None,
+        disk_budget: Optional[int] = None,
+        job_memory: int = 0,
+        max_running: Optional[int] = None,
+        poll_interval: float = 10.0,
+    ) -> None:
+        """Create a scheduler.
+
+        Args:
+          queue: Queue to take jobs from
+          run_job: Function that runs a job; called with the old and new run
+            ids and a callback to report the size of a run's artifacts
+          memory_budget: Total memory available to jobs, in bytes
+          disk_budget: Total disk space available to jobs, in bytes
+          job_memory: Memory reserved by a single job, in bytes
+          max_running: Maximum number of jobs to run at a time
+          poll_interval: How often to check the queue for jobs submitted by
+            other processes, in seconds
+        """
+        self.queue = queue
+        self.run_job = run_job
+        self.memory_budget = memory_budget
+        self.disk_budget = disk_budget
+        self.job_memory = job_memory
+        self.max_running = max_running
+        self.poll_interval = poll_interval
+        self.completed = 0
+        self.failed = 0
+        self._artifact_sizes: OrderedDict[str, int] = OrderedDict()
+        self._running: dict[Job, dict] = {}
+        self._reserved_memory = 0
+        self._reserved_disk = 0
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+
+    def artifact_size(self, run_id: str) -> int:
+        try:
+            return self._artifact_sizes[run_id]
+        except KeyError:
+            pass
+        if self._artifact_sizes:
+            return sum(self._artifact_sizes.values()) // len(self._artifact_sizes)
+        return DEFAULT_ARTIFACT_SIZE
+
+    def _report_artifact_size(self, job: Job, run_id: str, size: int) -> None:
+        self._artifact_sizes[run_id] = size
+        self._artifact_sizes.move_to_end(run_id)
+        while len(self._artifact_sizes) > MAX_ARTIFACT_SIZES:
+            self._artifact_sizes.popitem(last=False)
+        # Replace the estimate with the actual size
+        info = self._running.get(job)
+        if info is None:
+            return
+        info["sizes"][run_id] = size
+        disk = sum(info["sizes"].get(r, self.artifact_size(r)) for r in job)
+        self._reserved_disk += disk - info["disk"]
+        info["disk"] = disk
+        precache_reserved_disk.set(self._reserved_disk)
+
+    def _fits(self, memory: int, disk: int) -> bool:
+        if not self._running:
+            return True
+        if self.max_running is not None and len(self._running) >= self.max_running:
+            return False
+        if (
+            self.memory_budget is not None
+            and self._reserved_memory + memory > self.memory_budget
+        ):
+            return False
+        if (
+            self.disk_budget is not None
+            and self._reserved_disk + disk > self.disk_budget
+        ):
+            return False
+        return True
+
+    async def submit(self, old_id: str, new_id: str, priority: int) -> bool:
+        """Queue a precache job.
+
+        Returns:
+          whether the job was newly added to the queue
+        """
+        added = await self.queue.push(old_id, new_id, priority)
+        self._wakeup.set()
+        return added
+
+    async def _wait(self) -> None:
+        try:
+            await asyncio.wait_for(self._wakeup.wait(), self.poll_interval)
+        except asyncio.TimeoutError:
+            pass
+        self._wakeup.clear()
+
+    async def _run(self, job: Job) -> None:
+        try:
+            await self.run_job(
+                job[0],
+                job[1],
+                lambda run_id, size: self._report_artifact_size(job, run_id, size),
+            )
+        except Exception as e:
+            # run_job is expected to log details about failures
+            logging.debug("Precache job %s/%s failed: %r", job[0], job[1], e)
+            self.failed += 1
+            precache_job_count.labels(result="failure").inc()
+        else:
+            self.completed += 1
+            precache_job_count.labels(result="success").inc()
+        finally:
+            info = self._running.pop(job)
+            self._reserved_memory -= info["memory"]
+            self._reserved_disk -= info["disk"]
+            precache_running_count.set(len(self._running))
+            precache_reserved_memory.set(self._reserved_memory)
+            precache_reserved_disk.set(self._reserved_disk)
+            self._wakeup.set()
+
+    async def process_once(self) -> bool:
+        """Start the next job, if it fits in the budget.
+
+        Returns:
+          whether the queue was modified
+        """
+        job = await self.queue.peek()
+        precache_queue_length.set(await self.queue.size())
+        if job is None:
+            return False
+        if job in self._running:
+            # Already running; it will pick up the result when it's done
+            await self.queue.remove(*job)
+            return True
+        memory = self.job_memory
+        disk = sum(self.artifact_size(run_id) for run_id in job)
+        if not self._fits(memory, disk):
+            return False
+        if not await self.queue.remove(*job):
+            # Taken by another instance
+            return True
+        self._running[job] = {
+            "memory": memory,
+            "disk": disk,
+            "sizes": {},
+            "start_time": time.time(),
+        }
+        self._reserved_memory += memory
+        self._reserved_disk += disk
+        precache_running_count.set(len(self._running))
+        precache_reserved_memory.set(self._reserved_memory)
+        precache_reserved_disk.set(self._reserved_disk)
+        self._running[job]["task"] = asyncio.create_task(self._run(job))
+        return True
+
+    async def process(self) -> None:
+        while True:
+            try:
+                progressed = await self.process_once()
+            except Exception:
+                logging.exception("Error processing precache queue")
+                progressed = False
+            if not progressed:
+                await self._wait()
+
+    async def status(self) -> dict:
+        return {
+            "queued": await self.queue.size(),
+            "running": [
+                {
+                    "old_id": old_id,
+                    "new_id": new_id,
+                    "start_time": info["start_time"],
+                }
+                for (old_id, new_id), info in self._running.items()
+            ],
+            "completed": self.completed,
+            "failed": self.failed,
+            "reserved_memory": self._reserved_memory,
+            "memory_budget": self.memory_budget,
+            "reserved_disk": self._reserved_disk,
+            "disk_budget": self.disk_budget,
+            "max_running": self.max_running,
+        }
+
+    def start(self) -> None:
+        self._task = asyncio.create_task(self.process())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        for info in list(self._running.values()):
+            info["task"].cancel()
+        if self._running:
+            await asyncio.gather(
+                *[info["task"] for info in self._running.values()],
+                return_exceptions=True,
+            )
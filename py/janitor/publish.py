@@ -29,7 +29,7 @@ import sys
 import time
 import uuid
 import warnings
-from collections.abc import AsyncIterable, Iterator
+from collections.abc import AsyncGenerator, Iterator
 from contextlib import AsyncExitStack
 from dataclasses import dataclass
 from datetime import datetime, timedelta
@@ -93,6 +93,7 @@ from ._publish import (
     role_branch_url,
 )
 from .config import Campaign, Config, get_campaign_config, read_config
+from .forge_cache import ForgeResponseCache, install_forge_response_cache
 from .schedule import CandidateUnavailable, do_schedule, do_schedule_control
 from .vcs import VcsManager, get_vcs_managers_from_config
 
@@ -205,8 +206,26 @@ unexpected_http_response_count = Counter(
 )
 
 
+publish_status_queue_depth = Gauge(
+    "publish_status_queue_depth",
+    "Number of publish-status events waiting to be processed",
+)
+publish_status_processing_lag = Histogram(
+    "publish_status_processing_lag",
+    "Delay between receiving a publish-status event and processing it",
+)
+publish_status_superseded_count = Counter(
+    "publish_status_superseded_count",
+    "Number of publish-status events dropped because a newer event for the "
+    "same run arrived before they were processed",
+)
+
+
 CLOSED_STATUSES = ["closed", "abandoned", "rejected", "applied"]
 
+# Publish result codes that don't count towards the exponential backoff
+TRANSIENT_PUBLISH_RESULT_CODES = {"differ-unreachable"}
+
 
 logger = logging.getLogger("janitor.publish")
 
@@ -446,6 +465,8 @@ async def consider_publish_run(
     command: str,
     push_limit: Optional[int] = None,
     require_binary_diff: bool = False,
+    attempt_count: Optional[int] = None,
+    last_mps: Optional[list[tuple[str, str]]] = None,
 ) -> dict[str, Optional[str]]:
     if run.revision is None:
         logger.warning(
@@ -455,9 +476,10 @@ async def consider_publish_run(
         )
         return {}
     campaign_config = get_campaign_config(config, run.campaign)
-    attempt_count = await get_publish_attempt_count(
-        conn, run.revision, {"differ-unreachable"}
-    )
+    if attempt_count is None:
+        attempt_count = await get_publish_attempt_count(
+            conn, run.revision, TRANSIENT_PUBLISH_RESULT_CODES
+        )
     next_try_time = calculate_next_try_time(run.finish_time, attempt_count)
     if datetime.utcnow() < next_try_time:
         logger.info(
@@ -493,9 +515,8 @@ async def consider_publish_run(
         # TODO(jelmer): Support target_branch_url ?
         return {}
 
-    last_mps: list[tuple[str, str]] = await get_previous_mp_status(
-        conn, run.codebase, run.campaign
-    )
+    if last_mps is None:
+        last_mps = await get_previous_mp_status(conn, run.codebase, run.campaign)
     if any(last_mp[1] in ("rejected", "closed") for last_mp in last_mps):
         logger.warning(
             "%s: last merge proposal was rejected by maintainer: %r",
@@ -556,11 +577,29 @@ async def consider_publish_run(
     return actual_modes
 
 
+def _publish_ready_entry(record):
+    return (
+        state.Run.from_row(record),
+        record["rate_limit_bucket"],
+        record["policy_command"],
+        record["unpublished_branches"],
+        record["publish_attempt_count"],
+        list(
+            zip(
+                record["previous_mp_urls"] or [],
+                record["previous_mp_statuses"] or [],
+            )
+        ),
+    )
+
+
 async def iter_publish_ready(
     conn: asyncpg.Connection,
     *,
     run_id: Optional[str] = None,
-) -> AsyncIterable[
+    prefetch: int = 50,
+    chunk_size: Optional[int] = None,
+) -> AsyncGenerator[
     tuple[
         state.Run,
         str,
@@ -577,16 +616,35 @@ async def iter_publish_ready(
                 Optional[str],
             ]
         ],
-    ]
+        int,
+        list[tuple[str, str]],
+    ],
+    None,
 ]:
+    """Iterate over runs that are ready to be published.
+
+    Besides the run itself, this yields the publish attempt count for the
+    run's revision and the status of the merge proposals for the last
+    successful run with a closed merge proposal, so that callers can decide
+    to skip a run (backoff, rejected proposals) without further queries.
+
+    By default, rows are streamed from a server-side cursor, ``prefetch`` rows
+    at a time. The cursor keeps a transaction open on ``conn`` until iteration
+    finishes, so ``conn`` can't be used for anything else in the meantime.
+    Callers that may stop iterating early should close the generator
+    explicitly (``aclose()``) rather than leaving that to garbage collection.
+
+    If ``chunk_size`` is set, only the ids of the ready runs are retrieved
+    upfront and the runs themselves are retrieved ``chunk_size`` at a time,
+    without holding a transaction open. Runs that are no longer ready by the
+    time their chunk is retrieved are skipped, and ``conn`` may be used for
+    other queries in between.
+    """
     args: list[Any] = []
-    query = """
-SELECT * FROM publish_ready
-"""
     conditions = []
     if run_id is not None:
         args.append(run_id)
-        conditions.append(f"id = ${len(args)}")
+        conditions.append(f"publish_ready.id = ${len(args)}")
     conditions.append("publish_status = 'approved'")
     conditions.append("change_set_state IN ('ready', 'publishing')")
 
@@ -597,25 +655,80 @@ SELECT * FROM publish_ready
 
     conditions.append(any_publishable_branches)
 
-    if conditions:
-        query += " WHERE " + " AND ".join(conditions)
-
     order_by = ["change_set_state = 'publishing' DESC"]
 
     order_by.extend(["value DESC NULLS LAST", "finish_time DESC"])
 
-    if order_by:
-        query += " ORDER BY " + ", ".join(order_by) + " "
-
-    for record in await conn.fetch(query, *args):
-        yield tuple(  # type: ignore
-            [
-                state.Run.from_row(record),
-                record["rate_limit_bucket"],
-                record["policy_command"],
-                record["unpublished_branches"],
-            ]
+    def build_query(columns, from_clause, conditions):
+        query = f"SELECT {columns} FROM {from_clause}"
+        if conditions:
+            query += " WHERE " + " AND ".join(conditions)
+        if order_by:
+            query += " ORDER BY " + ", ".join(order_by) + " "
+        return query
+
+    # The transient result codes are always the last but one argument,
+    # since the chunked query adds the list of ids after it.
+    transient_arg = len(args) + 1
+    columns = """
+  publish_ready.*,
+  attempts.publish_attempt_count,
+  previous_mps.previous_mp_urls,
+  previous_mps.previous_mp_statuses"""
+    from_clause = f"""
+publish_ready
+LEFT JOIN LATERAL (
+  SELECT count(*) AS publish_attempt_count
+  FROM publish
+  WHERE publish.revision = publish_ready.revision
+  AND publish.result_code != ALL(${transient_arg}::text[])
+) AS attempts ON TRUE
+LEFT JOIN LATERAL (
+  SELECT
+    array_agg(merge_proposal.url) AS previous_mp_urls,
+    array_agg(merge_proposal.status) AS previous_mp_statuses
+  FROM merge_proposal
+  WHERE merge_proposal.status NOT IN ('open', 'abandoned')
+  AND merge_proposal.revision = (
+    SELECT previous_run.revision
+    FROM run AS previous_run
+    INNER JOIN merge_proposal AS previous_mp
+    ON previous_mp.revision = previous_run.revision
+    WHERE previous_run.codebase = publish_ready.codebase
+    AND previous_run.suite = publish_ready.suite
+    AND previous_run.result_code = 'success'
+    AND previous_mp.status NOT IN ('open', 'abandoned')
+    ORDER BY previous_run.finish_time DESC
+    LIMIT 1)
+) AS previous_mps ON TRUE
+"""
+    transient_result_codes = list(TRANSIENT_PUBLISH_RESULT_CODES)
+
+    if chunk_size is None:
+        query = build_query(columns, from_clause, conditions)
+        async with conn.transaction(readonly=True):
+            async for record in conn.cursor(
+                query, *args, transient_result_codes, prefetch=prefetch
+            ):
+                yield _publish_ready_entry(record)  # type: ignore
+        return
+
+    ids = [
+        row[0]
+        for row in await conn.fetch(
+            build_query("publish_ready.id", "publish_ready", conditions), *args
         )
+    ]
+    chunk_query = build_query(
+        columns,
+        from_clause,
+        [*conditions, f"publish_ready.id = ANY(${transient_arg + 1}::text[])"],
+    )
+    for i in range(0, len(ids), chunk_size):
+        for record in await conn.fetch(
+            chunk_query, *args, transient_result_codes, ids[i : i + chunk_size]
+        ):
+            yield _publish_ready_entry(record)  # type: ignore
 
 
 async def publish_pending_ready(
@@ -628,17 +741,31 @@ async def publish_pending_ready(
     vcs_managers,
     push_limit: Optional[int] = None,
     require_binary_diff: bool = False,
+    chunk_size: Optional[int] = None,
 ):
     start = time.time()
     actions: dict[Optional[str], int] = {}
 
-    async with db.acquire() as conn1, db.acquire() as conn:
+    async with AsyncExitStack() as es:
+        conn = await es.enter_async_context(db.acquire())
+        if chunk_size is None:
+            # The cursor keeps its connection busy, so use a separate one
+            # for processing the runs.
+            ready_conn = await es.enter_async_context(db.acquire())
+        else:
+            ready_conn = conn
+        ready = iter_publish_ready(ready_conn, chunk_size=chunk_size)
+        # Close the cursor (and its transaction) before the connections are
+        # released, also when bailing out early.
+        es.push_async_callback(ready.aclose)
         async for (
             run,
             rate_limit_bucket,
             command,
             unpublished_branches,
-        ) in iter_publish_ready(conn1):
+            attempt_count,
+            last_mps,
+        ) in ready:
             actual_modes = await consider_publish_run(
                 conn,
                 redis=redis,
@@ -652,6 +779,8 @@ async def publish_pending_ready(
                 unpublished_branches=unpublished_branches,
                 push_limit=push_limit,
                 require_binary_diff=require_binary_diff,
+                attempt_count=attempt_count,
+                last_mps=last_mps,
             )
             for actual_mode in actual_modes.values():
                 if actual_mode is None:
@@ -1573,15 +1702,21 @@ async def consider_request(request):
 
     async def run():
         async with request.app["db"].acquire() as conn:
-            async for (
-                run,
-                rate_limit_bucket,
-                command,
-                unpublished_branches,
-            ) in iter_publish_ready(conn, run_id=run_id):
-                break
-            else:
-                return
+            ready = iter_publish_ready(conn, run_id=run_id, chunk_size=1)
+            try:
+                async for (
+                    run,
+                    rate_limit_bucket,
+                    command,
+                    unpublished_branches,
+                    attempt_count,
+                    last_mps,
+                ) in ready:
+                    break
+                else:
+                    return
+            finally:
+                await ready.aclose()
             await consider_publish_run(
                 conn,
                 redis=request.app["redis"],
@@ -1594,6 +1729,8 @@ async def consider_request(request):
                 rate_limit_bucket=rate_limit_bucket,
                 unpublished_branches=unpublished_branches,
                 require_binary_diff=request.app["require_binary_diff"],
+                attempt_count=attempt_count,
+                last_mps=last_mps,
             )
 
     await spawn(request, run())
@@ -2043,7 +2180,9 @@ WHERE run.id = $1
         if run["revision"] is not None:
             with span.new_child("sql:publish-attempt-count"):
                 attempt_count = await get_publish_attempt_count(
-                    conn, run["revision"].encode("utf-8"), {"differ-unreachable"}
+                    conn,
+                    run["revision"].encode("utf-8"),
+                    TRANSIENT_PUBLISH_RESULT_CODES,
                 )
         else:
             attempt_count = 0
@@ -2135,6 +2274,7 @@ async def process_queue_loop(
     push_limit: Optional[int] = None,
     modify_mp_limit: Optional[int] = None,
     require_binary_diff: bool = False,
+    ready_chunk_size: Optional[int] = None,
 ):
     while True:
         cycle_start = datetime.utcnow()
@@ -2160,6 +2300,7 @@ async def process_queue_loop(
                 vcs_managers=vcs_managers,
                 push_limit=push_limit,
                 require_binary_diff=require_binary_diff,
+                chunk_size=ready_chunk_size,
             )
         cycle_duration = datetime.utcnow() - cycle_start
         to_wait = max(0, interval - cycle_duration.total_seconds())
@@ -3402,6 +3543,53 @@ ORDER BY start_time DESC
     ]
 
 
+class PublishStatusDispatcher:
+    """Dispatch publish-status events to a bounded number of workers.
+
+    Events for the same codebase are processed one at a time, in the order in
+    which they were received. An event for a run that hasn't been processed
+    yet is superseded by any newer event for the same run.
+    """
+
+    def __init__(self, handler, *, concurrency: int = 4) -> None:
+        self._handler = handler
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._pending: dict[str, dict[str, tuple[Any, float]]] = {}
+        self._tasks: dict[str, asyncio.Task] = {}
+
+    def submit(self, codebase: str, run_id: str, event: Any) -> None:
+        pending = self._pending.setdefault(codebase, {})
+        if run_id in pending:
+            publish_status_superseded_count.inc()
+            del pending[run_id]
+        else:
+            publish_status_queue_depth.inc()
+        pending[run_id] = (event, time.monotonic())
+        if codebase not in self._tasks:
+            self._tasks[codebase] = asyncio.create_task(self._process(codebase))
+
+    async def _process(self, codebase: str) -> None:
+        pending = self._pending[codebase]
+        try:
+            while pending:
+                async with self._semaphore:
+                    run_id = next(iter(pending))
+                    event, received = pending.pop(run_id)
+                    publish_status_queue_depth.dec()
+                    publish_status_processing_lag.observe(time.monotonic() - received)
+                    try:
+                        await self._handler(event)
+                    except Exception:
+                        logger.exception(
+                            "Error processing publish-status event for %s",
+                            run_id,
+                            extra={"run_id": run_id},
+                        )
+        finally:
+            del self._pending[codebase]
+            del self._tasks[codebase]
+
+
 async def listen_to_runner(
     *,
     db,
@@ -3411,6 +3599,7 @@ async def listen_to_runner(
     bucket_rate_limiter,
     vcs_managers,
     require_binary_diff: bool = False,
+    concurrency: int = 4,
 ):
     async def process_run(conn, run, branch_url):
         publish_policy, command, rate_limit_bucket = await get_publish_policy(
@@ -3441,10 +3630,7 @@ async def listen_to_runner(
                 requester="runner",
             )
 
-    async def handle_publish_status_message(msg):
-        result = json.loads(msg["data"])
-        if result["publish_status"] != "approved":
-            return
+    async def process_publish_status(result):
         async with db.acquire() as conn:
             # TODO(jelmer): Fold these into a single query ?
             codebase = await conn.fetchrow(
@@ -3456,6 +3642,16 @@ async def listen_to_runner(
             run = await get_run(conn, result["run_id"])
             await process_run(conn, run, codebase["branch_url"])
 
+    dispatcher = PublishStatusDispatcher(
+        process_publish_status, concurrency=concurrency
+    )
+
+    async def handle_publish_status_message(msg):
+        result = json.loads(msg["data"])
+        if result["publish_status"] != "approved":
+            return
+        dispatcher.submit(result["codebase"], result["run_id"], result)
+
     try:
         async with redis.pubsub(ignore_subscribe_messages=True) as ch:
             await ch.subscribe(
@@ -3538,6 +3734,16 @@ async def main_async(argv=None):
         default=False,
         help="Require a binary diff when publishing merge requests",
     )
+    parser.add_argument(
+        "--ready-chunk-size",
+        type=int,
+        default=None,
+        help=(
+            "Retrieve publish-ready runs in chunks of this size rather than "
+            "streaming them from a cursor that keeps a transaction open "
+            "for the whole cycle"
+        ),
+    )
     parser.add_argument(
         "--modify-mp-limit",
         type=int,
@@ -3554,6 +3760,25 @@ async def main_async(argv=None):
     parser.add_argument(
         "--template-env-path", type=str, help="Path to merge proposal templates"
     )
+    parser.add_argument(
+        "--publish-status-concurrency",
+        type=int,
+        default=4,
+        help="Maximum number of publish-status events to process concurrently",
+    )
+    parser.add_argument(
+        "--forge-cache-path",
+        type=str,
+        default=None,
+        help="Path to cache forge API responses in, revalidated with "
+        "conditional requests",
+    )
+    parser.add_argument(
+        "--forge-cache-max-size",
+        type=int,
+        default=100,
+        help="Maximum size of the forge API response cache (in MB)",
+    )
     parser.add_argument(
         "--gcp-logging", action="store_true", help="Use Google cloud logging"
     )
@@ -3586,6 +3811,13 @@ async def main_async(argv=None):
 
     set_user_agent(config.user_agent)
 
+    if args.forge_cache_path:
+        install_forge_response_cache(
+            ForgeResponseCache(
+                args.forge_cache_path, max_size=args.forge_cache_max_size * 1024**2
+            )
+        )
+
     bucket_rate_limiter: RateLimiter
     if args.slowstart:
         bucket_rate_limiter = SlowStartRateLimiter(args.max_mps_per_bucket)
@@ -3626,6 +3858,7 @@ async def main_async(argv=None):
                 bucket_rate_limiter=bucket_rate_limiter,
                 vcs_managers=vcs_managers,
                 require_binary_diff=args.require_binary_diff,
+                chunk_size=args.ready_chunk_size,
             )
             if args.prometheus:
                 await push_to_gateway(
@@ -3647,6 +3880,7 @@ async def main_async(argv=None):
                         push_limit=args.push_limit,
                         modify_mp_limit=args.modify_mp_limit,
                         require_binary_diff=args.require_binary_diff,
+                        ready_chunk_size=args.ready_chunk_size,
                     )
                 ),
                 loop.create_task(
@@ -3679,6 +3913,7 @@ async def main_async(argv=None):
                         bucket_rate_limiter=bucket_rate_limiter,
                         vcs_managers=vcs_managers,
                         require_binary_diff=args.require_binary_diff,
+                        concurrency=args.publish_status_concurrency,
                     )
                 )
             )
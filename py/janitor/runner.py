@@ -256,6 +256,8 @@ class DebianResult(BuilderResult):
         self.binary_packages = binary_packages
         self.changes_filenames = changes_filenames
         self.lintian_result = lintian_result
+        self.binary_stanzas = None
+        self.source_stanzas = None
 
     def from_directory(self, path):
         from .debian import NoChangesFile, find_changes
@@ -282,6 +284,25 @@ class DebianResult(BuilderResult):
                 self.build_distribution,
                 self.binary_packages,
             )
+            self._scan_package_index(path)
+
+    def _scan_package_index(self, path):
+        from .debian.scan import scan_deb, scan_dsc
+
+        binary_stanzas = []
+        source_stanzas = []
+        try:
+            for name in self.artifact_filenames():
+                if name.endswith(".deb"):
+                    binary_stanzas.append(scan_deb(os.path.join(path, name)))
+                elif name.endswith(".dsc"):
+                    source_stanzas.append(scan_dsc(os.path.join(path, name)))
+        except (OSError, ValueError) as e:
+            # The archive will fall back to scanning the artifacts
+            logging.warning("Unable to generate package index stanzas: %s", e)
+        else:
+            self.binary_stanzas = binary_stanzas
+            self.source_stanzas = source_stanzas
 
     def artifact_filenames(self):
         if not self.changes_filenames:
@@ -311,6 +332,20 @@ class DebianResult(BuilderResult):
                 self.lintian_result,
                 self.binary_packages,
             )
+            if self.binary_stanzas is not None:
+                from .debian.scan import package_index, run_directory
+
+                index = package_index(
+                    self.binary_stanzas,
+                    self.source_stanzas,
+                    run_directory(self.build_distribution, self.source, run_id),
+                )
+                await conn.executemany(
+                    "INSERT INTO debian_package_index "
+                    "(run_id, architecture, stanzas) VALUES ($1, $2, $3) "
+                    "ON CONFLICT DO NOTHING",
+                    [(run_id, arch, stanzas) for (arch, stanzas) in index.items()],
+                )
 
     def json(self):
         return {
@@ -2852,7 +2887,9 @@ async def finish(
             )
 
         if result.builder_result is not None:
-            result.builder_result.from_directory(output_directory)
+            await asyncio.to_thread(
+                result.builder_result.from_directory, output_directory
+            )
 
             artifact_names = result.builder_result.artifact_filenames()
             with span.new_child("upload-artifacts-with-backup"):
@@ -0,0 +1,134 @@
+#!/usr/bin/python3
+# Copyright (C) 2024 Jelmer Vernooij <jelmer@jelmer.uk>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+"""Coalescing of concurrent identical computations."""
+
+__all__ = [
+    "SingleFlight",
+]
+
+import asyncio
+import logging
+from collections.abc import Awaitable, Hashable
+from typing import Callable, Generic, Optional, TypeVar
+
+import aioredlock
+from aiohttp_openmetrics import Counter
+
+T = TypeVar("T")
+
+single_flight_coalesced_count = Counter(
+    "single_flight_coalesced_count",
+    "Number of requests that waited for an identical in-flight computation",
+    labelnames=("kind",),
+)
+single_flight_lock_wait_count = Counter(
+    "single_flight_lock_wait_count",
+    "Number of computations that waited for another process to finish",
+    labelnames=("kind",),
+)
+
+
+class SingleFlight(Generic[T]):
+    """Run at most one computation per key at a time.
+
+    Callers that ask for a key that is already being computed wait for
+    the result of the in-flight computation rather than starting their own.
+
+    If a lock manager is specified, the computation is also serialized
+    across processes using a Redis lock. The computation function should
+    then check whether another process has already produced the result
+    (e.g. by looking in a shared cache) before doing any work.
+    """
+
+    def __init__(
+        self,
+        lock_manager: Optional[aioredlock.Aioredlock] = None,
+        *,
+        lock_prefix: str = "single-flight",
+        lock_wait: float = 3600.0,
+        lock_poll_interval: float = 1.0,
+    ) -> None:
+        self.lock_manager = lock_manager
+        self.lock_prefix = lock_prefix
+        self.lock_wait = lock_wait
+        self.lock_poll_interval = lock_poll_interval
+        self._inflight: dict[Hashable, asyncio.Task[T]] = {}
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._inflight
+
+    def _lock_name(self, key: Hashable) -> str:
+        if isinstance(key, tuple):
+            return ":".join([self.lock_prefix] + [str(k) for k in key])
+        return f"{self.lock_prefix}:{key}"
+
+    async def _run_locked(self, key: Hashable, fn: Callable[[], Awaitable[T]]) -> T:
+        if self.lock_manager is None:
+            return await fn()
+        kind = key[0] if isinstance(key, tuple) else key
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.lock_wait
+        waited = False
+        while True:
+            try:
+                lock = await self.lock_manager.lock(self._lock_name(key))
+            except aioredlock.LockError:
+                if loop.time() > deadline:
+                    logging.warning(
+                        "Timed out waiting for lock on %r; computing anyway", key
+                    )
+                    return await fn()
+                if not waited:
+                    single_flight_lock_wait_count.labels(kind=str(kind)).inc()
+                    waited = True
+                await asyncio.sleep(self.lock_poll_interval)
+            else:
+                async with lock:
+                    return await fn()
+
+    async def do(self, key: Hashable, fn: Callable[[], Awaitable[T]]) -> T:
+        """Return the result of fn, sharing it with concurrent callers for key.
+
+        Args:
+          key: Key identifying the computation; the first element of a tuple
+            key is used as the "kind" label in metrics
+          fn: Function that performs the computation
+        Returns:
+          result of the (possibly shared) computation
+        """
+        try:
+            task = self._inflight[key]
+        except KeyError:
+            task = asyncio.create_task(self._run_locked(key, fn))
+            self._inflight[key] = task
+
+            def done(task):
+                if self._inflight.get(key) is task:
+                    del self._inflight[key]
+                # Make sure exceptions are considered retrieved even if all
+                # callers have gone away.
+                if not task.cancelled():
+                    task.exception()
+
+            task.add_done_callback(done)
+        else:
+            kind = key[0] if isinstance(key, tuple) else key
+            single_flight_coalesced_count.labels(kind=str(kind)).inc()
+        # Shield the computation, so that a caller going away (e.g. a client
+        # disconnecting) does not cancel it for the other callers.
+        return await asyncio.shield(task)
@@ -17,6 +17,7 @@
 
 __all__ = [
     "iter_publishable_suites",
+    "check_publish_ready",
 ]
 
 import datetime
@@ -239,6 +240,32 @@ WHERE codebase = $1
     return [row[0] for row in await conn.fetch(query, codebase)]
 
 
+async def check_publish_ready(
+    conn: asyncpg.Connection, *, repair: bool = False
+) -> list[tuple[str, str]]:
+    """Check the publish_ready table against its reference view.
+
+    Args:
+      conn: Database connection
+      repair: Whether to refresh the entries that are out of date
+    Returns:
+      list of (codebase, campaign) tuples for which publish_ready differs
+    """
+    inconsistent = [
+        (row["codebase"], row["campaign"])
+        for row in await conn.fetch(
+            "SELECT codebase, campaign FROM check_publish_ready()"
+        )
+    ]
+    if repair:
+        async with conn.transaction():
+            for codebase, campaign in inconsistent:
+                await conn.execute(
+                    "SELECT refresh_publish_ready($1, $2)", codebase, campaign
+                )
+    return inconsistent
+
+
 async def has_cotenants(
     conn: asyncpg.Connection, codebase: str, url: str
 ) -> Optional[bool]:
@@ -561,9 +561,14 @@ CREATE TYPE result_branch_with_policy AS (
   mode publish_mode,
   frequency_days integer);
 
-CREATE OR REPLACE VIEW publish_ready AS
+-- Reference definition of publish_ready; the publish_ready table below is
+-- kept in sync with this view by triggers. Use check_publish_ready() to
+-- compare the two.
+CREATE OR REPLACE VIEW publish_ready_view AS
 WITH publishable AS (
-  SELECT
+  -- A codebase/campaign can have a candidate per change set; use a single
+  -- one per run, preferring the candidate for the run's own change set.
+  SELECT DISTINCT ON (run.id)
   run.id AS id,
   run.command AS command,
   run.start_time AS start_time,
@@ -609,9 +614,161 @@ INNER JOIN named_publish_policy ON
     candidate.publish_policy = named_publish_policy.name
 INNER JOIN change_set ON change_set.id = run.change_set
 WHERE
-  result_code = 'success')
+  result_code = 'success'
+ORDER BY
+  run.id,
+  candidate.change_set IS NOT DISTINCT FROM run.change_set DESC,
+  candidate.change_set IS NULL DESC,
+  candidate.id)
 SELECT * FROM publishable WHERE ARRAY_LENGTH(unpublished_branches, 1) > 0;
 
+CREATE TABLE publish_ready AS SELECT * FROM publish_ready_view WITH NO DATA;
+ALTER TABLE publish_ready ADD PRIMARY KEY (id);
+CREATE INDEX ON publish_ready (codebase, suite);
+CREATE INDEX ON publish_ready (publish_status, change_set_state, value);
+CREATE INDEX ON publish_ready (change_set);
+-- Populate the table for databases that already have runs; from here on
+-- the triggers below keep it up to date.
+INSERT INTO publish_ready SELECT * FROM publish_ready_view;
+
+CREATE OR REPLACE FUNCTION refresh_publish_ready(_codebase text, _campaign text)
+  RETURNS void
+  LANGUAGE PLPGSQL
+  AS $$
+    BEGIN
+    DELETE FROM publish_ready WHERE codebase = _codebase AND suite = _campaign;
+    INSERT INTO publish_ready
+        SELECT * FROM publish_ready_view
+        WHERE codebase = _codebase AND suite = _campaign;
+    END;
+$$;
+
+CREATE OR REPLACE FUNCTION run_trigger_refresh_publish_ready()
+  RETURNS TRIGGER
+  LANGUAGE PLPGSQL
+  AS $$
+    BEGIN
+    IF TG_OP IN ('UPDATE', 'DELETE') THEN
+      PERFORM refresh_publish_ready(OLD.codebase, OLD.suite::text);
+    END IF;
+    IF TG_OP = 'INSERT' OR (TG_OP = 'UPDATE' AND (
+            OLD.codebase != NEW.codebase OR OLD.suite != NEW.suite)) THEN
+      PERFORM refresh_publish_ready(NEW.codebase, NEW.suite::text);
+    END IF;
+    RETURN NEW;
+    END;
+$$;
+
+-- Note that this has to run after run_refresh_last_run, which it does
+-- since triggers fire in alphabetical order.
+CREATE OR REPLACE TRIGGER run_refresh_publish_ready
+  AFTER INSERT OR UPDATE OR DELETE
+  ON run
+  FOR EACH ROW
+  EXECUTE FUNCTION run_trigger_refresh_publish_ready();
+
+CREATE OR REPLACE FUNCTION new_result_branch_trigger_refresh_publish_ready()
+  RETURNS TRIGGER
+  LANGUAGE PLPGSQL
+  AS $$
+    DECLARE row RECORD;
+    BEGIN
+    IF TG_OP IN ('UPDATE', 'DELETE') THEN
+      SELECT codebase, suite INTO row FROM run WHERE id = OLD.run_id;
+      IF FOUND THEN
+        PERFORM refresh_publish_ready(row.codebase, row.suite::text);
+      END IF;
+    END IF;
+    IF TG_OP = 'INSERT' OR (TG_OP = 'UPDATE' AND OLD.run_id != NEW.run_id) THEN
+      SELECT codebase, suite INTO row FROM run WHERE id = NEW.run_id;
+      IF FOUND THEN
+        PERFORM refresh_publish_ready(row.codebase, row.suite::text);
+      END IF;
+    END IF;
+    RETURN NEW;
+    END;
+$$;
+
+CREATE OR REPLACE TRIGGER new_result_branch_refresh_publish_ready
+  AFTER INSERT OR UPDATE OR DELETE
+  ON new_result_branch
+  FOR EACH ROW
+  EXECUTE FUNCTION new_result_branch_trigger_refresh_publish_ready();
+
+CREATE OR REPLACE FUNCTION candidate_trigger_refresh_publish_ready()
+  RETURNS TRIGGER
+  LANGUAGE PLPGSQL
+  AS $$
+    BEGIN
+    IF TG_OP IN ('UPDATE', 'DELETE') THEN
+      PERFORM refresh_publish_ready(OLD.codebase, OLD.suite::text);
+    END IF;
+    IF TG_OP = 'INSERT' OR (TG_OP = 'UPDATE' AND (
+            OLD.codebase != NEW.codebase OR OLD.suite != NEW.suite)) THEN
+      PERFORM refresh_publish_ready(NEW.codebase, NEW.suite::text);
+    END IF;
+    RETURN NEW;
+    END;
+$$;
+
+CREATE OR REPLACE TRIGGER candidate_refresh_publish_ready
+  AFTER INSERT OR UPDATE OR DELETE
+  ON candidate
+  FOR EACH ROW
+  EXECUTE FUNCTION candidate_trigger_refresh_publish_ready();
+
+CREATE OR REPLACE FUNCTION named_publish_policy_trigger_refresh_publish_ready()
+  RETURNS TRIGGER
+  LANGUAGE PLPGSQL
+  AS $$
+    DECLARE row RECORD;
+    BEGIN
+    FOR row IN SELECT codebase, suite FROM candidate WHERE publish_policy = NEW.name LOOP
+      PERFORM refresh_publish_ready(row.codebase, row.suite::text);
+    END LOOP;
+    RETURN NEW;
+    END;
+$$;
+
+CREATE OR REPLACE TRIGGER named_publish_policy_refresh_publish_ready
+  AFTER UPDATE
+  ON named_publish_policy
+  FOR EACH ROW
+  EXECUTE FUNCTION named_publish_policy_trigger_refresh_publish_ready();
+
+-- Publishing (and absorbing) only affects publish_ready through the state of
+-- the change set, which is all this needs to propagate.
+CREATE OR REPLACE FUNCTION change_set_trigger_refresh_publish_ready()
+  RETURNS TRIGGER
+  LANGUAGE PLPGSQL
+  AS $$
+    BEGIN
+    UPDATE publish_ready SET change_set_state = NEW.state WHERE change_set = NEW.id;
+    RETURN NEW;
+    END;
+$$;
+
+CREATE OR REPLACE TRIGGER change_set_refresh_publish_ready
+  AFTER UPDATE OF state
+  ON change_set
+  FOR EACH ROW
+  WHEN (OLD.state IS DISTINCT FROM NEW.state)
+  EXECUTE FUNCTION change_set_trigger_refresh_publish_ready();
+
+-- Compare the publish_ready table against the publish_ready_view
+-- definition, returning the codebase/campaign combinations that differ.
+CREATE OR REPLACE FUNCTION check_publish_ready()
+  RETURNS TABLE (codebase text, campaign text)
+  LANGUAGE SQL
+  AS $$
+    SELECT DISTINCT
+        coalesce(t.codebase, v.codebase)::text,
+        coalesce(t.suite, v.suite)::text
+    FROM publish_ready AS t
+    FULL OUTER JOIN publish_ready_view AS v ON t.id = v.id
+    WHERE t.id IS NULL OR v.id IS NULL OR t::text != v::text;
+$$;
+
 CREATE TABLE IF NOT EXISTS review (
  run_id text not null references run (id),
  comment text,
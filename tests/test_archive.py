@@ -16,14 +16,36 @@
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
 
 
+import asyncio
+import gzip
 import hashlib
+import lzma
 import os
+from contextlib import asynccontextmanager
+from datetime import datetime
 from tempfile import TemporaryDirectory
+from types import SimpleNamespace
 
+import pytest
 from debian.deb822 import Release
 
+from janitor.artifacts import ArtifactsMissing
 from janitor.config import read_string as read_config_string
-from janitor.debian.archive import HashedFileWriter, create_app
+from janitor.debian.archive import (
+    DatabasePackageInfoProvider,
+    DiskCachingPackageInfoProvider,
+    GeneratorManager,
+    HashedFileWriter,
+    OnDemandDists,
+    PackageInfoProvider,
+    ReleaseSigner,
+    builds_fingerprint,
+    cleanup_by_hash_files,
+    create_app,
+    parse_compression,
+    prefetch_ordered,
+    write_suite_files,
+)
 
 
 async def create_client(aiohttp_client, config=None):
@@ -65,3 +87,469 @@ def test_hash_file_writer():
         with open(os.path.join(td, "foo", "bar"), "rb") as f:
             assert f.read() == b"chunk1chunk2"
         assert r["MD5Sum"] == [{"md5sum": md5hex, "name": "foo/bar", "size": 12}]
+
+
+async def test_prefetch_ordered():
+    running = 0
+    max_running = 0
+
+    async def fetch(i):
+        nonlocal running, max_running
+        running += 1
+        max_running = max(max_running, running)
+        # Later items finish first
+        await asyncio.sleep(0.01 * (10 - i))
+        running -= 1
+        return i
+
+    results = [r async for r in prefetch_ordered(range(10), fetch, 3)]
+    assert results == list(range(10))
+    assert max_running == 3
+
+
+def test_hash_file_writer_compressed():
+    with TemporaryDirectory() as td:
+        r = Release()
+        with HashedFileWriter(
+            r, td, "foo/bar.gz", lambda f: gzip.GzipFile(fileobj=f, mode="wb")
+        ) as w:
+            w.write(b"chunk1")
+            w.done()
+        with open(os.path.join(td, "foo", "bar.gz"), "rb") as f:
+            data = f.read()
+        assert gzip.decompress(data) == b"chunk1"
+        sha256hex = hashlib.sha256(data).hexdigest()
+        assert r["SHA256"] == [
+            {"sha256": sha256hex, "name": "foo/bar.gz", "size": len(data)}
+        ]
+        # The by-hash file is a hardlink to the published file
+        by_hash_path = os.path.join(td, "foo", "by-hash", "SHA256", sha256hex)
+        assert os.path.samefile(by_hash_path, os.path.join(td, "foo", "bar.gz"))
+
+
+def test_cleanup_by_hash_files():
+    with TemporaryDirectory() as td:
+        for contents in [b"old", b"new"]:
+            r = Release()
+            with HashedFileWriter(r, td, "bar") as w:
+                w.write(contents)
+                w.done()
+        md5_dir = os.path.join(td, "by-hash", "MD5Sum")
+        old_path = os.path.join(md5_dir, hashlib.md5(b"old").hexdigest())
+        os.utime(old_path, (0, 0))
+        cleanup_by_hash_files(td, 3600)
+        assert os.listdir(md5_dir) == [hashlib.md5(b"new").hexdigest()]
+        with open(os.path.join(td, "bar"), "rb") as f:
+            assert f.read() == b"new"
+
+
+def test_parse_compression():
+    assert parse_compression("gz,xz", ["xz=9"]) == {"gz": None, "xz": 9}
+    assert parse_compression("", []) == {}
+    with pytest.raises(ValueError):
+        parse_compression("rar", [])
+    with pytest.raises(ValueError):
+        parse_compression("gz", ["xz=9"])
+    with pytest.raises(ValueError):
+        parse_compression("gz", ["gz"])
+
+
+async def test_write_suite_files_compression(tmp_path):
+    async def get_packages(suite, component, arch):
+        yield b"Package: foo\n\n"
+
+    async def get_sources(suite, component):
+        yield b"Package: foo\n\n"
+
+    await write_suite_files(
+        str(tmp_path),
+        get_packages=get_packages,
+        get_sources=get_sources,
+        suite_name="unstable",
+        archive_description="Test",
+        components=["main"],
+        arches=["amd64"],
+        origin="test",
+        signer=None,
+        compression={"gz": 1, "xz": None},
+    )
+    packages_dir = tmp_path / "main" / "binary-amd64"
+    assert sorted(os.listdir(packages_dir)) == [
+        "Packages",
+        "Packages.gz",
+        "Packages.xz",
+        "by-hash",
+    ]
+    assert lzma.decompress((packages_dir / "Packages.xz").read_bytes()) == (
+        b"Package: foo\n\n"
+    )
+    with open(tmp_path / "Release") as f:
+        release = Release(f)
+    assert [e["name"] for e in release["SHA256"]] == [
+        "main/binary-amd64/Packages",
+        "main/binary-amd64/Packages.gz",
+        "main/binary-amd64/Packages.xz",
+        "main/source/Sources",
+        "main/source/Sources.gz",
+        "main/source/Sources.xz",
+    ]
+
+
+class CountingPackageInfoProvider(PackageInfoProvider):
+    def __init__(self):
+        self.calls = []
+
+    async def packages_for_run(self, run_id, suite_name, package, arch):
+        self.calls.append(run_id)
+        if run_id == "missing":
+            yield b"Package: partial\n"
+            raise ArtifactsMissing(run_id)
+        yield f"Package: {package}\n".encode()
+        yield b"\n"
+
+    async def sources_for_run(self, run_id, suite_name, package):
+        self.calls.append(run_id)
+        yield f"Package: {package}\n\n".encode()
+
+
+async def read_packages(provider, run_id, package="foo"):
+    return b"".join(
+        [
+            chunk
+            async for chunk in provider.packages_for_run(
+                run_id, "unstable", package, "amd64"
+            )
+        ]
+    )
+
+
+async def test_disk_cache(tmp_path):
+    primary = CountingPackageInfoProvider()
+    provider = DiskCachingPackageInfoProvider(primary, str(tmp_path))
+    assert await read_packages(provider, "run-1") == b"Package: foo\n\n"
+    assert await read_packages(provider, "run-1") == b"Package: foo\n\n"
+    assert primary.calls == ["run-1"]
+    assert os.path.exists(tmp_path / "binary-amd64" / "ru" / "run-1")
+
+    # Entries are validated on read
+    path = tmp_path / "binary-amd64" / "ru" / "run-1"
+    path.write_bytes(path.read_bytes().replace(b"foo", b"bar"))
+    assert await read_packages(provider, "run-1") == b"Package: foo\n\n"
+    assert primary.calls == ["run-1", "run-1"]
+
+    # Failed retrievals are not cached
+    with pytest.raises(ArtifactsMissing):
+        await read_packages(provider, "missing")
+    assert not os.path.exists(tmp_path / "binary-amd64" / "mi" / "missing")
+
+    # Existing entries are picked up again
+    provider = DiskCachingPackageInfoProvider(primary, str(tmp_path))
+    assert await read_packages(provider, "run-1") == b"Package: foo\n\n"
+    assert primary.calls == ["run-1", "run-1", "missing"]
+
+
+async def test_disk_cache_eviction(tmp_path):
+    primary = CountingPackageInfoProvider()
+    provider = DiskCachingPackageInfoProvider(primary, str(tmp_path), max_size=200)
+    for run_id in ["run-1", "run-2", "run-3"]:
+        await read_packages(provider, run_id)
+    # Each entry is a 65 byte header plus the stanza; the least recently used
+    # entry is evicted.
+    assert not os.path.exists(tmp_path / "binary-amd64" / "ru" / "run-1")
+    assert os.path.exists(tmp_path / "binary-amd64" / "ru" / "run-3")
+    await read_packages(provider, "run-2")
+    await read_packages(provider, "run-1")
+    assert os.path.exists(tmp_path / "binary-amd64" / "ru" / "run-2")
+    assert not os.path.exists(tmp_path / "binary-amd64" / "ru" / "run-3")
+
+
+class FakeOnDemandDists(OnDemandDists):
+    def __init__(self, *args, builds, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.builds = builds
+        self.lookups = 0
+
+    async def _lookup(self, kind, id):
+        self.lookups += 1
+        await asyncio.sleep(0.01)
+        return SimpleNamespace(component=["main"]), self.builds[id], "Test"
+
+
+def test_builds_fingerprint():
+    builds = [("foo", "run-1", "unstable", "1.0"), ("bar", "run-2", "unstable", "2")]
+    assert builds_fingerprint(builds, ["main"], ["amd64"]) == builds_fingerprint(
+        list(reversed(builds)), ["main"], ["amd64"]
+    )
+    assert builds_fingerprint(builds, ["main"], ["amd64"]) != builds_fingerprint(
+        builds[:1], ["main"], ["amd64"]
+    )
+
+
+async def test_on_demand_dists(tmp_path):
+    primary = CountingPackageInfoProvider()
+    builds = {"run-1": [("foo", "run-1", "unstable", "1.0")]}
+    dists = FakeOnDemandDists(
+        str(tmp_path),
+        None,
+        SimpleNamespace(origin="test"),
+        primary,
+        None,
+        builds=builds,
+        ttl=0,
+    )
+    # Concurrent requests share a single refresh
+    await asyncio.gather(*[dists.refresh("run", "run-1") for i in range(5)])
+    assert dists.lookups == 1
+    release_path = tmp_path / "run" / "run-1" / "Release"
+    mtime = os.stat(release_path).st_mtime_ns
+
+    # Unchanged builds are not regenerated
+    await dists.refresh("run", "run-1")
+    assert dists.lookups == 2
+    assert os.stat(release_path).st_mtime_ns == mtime
+
+    # Changed builds are
+    builds["run-1"] = []
+    await dists.refresh("run", "run-1")
+    assert os.stat(release_path).st_mtime_ns != mtime
+
+
+async def test_on_demand_dists_ttl_and_eviction(tmp_path):
+    primary = CountingPackageInfoProvider()
+    builds = {
+        "run-1": [("foo", "run-1", "unstable", "1.0")],
+        "run-2": [("bar", "run-2", "unstable", "1.0")],
+    }
+    dists = FakeOnDemandDists(
+        str(tmp_path),
+        None,
+        SimpleNamespace(origin="test"),
+        primary,
+        None,
+        builds=builds,
+        max_entries=1,
+    )
+    await dists.refresh("run", "run-1")
+    await dists.refresh("run", "run-1")
+    assert dists.lookups == 1
+    await dists.refresh("run", "run-2")
+    assert not os.path.exists(tmp_path / "run" / "run-1")
+    assert os.path.exists(tmp_path / "run" / "run-2" / "Release")
+
+    # Existing suites are picked up on startup
+    calls = len(primary.calls)
+    dists = FakeOnDemandDists(
+        str(tmp_path),
+        None,
+        SimpleNamespace(origin="test"),
+        primary,
+        None,
+        builds=builds,
+        max_entries=1,
+    )
+    await dists.refresh("run", "run-2")
+    assert dists.lookups == 1
+    assert len(primary.calls) == calls
+
+
+class FakeSigner(ReleaseSigner):
+    def __init__(self):
+        super().__init__(lambda: None)
+        self.signed = []
+
+    def _sign(self, data):
+        self.signed.append(data)
+        return b"signature", b"clearsigned"
+
+
+async def test_write_suite_files_signing(tmp_path):
+    stanzas = [b"Package: foo\n\n"]
+
+    async def get_packages(suite, component, arch):
+        for stanza in stanzas:
+            yield stanza
+
+    async def get_sources(suite, component):
+        return
+        yield
+
+    signer = FakeSigner()
+
+    async def write(timestamp):
+        await write_suite_files(
+            str(tmp_path),
+            get_packages=get_packages,
+            get_sources=get_sources,
+            suite_name="unstable",
+            archive_description="Test",
+            components=["main"],
+            arches=["amd64"],
+            origin="test",
+            signer=signer,
+            timestamp=timestamp,
+        )
+
+    await write(datetime(2024, 1, 1, 12))
+    assert len(signer.signed) == 1
+    assert (tmp_path / "Release").read_bytes() == signer.signed[0]
+    assert (tmp_path / "InRelease").read_bytes() == b"clearsigned"
+    assert (tmp_path / "Release.gpg").read_bytes() == b"signature"
+
+    # Only the date changed, so the existing signatures are kept
+    await write(datetime(2024, 1, 2, 12))
+    assert len(signer.signed) == 1
+    assert b"Date: Mon, 01 Jan 2024" in (tmp_path / "Release").read_bytes()
+
+    stanzas.append(b"Package: bar\n\n")
+    await write(datetime(2024, 1, 3, 12))
+    assert len(signer.signed) == 2
+    assert (tmp_path / "Release").read_bytes() == signer.signed[1]
+
+
+class RecordingGeneratorManager(GeneratorManager):
+    def __init__(self, **kwargs):
+        repo = SimpleNamespace(name="suite", select=[SimpleNamespace(campaign="c")])
+        super().__init__(
+            None,
+            None,
+            SimpleNamespace(apt_repository=[repo]),
+            None,
+            None,
+            **kwargs,
+        )
+        self.published = []
+
+    async def _publish(self, apt_repository_config):
+        self.published.append(asyncio.get_running_loop().time())
+        await asyncio.sleep(0.01)
+
+
+async def test_generator_manager_coalesce():
+    manager = RecordingGeneratorManager(coalesce_window=0.2, max_staleness=10)
+    for i in range(5):
+        await manager.trigger_campaign("c")
+        await asyncio.sleep(0.01)
+    await manager.trigger_campaign("unknown")
+    assert manager.published == []
+    await asyncio.sleep(0.3)
+    assert len(manager.published) == 1
+
+    # Changes while publishing result in another publish
+    await manager.trigger_campaign("c", immediate=True)
+    await asyncio.sleep(0.005)
+    await manager.trigger_campaign("c")
+    await asyncio.sleep(0.3)
+    assert len(manager.published) == 3
+    await manager.scheduler.close()
+
+
+async def test_generator_manager_max_staleness():
+    manager = RecordingGeneratorManager(coalesce_window=1.0, max_staleness=0.1)
+    start = asyncio.get_running_loop().time()
+    for i in range(30):
+        await manager.trigger_campaign("c")
+        await asyncio.sleep(0.01)
+    assert len(manager.published) >= 1
+    assert manager.published[0] - start < 0.25
+    await manager.scheduler.close()
+
+
+class FailingGeneratorManager(RecordingGeneratorManager):
+    def __init__(self, failures, **kwargs):
+        super().__init__(**kwargs)
+        self.failures = failures
+
+    async def _publish(self, apt_repository_config):
+        await super()._publish(apt_repository_config)
+        if self.failures:
+            self.failures -= 1
+            raise RuntimeError("publish failed")
+
+
+async def test_generator_manager_retry():
+    manager = FailingGeneratorManager(
+        2, coalesce_window=0, max_staleness=0, retry_delay=0.2, max_retry_delay=10
+    )
+    await manager.trigger_campaign("c")
+    await manager.trigger_campaign("c")
+    await asyncio.sleep(0.05)
+    # The failed publish leaves the suite dirty, with its pending changes
+    assert len(manager.published) == 1
+    assert manager._pending == {"suite": 2}
+    assert "suite" in manager._dirty
+
+    # .. and is retried with an exponential backoff
+    await asyncio.sleep(0.3)
+    assert len(manager.published) == 2
+    assert manager.published[1] - manager.published[0] >= 0.2
+    await asyncio.sleep(0.15)
+    assert len(manager.published) == 2
+    await asyncio.sleep(0.3)
+    assert len(manager.published) == 3
+    assert manager.published[2] - manager.published[1] >= 0.4
+    assert manager._dirty == {}
+    assert manager._pending == {}
+    assert manager._failures == {}
+    await manager.scheduler.close()
+
+
+class FakePackageIndexConnection:
+    def __init__(self, index):
+        self.index = index
+
+    async def fetch(self, query, run_ids):
+        return [(run_id,) for run_id in {r for (r, a) in self.index} & set(run_ids)]
+
+    @asynccontextmanager
+    async def transaction(self):
+        yield
+
+    async def cursor(self, query, run_ids, architectures):
+        for ord, run_id in enumerate(run_ids, 1):
+            for arch in architectures:
+                if (run_id, arch) in self.index:
+                    yield (ord, self.index[(run_id, arch)])
+
+
+class FakePackageIndexPool:
+    def __init__(self, index):
+        self.index = index
+
+    @asynccontextmanager
+    async def acquire(self):
+        yield FakePackageIndexConnection(self.index)
+
+
+async def test_database_package_info_provider():
+    primary = CountingPackageInfoProvider()
+    primary.concurrency = 2
+    db = FakePackageIndexPool(
+        {
+            ("run-1", "amd64"): b"Package: one\n\n",
+            ("run-1", "all"): b"Package: one-doc\n\n",
+            ("run-3", "all"): b"Package: three\n\n",
+            # Stored, but without stanzas for this architecture
+            ("run-5", "i386"): b"Package: five\n\n",
+        }
+    )
+    provider = DatabasePackageInfoProvider(db, primary)
+    rows = [
+        ("two", "run-2", "unstable", "1"),
+        ("one", "run-1", "unstable", "1"),
+        ("four", "run-4", "unstable", "1"),
+        ("three", "run-3", "unstable", "1"),
+        ("five", "run-5", "unstable", "1"),
+        ("six", "run-6", "unstable", "1"),
+    ]
+    result = [chunk async for chunk in provider.packages_for_runs(rows, "amd64")]
+    # Builds without stored stanzas are retrieved from the primary provider,
+    # and kept in order
+    assert result == [
+        b"Package: two\n\n",
+        b"Package: one\n\n",
+        b"Package: one-doc\n\n",
+        b"Package: four\n\n",
+        b"Package: three\n\n",
+        b"Package: six\n\n",
+    ]
+    assert sorted(primary.calls) == ["run-2", "run-4", "run-6"]
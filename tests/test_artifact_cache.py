@@ -0,0 +1,104 @@
+import os
+
+from janitor.artifact_cache import ArtifactCache
+
+
+class FakeArtifactManager:
+    def __init__(self, artifacts):
+        self.artifacts = artifacts
+        self.retrieved = []
+
+    async def retrieve_artifacts(self, run_id, local_path, filter_fn=None):
+        self.retrieved.append(run_id)
+        for name, contents in self.artifacts.get(run_id, {}).items():
+            if filter_fn is not None and not filter_fn(name):
+                continue
+            with open(os.path.join(local_path, name), "wb") as f:
+                f.write(contents)
+
+
+def is_binary(n):
+    return n.endswith(".deb")
+
+
+async def test_checkout(tmp_path):
+    manager = FakeArtifactManager(
+        {"run1": {"foo.deb": b"foo", "foo.buildinfo": b"info"}}
+    )
+    cache = ArtifactCache(str(tmp_path / "cache"), manager, filter_fn=is_binary)
+    for i in range(2):
+        target = tmp_path / f"target{i}"
+        target.mkdir()
+        async with cache.checkout("run1", str(target)):
+            assert os.listdir(target) == ["foo.deb"]
+            assert (target / "foo.deb").read_bytes() == b"foo"
+    assert manager.retrieved == ["run1"]
+
+    # The cache persists
+    cache = ArtifactCache(str(tmp_path / "cache"), manager, filter_fn=is_binary)
+    target = tmp_path / "target3"
+    target.mkdir()
+    async with cache.checkout("run1", str(target)):
+        assert os.listdir(target) == ["foo.deb"]
+    assert manager.retrieved == ["run1"]
+
+
+async def test_missing(tmp_path):
+    manager = FakeArtifactManager({})
+    cache = ArtifactCache(str(tmp_path / "cache"), manager)
+    async with cache.checkout("run1", str(tmp_path)):
+        pass
+    async with cache.checkout("run1", str(tmp_path)):
+        pass
+    # Missing artifacts are not cached
+    assert manager.retrieved == ["run1", "run1"]
+
+
+async def test_deduplicated(tmp_path):
+    manager = FakeArtifactManager(
+        {"run1": {"foo.deb": b"same"}, "run2": {"bar.deb": b"same"}}
+    )
+    cache = ArtifactCache(str(tmp_path / "cache"), manager)
+    for run_id in ["run1", "run2"]:
+        target = tmp_path / run_id
+        target.mkdir()
+        async with cache.checkout(run_id, str(target)):
+            pass
+    objects = [
+        name
+        for (dirpath, dirnames, filenames) in os.walk(tmp_path / "cache" / "objects")
+        for name in filenames
+    ]
+    assert len(objects) == 1
+
+
+async def test_evict_unused(tmp_path):
+    manager = FakeArtifactManager(
+        {
+            "run1": {"a.deb": b"a" * 100},
+            "run2": {"b.deb": b"b" * 100},
+            "run3": {"c.deb": b"c" * 100},
+        }
+    )
+    cache = ArtifactCache(str(tmp_path / "cache"), manager, max_size=200)
+    for run_id in ["run1", "run2"]:
+        target = tmp_path / run_id
+        target.mkdir()
+        async with cache.checkout(run_id, str(target)):
+            pass
+
+    target = tmp_path / "run1-again"
+    target.mkdir()
+    async with cache.checkout("run1", str(target)):
+        target = tmp_path / "run3"
+        target.mkdir()
+        async with cache.checkout("run3", str(target)):
+            pass
+        # run2 was least recently used; run1 is in use
+    assert manager.retrieved == ["run1", "run2", "run3"]
+
+    target = tmp_path / "run2-again"
+    target.mkdir()
+    async with cache.checkout("run2", str(target)):
+        assert (target / "b.deb").read_bytes() == b"b" * 100
+    assert manager.retrieved == ["run1", "run2", "run3", "run2"]
@@ -0,0 +1,148 @@
+import gzip
+import os
+import time
+
+from janitor.diff_cache import (
+    STALE_TEMPORARY_FILE_AGE,
+    LocalDiffCache,
+    ReadThroughDiffCache,
+    get_diff_cache,
+)
+
+
+async def test_get_put(tmp_path):
+    cache = LocalDiffCache(str(tmp_path))
+    assert await cache.get("debdiff", "old", "new") is None
+    assert not await cache.contains("debdiff", "old", "new")
+    await cache.put("debdiff", "old", "new", b"some diff")
+    assert await cache.contains("debdiff", "old", "new")
+    assert await cache.get("debdiff", "old", "new") == b"some diff"
+    assert await cache.get("diffoscope", "old", "new") is None
+    assert os.listdir(tmp_path / "debdiff") == ["old_new.gz"]
+
+
+async def test_persistent(tmp_path):
+    cache = LocalDiffCache(str(tmp_path))
+    await cache.put("debdiff", "old", "new", b"some diff")
+    cache = LocalDiffCache(str(tmp_path))
+    assert await cache.get("debdiff", "old", "new") == b"some diff"
+
+
+async def test_evict(tmp_path):
+    cache = LocalDiffCache(str(tmp_path))
+    await cache.put("debdiff", "a", "b", os.urandom(1000))
+    entry_size = os.path.getsize(tmp_path / "debdiff" / "a_b.gz")
+    cache = LocalDiffCache(str(tmp_path), max_size=entry_size * 2)
+    await cache.put("debdiff", "c", "d", os.urandom(1000))
+    # Use a_b, so that c_d becomes the least recently used entry
+    assert await cache.get("debdiff", "a", "b") is not None
+    await cache.put("debdiff", "e", "f", os.urandom(1000))
+    assert await cache.contains("debdiff", "a", "b")
+    assert not await cache.contains("debdiff", "c", "d")
+    assert await cache.contains("debdiff", "e", "f")
+
+
+async def test_corrupt(tmp_path):
+    cache = LocalDiffCache(str(tmp_path))
+    await cache.put("debdiff", "old", "new", b"some diff")
+    with open(tmp_path / "debdiff" / "old_new.gz", "wb") as f:
+        f.write(b"truncated")
+    assert await cache.get("debdiff", "old", "new") is None
+    assert not await cache.contains("debdiff", "old", "new")
+
+
+async def test_corrupt_deflate_stream(tmp_path):
+    cache = LocalDiffCache(str(tmp_path))
+    await cache.put("debdiff", "old", "new", b"some diff" * 100)
+    path = tmp_path / "debdiff" / "old_new.gz"
+    data = bytearray(path.read_bytes())
+    # Damage the first deflate block, but not the gzip header
+    data[10] = 0xFF
+    path.write_bytes(bytes(data))
+    assert await cache.get("debdiff", "old", "new") is None
+    assert not await cache.contains("debdiff", "old", "new")
+
+
+async def test_evict_unknown_files(tmp_path):
+    # Entries in the uncompressed layout used before
+    os.mkdir(tmp_path / "diffoscope")
+    with open(tmp_path / "diffoscope" / "a_b.json", "wb") as f:
+        f.write(os.urandom(1000))
+    os.mkdir(tmp_path / "debdiff")
+    with open(tmp_path / "debdiff" / "a_b", "wb") as f:
+        f.write(os.urandom(1000))
+    os.utime(tmp_path / "diffoscope" / "a_b.json", (time.time() - 120,) * 2)
+    os.utime(tmp_path / "debdiff" / "a_b", (time.time() - 60,) * 2)
+
+    cache = LocalDiffCache(str(tmp_path), max_size=1500)
+    # They count towards the size limit
+    assert os.listdir(tmp_path / "diffoscope") == []
+    assert os.listdir(tmp_path / "debdiff") == ["a_b"]
+    await cache.put("debdiff", "c", "d", os.urandom(1000))
+    assert os.listdir(tmp_path / "debdiff") == ["c_d.gz"]
+
+
+async def test_interrupted_write(tmp_path):
+    os.mkdir(tmp_path / "debdiff")
+    with open(tmp_path / "debdiff" / ".tmpabc", "wb") as f:
+        f.write(b"partial")
+    stale = time.time() - STALE_TEMPORARY_FILE_AGE - 60
+    os.utime(tmp_path / "debdiff" / ".tmpabc", (stale, stale))
+    with open(tmp_path / "debdiff" / ".tmpdef", "wb") as f:
+        f.write(b"partial")
+    LocalDiffCache(str(tmp_path))
+    # Recent temporary files may be in use by another process
+    assert os.listdir(tmp_path / "debdiff") == [".tmpdef"]
+
+
+async def test_read_through(tmp_path):
+    local = LocalDiffCache(str(tmp_path / "local"))
+    shared = LocalDiffCache(str(tmp_path / "shared"))
+    cache = ReadThroughDiffCache(local, shared)
+    await shared.put("debdiff", "old", "new", b"shared diff")
+    assert not await local.contains("debdiff", "old", "new")
+    assert await cache.contains("debdiff", "old", "new")
+    assert await cache.get("debdiff", "old", "new") == b"shared diff"
+    assert await local.get("debdiff", "old", "new") == b"shared diff"
+
+    await cache.put("diffoscope", "old", "new", b"{}")
+    assert await shared.get("diffoscope", "old", "new") == b"{}"
+    assert await local.get("diffoscope", "old", "new") == b"{}"
+
+
+def test_get_diff_cache(tmp_path):
+    assert get_diff_cache() is None
+    assert isinstance(get_diff_cache(local_path=str(tmp_path)), LocalDiffCache)
+    assert isinstance(get_diff_cache(str(tmp_path)), LocalDiffCache)
+    assert isinstance(
+        get_diff_cache(str(tmp_path / "shared"), local_path=str(tmp_path / "local")),
+        ReadThroughDiffCache,
+    )
+
+
+async def test_get_local_file(tmp_path):
+    cache = LocalDiffCache(str(tmp_path / "gzip"))
+    assert await cache.get_local_file("debdiff", "old", "new") is None
+    await cache.put("debdiff", "old", "new", b"some diff")
+    path, content_encoding = await cache.get_local_file("debdiff", "old", "new")
+    assert content_encoding == "gzip"
+    with open(path, "rb") as f:
+        assert gzip.decompress(f.read()) == b"some diff"
+
+    cache = LocalDiffCache(str(tmp_path / "none"), compression="none")
+    await cache.put("debdiff", "old", "new", b"some diff")
+    path, content_encoding = await cache.get_local_file("debdiff", "old", "new")
+    assert content_encoding is None
+    with open(path, "rb") as f:
+        assert f.read() == b"some diff"
+
+
+async def test_read_through_local_file(tmp_path):
+    local = LocalDiffCache(str(tmp_path / "local"), compression="none")
+    shared = LocalDiffCache(str(tmp_path / "shared"))
+    cache = ReadThroughDiffCache(local, shared)
+    assert await cache.get_local_file("debdiff", "old", "new") is None
+    await shared.put("debdiff", "old", "new", b"shared diff")
+    path, content_encoding = await cache.get_local_file("debdiff", "old", "new")
+    assert content_encoding is None
+    assert path.startswith(str(tmp_path / "local"))
@@ -16,10 +16,32 @@
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
 
 
+import asyncio
+import gzip
+import os
 import tempfile
 
-from janitor.artifacts import LocalArtifactManager
-from janitor.differ import create_app
+import pytest
+from aiohttp import web
+from aiohttp.test_utils import make_mocked_request
+
+from janitor import differ
+from janitor.artifacts import ArtifactsMissing, LocalArtifactManager
+from janitor.diff_cache import LocalDiffCache
+from janitor.differ import (
+    PRECACHE_KINDS,
+    DiffCommandError,
+    PrecachePipeline,
+    _accepts_encoding,
+    cached_diff,
+    create_app,
+    filtered_kind,
+    precache_kind,
+    precache_needed,
+    rendered_diffoscope_kind,
+    serve_diff,
+)
+from janitor.singleflight import SingleFlight
 
 
 async def create_client(aiohttp_client, db):
@@ -53,3 +75,426 @@ async def test_precache_all(aiohttp_client, db):
     resp = await client.post("/precache-all")
     assert resp.status == 200
     assert {"count": 0} == await resp.json()
+
+
+def test_rendered_diffoscope_kind():
+    kinds = {
+        rendered_diffoscope_kind("text/html", False),
+        rendered_diffoscope_kind("text/plain", False),
+        rendered_diffoscope_kind("text/markdown", False),
+        rendered_diffoscope_kind("application/json", False),
+        rendered_diffoscope_kind("text/html", True),
+        rendered_diffoscope_kind("text/html", False, "https://example.com/a.css"),
+        rendered_diffoscope_kind("text/html", False, "https://example.com/b.css"),
+    }
+    assert len(kinds) == 7
+    # The stylesheet only affects HTML
+    assert rendered_diffoscope_kind(
+        "text/plain", False, "https://example.com/a.css"
+    ) == rendered_diffoscope_kind("text/plain", False)
+
+
+async def test_cached_diff(tmp_path):
+    diff_cache = LocalDiffCache(str(tmp_path))
+    calls = []
+
+    async def render():
+        calls.append(None)
+        return b"rendered"
+
+    kind = rendered_diffoscope_kind("text/html", False)
+    assert await cached_diff(diff_cache, kind, "old", "new", render) == b"rendered"
+    assert await cached_diff(diff_cache, kind, "old", "new", render) == b"rendered"
+    assert len(calls) == 1
+    assert await diff_cache.get(kind, "old", "new") == b"rendered"
+
+    # Without a cache, the diff is rendered every time
+    assert await cached_diff(None, kind, "old", "new", render) == b"rendered"
+    assert len(calls) == 2
+
+
+DIFF = b"0123456789"
+
+
+async def create_serve_diff_client(aiohttp_client, tmp_path):
+    with open(tmp_path / "diff", "wb") as f:
+        f.write(DIFF)
+    with open(tmp_path / "diff.gz", "wb") as f:
+        f.write(gzip.compress(DIFF))
+
+    async def handle_body(request):
+        return await serve_diff(request, "v1", "text/plain", body=DIFF)
+
+    async def handle_path(request):
+        return await serve_diff(
+            request, "v1", "text/plain", path=str(tmp_path / "diff")
+        )
+
+    async def handle_gzip(request):
+        return await serve_diff(
+            request,
+            "v1",
+            "text/plain",
+            path=str(tmp_path / "diff.gz"),
+            content_encoding="gzip",
+        )
+
+    app = web.Application()
+    app.router.add_get("/body", handle_body)
+    app.router.add_get("/path", handle_path)
+    app.router.add_get("/gzip", handle_gzip)
+    return await aiohttp_client(app)
+
+
+async def test_serve_diff(aiohttp_client, tmp_path):
+    client = await create_serve_diff_client(aiohttp_client, tmp_path)
+    for url in ["/body", "/path"]:
+        resp = await client.get(url)
+        assert resp.status == 200
+        assert resp.headers["ETag"] == '"v1"'
+        assert resp.headers["Accept-Ranges"] == "bytes"
+        assert resp.headers["Content-Type"] == "text/plain; charset=utf-8"
+        assert await resp.read() == DIFF
+
+    resp = await client.head("/path")
+    assert resp.status == 200
+    assert resp.headers["Content-Length"] == str(len(DIFF))
+    assert await resp.read() == b""
+
+
+async def test_serve_diff_not_modified(aiohttp_client, tmp_path):
+    client = await create_serve_diff_client(aiohttp_client, tmp_path)
+    for url in ["/body", "/path"]:
+        resp = await client.get(url, headers={"If-None-Match": '"v1"'})
+        assert resp.status == 304
+        assert resp.headers["ETag"] == '"v1"'
+        assert await resp.read() == b""
+
+        resp = await client.get(url, headers={"If-None-Match": '"v0", "v1"'})
+        assert resp.status == 304
+
+        resp = await client.get(url, headers={"If-None-Match": '"v0"'})
+        assert resp.status == 200
+        assert await resp.read() == DIFF
+
+
+async def test_serve_diff_range(aiohttp_client, tmp_path):
+    client = await create_serve_diff_client(aiohttp_client, tmp_path)
+    for url in ["/body", "/path"]:
+        resp = await client.get(url, headers={"Range": "bytes=2-5"})
+        assert resp.status == 206
+        assert resp.headers["Content-Range"] == "bytes 2-5/10"
+        assert await resp.read() == b"2345"
+
+        resp = await client.get(url, headers={"Range": "bytes=7-"})
+        assert resp.status == 206
+        assert resp.headers["Content-Range"] == "bytes 7-9/10"
+        assert await resp.read() == b"789"
+
+        resp = await client.get(url, headers={"Range": "bytes=-3"})
+        assert resp.status == 206
+        assert resp.headers["Content-Range"] == "bytes 7-9/10"
+        assert await resp.read() == b"789"
+
+        # The end of the range is clamped to the size of the diff
+        resp = await client.get(url, headers={"Range": "bytes=8-20"})
+        assert resp.status == 206
+        assert resp.headers["Content-Range"] == "bytes 8-9/10"
+        assert await resp.read() == b"89"
+
+
+async def test_serve_diff_range_past_end(aiohttp_client, tmp_path):
+    client = await create_serve_diff_client(aiohttp_client, tmp_path)
+    for url in ["/body", "/path"]:
+        resp = await client.get(url, headers={"Range": "bytes=10-20"})
+        assert resp.status == 416
+        assert resp.headers["Content-Range"] == "bytes */10"
+
+
+async def test_serve_diff_malformed_range(aiohttp_client, tmp_path):
+    client = await create_serve_diff_client(aiohttp_client, tmp_path)
+    for url in ["/body", "/path"]:
+        for value in ["bytes=abc", "bytes=5-2", "lines=1-2"]:
+            resp = await client.get(url, headers={"Range": value})
+            assert resp.status == 200
+            assert "Content-Range" not in resp.headers
+            assert await resp.read() == DIFF
+
+
+async def test_serve_diff_if_range(aiohttp_client, tmp_path):
+    client = await create_serve_diff_client(aiohttp_client, tmp_path)
+    for url in ["/body", "/path"]:
+        resp = await client.get(url, headers={"Range": "bytes=2-5", "If-Range": '"v1"'})
+        assert resp.status == 206
+        assert await resp.read() == b"2345"
+
+        # A different validator means the client's copy is out of date
+        resp = await client.get(url, headers={"Range": "bytes=2-5", "If-Range": '"v0"'})
+        assert resp.status == 200
+        assert "Content-Range" not in resp.headers
+        assert await resp.read() == DIFF
+
+
+async def test_serve_diff_content_encoding(aiohttp_client, tmp_path):
+    client = await create_serve_diff_client(aiohttp_client, tmp_path)
+    resp = await client.get("/gzip", headers={"Accept-Encoding": "gzip"})
+    assert resp.status == 200
+    assert resp.headers["Content-Encoding"] == "gzip"
+    # The encoded variant has a tag of its own
+    assert resp.headers["ETag"] == '"v1-gzip"'
+    assert resp.headers["Vary"] == "Accept, Accept-Encoding"
+    assert await resp.read() == DIFF
+
+    resp = await client.get("/gzip", headers={"If-None-Match": '"v1-gzip"'})
+    assert resp.status == 304
+    resp = await client.get("/gzip", headers={"If-None-Match": '"v1"'})
+    assert resp.status == 200
+
+
+def test_accepts_encoding():
+    def accepts(value):
+        headers = {} if value is None else {"Accept-Encoding": value}
+        return _accepts_encoding(
+            make_mocked_request("GET", "/", headers=headers), "gzip"
+        )
+
+    assert accepts("gzip")
+    assert accepts("br, GZIP")
+    assert accepts("gzip;q=0.5")
+    assert not accepts("gzip;q=0")
+    assert not accepts("gzip; q=0.000")
+    assert not accepts("br")
+    assert not accepts(None)
+
+
+def test_filtered_kind():
+    kind = filtered_kind("debdiff", "1.0", "1.1")
+    assert kind != "debdiff"
+    assert kind == filtered_kind("debdiff", "1.0", "1.1")
+    assert kind != filtered_kind("diffoscope", "1.0", "1.1")
+    # Filtering depends on the versions of both runs
+    assert kind != filtered_kind("debdiff", "1.0", "1.2")
+    assert kind != filtered_kind("debdiff", "0.9", "1.1")
+
+
+async def test_precache_kind_filtered(tmp_path, monkeypatch):
+    diff_cache = LocalDiffCache(str(tmp_path))
+    old_run = {"build_version": "1.0", "campaign": "lintian-fixes"}
+    new_run = {"build_version": "1.1", "campaign": "lintian-fixes"}
+    monkeypatch.setitem(
+        PRECACHE_KINDS,
+        "debdiff",
+        lambda diff, old_run, new_run: diff.replace(b"boring\n", b""),
+    )
+    calls = []
+
+    async def generate():
+        calls.append(None)
+        return b"boring\ninteresting\n"
+
+    assert await precache_needed(diff_cache, "old", "new", old_run, new_run)
+    await precache_kind(
+        diff_cache,
+        SingleFlight(),
+        "debdiff",
+        "old",
+        "new",
+        generate,
+        old_run,
+        new_run,
+    )
+    assert len(calls) == 1
+    # The unfiltered diff is kept as is, and the filtered variant is keyed
+    # separately
+    assert await diff_cache.get("debdiff", "old", "new") == b"boring\ninteresting\n"
+    filtered = filtered_kind("debdiff", "1.0", "1.1")
+    assert await diff_cache.get(filtered, "old", "new") == b"interesting\n"
+    assert not await diff_cache.contains(
+        filtered_kind("debdiff", "1.0", "1.2"), "old", "new"
+    )
+
+    # Once cached, neither is generated again
+    await precache_kind(
+        diff_cache,
+        SingleFlight(),
+        "debdiff",
+        "old",
+        "new",
+        generate,
+        old_run,
+        new_run,
+    )
+    assert len(calls) == 1
+
+    # Without versions, there is no filtered variant
+    await precache_kind(diff_cache, SingleFlight(), "debdiff", "a", "b", generate)
+    assert await diff_cache.contains("debdiff", "a", "b")
+    assert sorted(os.listdir(tmp_path)) == sorted(["debdiff", filtered])
+
+
+class FakeDiffer:
+    """Stand-ins for artifact retrieval and the diff commands."""
+
+    def __init__(self, path):
+        self.path = path
+        self.retrieved = []
+        self.diffoscope_started = []
+        self.diffoscope_blocker = asyncio.Event()
+        self.diffoscope_blocker.set()
+
+    async def retrieve_binaries(self, artifact_manager, es, old_id, new_id, **kwargs):
+        if new_id == "missing":
+            raise ArtifactsMissing(new_id)
+        self.retrieved.append((old_id, new_id))
+        binaries = []
+        for run_id in (old_id, new_id):
+            path = os.path.join(self.path, f"{run_id}.deb")
+            with open(path, "wb") as f:
+                f.write(b"x" * 100)
+            binaries.append([(f"{run_id}.deb", path)])
+        return tuple(binaries)
+
+    async def generate_debdiff(self, old_binaries, new_binaries):
+        return b"debdiff"
+
+    async def generate_diffoscope(self, old_binaries, new_binaries, **kwargs):
+        self.diffoscope_started.append(new_binaries[0][0])
+        await self.diffoscope_blocker.wait()
+        if new_binaries[0][0] == "broken.deb":
+            raise DiffCommandError("diffoscope", "it broke")
+        return b"{}"
+
+
+@pytest.fixture
+def pipeline_app(tmp_path, monkeypatch):
+    fake = FakeDiffer(str(tmp_path))
+    for name in ["retrieve_binaries", "generate_debdiff", "generate_diffoscope"]:
+        monkeypatch.setattr(differ, name, getattr(fake, name))
+    os.mkdir(tmp_path / "cache")
+    app = {
+        "diff_cache": LocalDiffCache(str(tmp_path / "cache")),
+        "artifact_manager": None,
+        "artifact_cache": None,
+        "single_flight": SingleFlight(),
+        "task_memory_limit": None,
+        "task_timeout": None,
+        "diffoscope_command": None,
+    }
+    return app, fake
+
+
+async def test_precache_pipeline(pipeline_app):
+    app, fake = pipeline_app
+    pipeline = PrecachePipeline(app)
+    pipeline.start()
+    try:
+        sizes = {}
+        await pipeline.run(
+            "old",
+            "new",
+            report_artifact_size=lambda run_id, size: sizes.__setitem__(run_id, size),
+        )
+        assert sizes == {"old": 100, "new": 100}
+        assert await app["diff_cache"].get("debdiff", "old", "new") == b"debdiff"
+        assert await app["diff_cache"].get("diffoscope", "old", "new") == b"{}"
+
+        # Nothing is retrieved when everything has been precached already
+        await pipeline.run("old", "new")
+        assert fake.retrieved == [("old", "new")]
+    finally:
+        await pipeline.stop()
+
+
+async def test_precache_pipeline_failure(pipeline_app):
+    app, fake = pipeline_app
+    pipeline = PrecachePipeline(app)
+    pipeline.start()
+    try:
+        # Failures in any stage are raised to the caller ..
+        with pytest.raises(ArtifactsMissing):
+            await pipeline.run("old", "missing")
+        with pytest.raises(DiffCommandError):
+            await pipeline.run("old", "broken")
+        # .. and don't affect later jobs
+        await pipeline.run("old", "new")
+        assert await app["diff_cache"].contains("diffoscope", "old", "new")
+    finally:
+        await pipeline.stop()
+
+
+async def test_precache_pipeline_backpressure(pipeline_app):
+    app, fake = pipeline_app
+    fake.diffoscope_blocker.clear()
+    pipeline = PrecachePipeline(
+        app, download_concurrency=1, diffoscope_concurrency=1, queue_size=1
+    )
+    pipeline.start()
+    try:
+        waiters = [
+            asyncio.create_task(pipeline.run("old", f"new{i}")) for i in range(10)
+        ]
+        while not fake.diffoscope_started:
+            await asyncio.sleep(0.01)
+        await asyncio.sleep(0.05)
+        # Artifacts are only retrieved for as many jobs as the stages and the
+        # queues between them can hold
+        assert len(fake.retrieved) == pipeline.capacity
+        assert fake.diffoscope_started == ["new0.deb"]
+
+        fake.diffoscope_blocker.set()
+        await asyncio.gather(*waiters)
+        assert len(fake.retrieved) == 10
+    finally:
+        await pipeline.stop()
+
+
+async def test_precache_pipeline_cancel(pipeline_app):
+    app, fake = pipeline_app
+    fake.diffoscope_blocker.clear()
+    pipeline = PrecachePipeline(app, download_concurrency=1, queue_size=1)
+    pipeline.start()
+    try:
+        cancelled = asyncio.create_task(pipeline.run("old", "new0"))
+        waiter = asyncio.create_task(pipeline.run("old", "new1"))
+        while not fake.diffoscope_started:
+            await asyncio.sleep(0.01)
+        # Cancelling a caller doesn't wedge the pipeline
+        cancelled.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await cancelled
+        fake.diffoscope_blocker.set()
+        await asyncio.wait_for(waiter, 5)
+    finally:
+        await asyncio.wait_for(pipeline.stop(), 5)
+
+    # Stopping the pipeline stops its workers, even when they are busy
+    fake.diffoscope_blocker.clear()
+    pipeline.start()
+    waiter = asyncio.create_task(pipeline.run("old", "new2"))
+    while "new2.deb" not in fake.diffoscope_started:
+        await asyncio.sleep(0.01)
+    await asyncio.wait_for(pipeline.stop(), 5)
+    waiter.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await waiter
+
+
+def test_diffoscope_concurrency(tmp_path, monkeypatch):
+    def concurrency(**kwargs):
+        app = create_app(
+            str(tmp_path / "cache"),
+            LocalArtifactManager(str(tmp_path / "artifacts")),
+            task_memory_limit=1000,
+            **kwargs,
+        )
+        return app["precache_pipeline"].diffoscope_concurrency
+
+    monkeypatch.setattr(os, "cpu_count", lambda: 4)
+    # Limited by memory ..
+    assert concurrency(memory_budget=2000 * 1024**2) == 2
+    assert concurrency(memory_budget=500 * 1024**2) == 1
+    # .. and by the number of CPUs
+    assert concurrency(memory_budget=64000 * 1024**2) == 4
+    assert concurrency() == 4
+    # .. unless set explicitly
+    assert concurrency(memory_budget=64000 * 1024**2, diffoscope_concurrency=8) == 8
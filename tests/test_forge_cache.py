@@ -0,0 +1,191 @@
+import os
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Optional
+
+import pytest
+from breezy.transport.http.urllib import HttpTransport
+
+from janitor.forge_cache import (
+    ForgeResponseCache,
+    install_forge_response_cache,
+    is_forge_api_url,
+)
+
+
+class FakeForge:
+    def __init__(self) -> None:
+        self.requests: list[tuple[str, str, dict[str, str]]] = []
+        self.etag = '"v1"'
+        self.body = b'{"state": "open"}'
+        self.url = ""
+        self.vary: Optional[str] = None
+
+
+@pytest.fixture
+def forge():
+    forge = FakeForge()
+
+    class Handler(BaseHTTPRequestHandler):
+        def _handle(self):
+            length = int(self.headers.get("Content-Length", 0))
+            if length:
+                self.rfile.read(length)
+            forge.requests.append((self.command, self.path, dict(self.headers)))
+            if (
+                self.command == "GET"
+                and self.headers.get("If-None-Match") == forge.etag
+            ):
+                self.send_response(304)
+                self.send_header("ETag", forge.etag)
+                self.end_headers()
+                return
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("ETag", forge.etag)
+            if forge.vary:
+                self.send_header("Vary", forge.vary)
+            self.send_header("Content-Length", str(len(forge.body)))
+            self.end_headers()
+            self.wfile.write(forge.body)
+
+        do_GET = _handle
+        do_POST = _handle
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    forge.url = f"http://127.0.0.1:{server.server_address[1]}/"
+    try:
+        yield forge
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+@pytest.fixture
+def transport(forge, tmp_path, monkeypatch):
+    # Restore the original request method once the test is done
+    monkeypatch.setattr(HttpTransport, "request", HttpTransport.request)
+    install_forge_response_cache(ForgeResponseCache(str(tmp_path)))
+    return HttpTransport(forge.url)
+
+
+def test_revalidate(forge, transport):
+    url = forge.url + "api/v3/repos/foo/bar/pulls/1"
+
+    resp = transport.request("GET", url)
+    assert resp.status == 200
+    assert resp.text == '{"state": "open"}'
+    assert "If-None-Match" not in forge.requests[-1][2]
+
+    resp = transport.request("GET", url)
+    assert forge.requests[-1][2]["If-None-Match"] == '"v1"'
+    assert resp.status == 200
+    assert resp.text == '{"state": "open"}'
+
+    forge.etag = '"v2"'
+    forge.body = b'{"state": "closed"}'
+    resp = transport.request("GET", url)
+    assert resp.text == '{"state": "closed"}'
+    resp = transport.request("GET", url)
+    assert forge.requests[-1][2]["If-None-Match"] == '"v2"'
+    assert resp.text == '{"state": "closed"}'
+
+
+def test_keyed_by_authorization(forge, transport):
+    url = forge.url + "api/v4/projects/1/merge_requests/1"
+
+    transport.request("GET", url, headers={"Authorization": "a"})
+    transport.request("GET", url, headers={"Authorization": "b"})
+    assert "If-None-Match" not in forge.requests[-1][2]
+
+
+def test_post_not_cached(forge, transport, tmp_path):
+    url = forge.url + "api/v3/repos/foo/bar/pulls"
+
+    transport.request("POST", url, body=b"{}")
+    transport.request("POST", url, body=b"{}")
+    assert "If-None-Match" not in forge.requests[-1][2]
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_keyed_by_accept(forge, transport):
+    url = forge.url + "api/v4/projects/1/merge_requests/1"
+
+    transport.request("GET", url, headers={"Accept": "application/json"})
+    transport.request("GET", url, headers={"Accept": "text/plain"})
+    assert "If-None-Match" not in forge.requests[-1][2]
+    transport.request("GET", url, headers={"Accept": "application/json"})
+    assert forge.requests[-1][2]["If-None-Match"] == '"v1"'
+
+
+def test_vary(forge, transport):
+    url = forge.url + "api/v1/repos/foo/bar/pulls/1"
+    forge.vary = "X-Custom"
+
+    transport.request("GET", url, headers={"X-Custom": "a"})
+    transport.request("GET", url, headers={"X-Custom": "b"})
+    assert "If-None-Match" not in forge.requests[-1][2]
+    transport.request("GET", url, headers={"X-Custom": "b"})
+    assert forge.requests[-1][2]["If-None-Match"] == '"v1"'
+
+    forge.vary = "*"
+    url = forge.url + "api/v1/repos/foo/bar/pulls/2"
+    transport.request("GET", url)
+    transport.request("GET", url)
+    assert "If-None-Match" not in forge.requests[-1][2]
+
+
+def test_not_forge_api(forge, transport, tmp_path):
+    url = forge.url + "foo/bar.git/info/refs"
+
+    transport.request("GET", url)
+    transport.request("GET", url)
+    assert "If-None-Match" not in forge.requests[-1][2]
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_is_forge_api_url():
+    assert is_forge_api_url("https://api.github.com/repos/foo/bar/pulls/1")
+    assert is_forge_api_url("https://salsa.debian.org/api/v4/projects/1")
+    assert is_forge_api_url("https://example.com/gitea/api/v1/repos/foo/bar")
+    assert not is_forge_api_url("https://github.com/foo/bar.git/info/refs")
+    assert not is_forge_api_url("https://salsa.debian.org/foo/bar.git")
+
+
+def test_evict(tmp_path):
+    def store(cache, url, data):
+        cache.store(
+            url,
+            {},
+            status=200,
+            reason="OK",
+            response_headers=[("ETag", '"v1"')],
+            data=data,
+        )
+
+    cache = ForgeResponseCache(str(tmp_path))
+    store(cache, "https://api.github.com/a", b"a" * 1000)
+    entry_size = sum(
+        os.path.getsize(os.path.join(dirpath, name))
+        for (dirpath, dirnames, filenames) in os.walk(tmp_path)
+        for name in filenames
+    )
+
+    cache = ForgeResponseCache(str(tmp_path), max_size=entry_size * 2)
+    store(cache, "https://api.github.com/b", b"b" * 1000)
+    assert cache.get("https://api.github.com/a", {}) is not None
+    store(cache, "https://api.github.com/c", b"c" * 1000)
+    # b was the least recently used
+    assert cache.get("https://api.github.com/b", {}) is None
+    assert cache.get("https://api.github.com/a", {}) is not None
+    assert cache.get("https://api.github.com/c", {}) is not None
+
+    # Entries larger than the cache are not stored at all
+    store(cache, "https://api.github.com/d", b"d" * entry_size * 3)
+    assert cache.get("https://api.github.com/d", {}) is None
+    assert cache.get("https://api.github.com/a", {}) is not None
@@ -0,0 +1,139 @@
+import asyncio
+
+from janitor.precache_queue import (
+    PRIORITY_BACKFILL,
+    PRIORITY_INTERACTIVE,
+    PRIORITY_RUNNER,
+    MemoryPrecacheQueue,
+    PrecacheScheduler,
+)
+
+
+async def test_memory_queue_priority():
+    queue = MemoryPrecacheQueue()
+    assert await queue.peek() is None
+    assert await queue.push("a", "b", PRIORITY_BACKFILL)
+    assert await queue.push("c", "d", PRIORITY_RUNNER)
+    assert await queue.push("e", "f", PRIORITY_BACKFILL)
+    assert await queue.size() == 3
+    assert await queue.peek() == ("c", "d")
+
+    # Raising the priority of an existing job moves it to the front
+    assert not await queue.push("e", "f", PRIORITY_INTERACTIVE)
+    assert await queue.size() == 3
+    assert await queue.peek() == ("e", "f")
+    # .. but lowering it doesn't
+    assert not await queue.push("e", "f", PRIORITY_BACKFILL)
+    assert await queue.peek() == ("e", "f")
+
+    assert await queue.remove("e", "f")
+    assert not await queue.remove("e", "f")
+    assert await queue.peek() == ("c", "d")
+    assert await queue.remove("c", "d")
+    assert await queue.peek() == ("a", "b")
+    assert await queue.size() == 1
+
+
+async def test_scheduler_budget():
+    running = set()
+    max_running = 0
+    events = {}
+
+    async def run_job(old_id, new_id, report_artifact_size):
+        nonlocal max_running
+        running.add((old_id, new_id))
+        max_running = max(max_running, len(running))
+        events[(old_id, new_id)] = asyncio.Event()
+        await events[(old_id, new_id)].wait()
+        running.remove((old_id, new_id))
+
+    scheduler = PrecacheScheduler(
+        MemoryPrecacheQueue(),
+        run_job,
+        memory_budget=200,
+        job_memory=100,
+        poll_interval=0.01,
+    )
+    for i in range(5):
+        await scheduler.submit("old", f"new{i}", PRIORITY_BACKFILL)
+    scheduler.start()
+    try:
+        while len(events) < 2:
+            await asyncio.sleep(0.01)
+        status = await scheduler.status()
+        assert status["queued"] == 3
+        assert len(status["running"]) == 2
+        assert status["reserved_memory"] == 200
+
+        # Interactive jobs go to the front of the queue
+        await scheduler.submit("old", "urgent", PRIORITY_INTERACTIVE)
+        events[("old", "new0")].set()
+        while ("old", "urgent") not in events:
+            await asyncio.sleep(0.01)
+        assert ("old", "new2") not in events
+
+        while scheduler.completed < 6:
+            for event in list(events.values()):
+                event.set()
+            await asyncio.sleep(0.01)
+    finally:
+        await scheduler.stop()
+    assert max_running == 2
+    status = await scheduler.status()
+    assert status["queued"] == 0
+    assert status["running"] == []
+    assert status["reserved_memory"] == 0
+    assert status["reserved_disk"] == 0
+
+
+async def test_scheduler_max_running():
+    started = []
+    done = asyncio.Event()
+
+    async def run_job(old_id, new_id, report_artifact_size):
+        started.append(new_id)
+        await done.wait()
+
+    scheduler = PrecacheScheduler(
+        MemoryPrecacheQueue(), run_job, max_running=2, poll_interval=0.01
+    )
+    for i in range(5):
+        await scheduler.submit("old", f"new{i}", PRIORITY_BACKFILL)
+    scheduler.start()
+    try:
+        while len(started) < 2:
+            await asyncio.sleep(0.01)
+        await asyncio.sleep(0.05)
+        # The remaining jobs stay queued until there is room for them
+        assert started == ["new0", "new1"]
+        assert (await scheduler.status())["queued"] == 3
+        done.set()
+        while scheduler.completed < 5:
+            await asyncio.sleep(0.01)
+    finally:
+        await scheduler.stop()
+
+
+async def test_scheduler_artifact_sizes():
+    async def run_job(old_id, new_id, report_artifact_size):
+        report_artifact_size(old_id, 1000)
+        report_artifact_size(new_id, 3000)
+        if new_id == "broken":
+            raise KeyError(new_id)
+
+    scheduler = PrecacheScheduler(
+        MemoryPrecacheQueue(), run_job, disk_budget=10000, poll_interval=0.01
+    )
+    await scheduler.submit("old", "new", PRIORITY_RUNNER)
+    await scheduler.submit("old", "broken", PRIORITY_RUNNER)
+    while await scheduler.process_once():
+        await asyncio.sleep(0.01)
+    while scheduler.completed + scheduler.failed < 2:
+        await asyncio.sleep(0.01)
+    assert scheduler.completed == 1
+    assert scheduler.failed == 1
+    assert scheduler.artifact_size("old") == 1000
+    assert scheduler.artifact_size("new") == 3000
+    # Unknown runs are estimated based on the runs seen so far
+    assert scheduler.artifact_size("unknown") == 2333
+    assert (await scheduler.status())["reserved_disk"] == 0
@@ -0,0 +1,103 @@
+import asyncio
+
+from janitor.publish import PublishStatusDispatcher
+
+
+async def wait_for_dispatcher(dispatcher):
+    while dispatcher._tasks:
+        await asyncio.gather(*list(dispatcher._tasks.values()))
+
+
+async def test_dispatcher_codebase_order():
+    processed = []
+    active = set()
+
+    async def handler(event):
+        codebase, run_id = event
+        assert codebase not in active
+        active.add(codebase)
+        await asyncio.sleep(0.01)
+        active.remove(codebase)
+        processed.append(event)
+
+    dispatcher = PublishStatusDispatcher(handler, concurrency=4)
+    for i in range(3):
+        for codebase in ["a", "b"]:
+            dispatcher.submit(codebase, f"{codebase}{i}", (codebase, f"{codebase}{i}"))
+    await wait_for_dispatcher(dispatcher)
+
+    assert [run_id for (codebase, run_id) in processed if codebase == "a"] == [
+        "a0",
+        "a1",
+        "a2",
+    ]
+    assert [run_id for (codebase, run_id) in processed if codebase == "b"] == [
+        "b0",
+        "b1",
+        "b2",
+    ]
+
+
+async def test_dispatcher_concurrency():
+    running = 0
+    max_running = 0
+
+    async def handler(event):
+        nonlocal running, max_running
+        running += 1
+        max_running = max(max_running, running)
+        await asyncio.sleep(0.01)
+        running -= 1
+
+    dispatcher = PublishStatusDispatcher(handler, concurrency=2)
+    for i in range(6):
+        dispatcher.submit(f"codebase{i}", f"run{i}", i)
+    await wait_for_dispatcher(dispatcher)
+
+    assert max_running == 2
+
+
+async def test_dispatcher_superseded():
+    processed = []
+    blocker = asyncio.Event()
+
+    async def handler(event):
+        await blocker.wait()
+        processed.append(event)
+
+    dispatcher = PublishStatusDispatcher(handler, concurrency=1)
+    dispatcher.submit("a", "run1", "first")
+    await asyncio.sleep(0)
+    # run2 is still pending, so this replaces its event
+    dispatcher.submit("a", "run2", "old")
+    dispatcher.submit("a", "run2", "new")
+    blocker.set()
+    await wait_for_dispatcher(dispatcher)
+
+    assert processed == ["first", "new"]
+
+
+async def test_dispatcher_handler_failure():
+    processed = []
+    blocker = asyncio.Event()
+
+    async def handler(event):
+        if event == "a1":
+            await blocker.wait()
+            raise RuntimeError("boom")
+        processed.append(event)
+
+    dispatcher = PublishStatusDispatcher(handler, concurrency=2)
+    dispatcher.submit("a", "run1", "a1")
+    dispatcher.submit("a", "run2", "a2")
+    dispatcher.submit("b", "run3", "b1")
+    dispatcher.submit("b", "run4", "b2")
+    # Other codebases are processed while one is stuck
+    while processed != ["b1", "b2"]:
+        await asyncio.sleep(0.01)
+    blocker.set()
+    await wait_for_dispatcher(dispatcher)
+
+    # .. and a failing event doesn't stop the events after it
+    assert processed == ["b1", "b2", "a2"]
+    assert dispatcher._pending == {}
@@ -0,0 +1,224 @@
+import os
+import shutil
+import subprocess
+
+import pytest
+
+from janitor.debian.scan import (
+    package_index,
+    parse_control,
+    run_directory,
+    scan_deb,
+    scan_dsc,
+    scan_packages,
+    scan_sources,
+)
+
+pytestmark = pytest.mark.skipif(
+    shutil.which("dpkg-scanpackages") is None, reason="dpkg-dev not available"
+)
+
+
+def build_deb(path, control, compression="xz"):
+    pkgdir = path.parent / "build"
+    os.makedirs(pkgdir / "DEBIAN")
+    (pkgdir / "DEBIAN" / "control").write_text(control)
+    os.makedirs(pkgdir / "usr" / "share" / "doc")
+    (pkgdir / "usr" / "share" / "doc" / "README").write_text("contents\n")
+    subprocess.check_call(
+        ["dpkg-deb", f"-Z{compression}", "--build", str(pkgdir), str(path)],
+        stdout=subprocess.DEVNULL,
+    )
+    shutil.rmtree(pkgdir)
+
+
+async def collect(stanzas):
+    return b"".join([bytes(s) + b"\n" async for s in stanzas])
+
+
+async def test_scan_packages_matches_dpkg(tmp_path):
+    repo = tmp_path / "repo"
+    repo.mkdir()
+    build_deb(
+        repo / "foo_1.0-1_all.deb",
+        """\
+Package: foo
+Version: 1.0-1
+Architecture: all
+Maintainer: Foo <foo@example.com>
+X-Custom: bar
+Depends: libc6
+Section: misc
+Priority: optional
+Built-Using: x (= 1)
+Description: A thing
+ Long description.
+ .
+ ..
+ More. é
+Homepage: https://example.com/
+Installed-Size: 10
+""",
+    )
+    build_deb(
+        repo / "bar_2.0_amd64.deb",
+        """\
+Package: bar
+Version: 2.0
+Architecture: amd64
+Maintainer: Bar <bar@example.com>
+multi-arch: same
+Description: Another thing
+""",
+        compression="gzip",
+    )
+    build_deb(
+        repo / "bar_1.0_amd64.deb",
+        """\
+Package: bar
+Version: 1.0
+Architecture: amd64
+Maintainer: Bar <bar@example.com>
+Description: An older thing
+""",
+    )
+    expected = subprocess.run(
+        ["dpkg-scanpackages", str(repo)], capture_output=True, check=True
+    ).stdout
+    assert await collect(scan_packages(str(repo))) == expected
+
+    expected = subprocess.run(
+        ["dpkg-scanpackages", "-a", "i386", str(repo)],
+        capture_output=True,
+        check=True,
+    ).stdout
+    assert await collect(scan_packages(str(repo), arch="i386")) == expected
+
+
+DSC = """\
+Format: 3.0 (quilt)
+Source: foo
+Binary: foo, foo-doc
+Architecture: any all
+Version: 1.0-1
+Maintainer: Foo <foo@example.com>
+Standards-Version: 4.6.2
+Build-Depends: debhelper-compat (= 13)
+Vcs-Git: https://example.com/foo.git
+Package-List:
+ foo deb misc optional arch=any
+ foo-doc deb doc optional arch=all
+Checksums-Sha1:
+ da39a3ee5e6b4b0d3255bfef95601890afd80709 0 foo_1.0.orig.tar.gz
+ da39a3ee5e6b4b0d3255bfef95601890afd80709 0 foo_1.0-1.debian.tar.xz
+Checksums-Sha256:
+ e3b0c44298fc1c149afbf4c8996fb92427ae41e4649b934ca495991b7852b855 0 foo_1.0.orig.tar.gz
+ e3b0c44298fc1c149afbf4c8996fb92427ae41e4649b934ca495991b7852b855 0 foo_1.0-1.debian.tar.xz
+Files:
+ d41d8cd98f00b204e9800998ecf8427e 0 foo_1.0.orig.tar.gz
+ d41d8cd98f00b204e9800998ecf8427e 0 foo_1.0-1.debian.tar.xz
+"""
+
+
+async def test_scan_packages_arch_from_control(tmp_path):
+    repo = tmp_path / "repo"
+    repo.mkdir()
+    # The filename doesn't carry the architecture
+    build_deb(
+        repo / "foo.deb",
+        "Package: foo\nVersion: 1.0\nArchitecture: amd64\n"
+        "Maintainer: Foo <foo@example.com>\nDescription: Foo\n",
+    )
+    # .. or carries the wrong one
+    build_deb(
+        repo / "bar_1.0_amd64.deb",
+        "Package: bar\nVersion: 1.0\nArchitecture: i386\n"
+        "Maintainer: Bar <bar@example.com>\nDescription: Bar\n",
+    )
+    build_deb(
+        repo / "baz.deb",
+        "Package: baz\nVersion: 1.0\nArchitecture: all\n"
+        "Maintainer: Baz <baz@example.com>\nDescription: Baz\n",
+    )
+    assert [s["Package"] async for s in scan_packages(str(repo), arch="amd64")] == [
+        "baz",
+        "foo",
+    ]
+    assert [s["Package"] async for s in scan_packages(str(repo), arch="i386")] == [
+        "bar",
+        "baz",
+    ]
+
+
+async def test_scan_skips_unreadable(tmp_path, caplog):
+    repo = tmp_path / "repo"
+    repo.mkdir()
+    build_deb(
+        repo / "foo_1.0_all.deb",
+        "Package: foo\nVersion: 1.0\nArchitecture: all\n"
+        "Maintainer: Foo <foo@example.com>\nDescription: Foo\n",
+    )
+    (repo / "broken_1.0_all.deb").write_bytes(b"not a deb")
+    (repo / "foo_1.0-1.dsc").write_text(DSC)
+    (repo / "broken_1.0.dsc").write_text("not a field\n")
+    assert [s["Package"] async for s in scan_packages(str(repo))] == ["foo"]
+    assert [s["Package"] async for s in scan_sources(str(repo))] == ["foo"]
+    assert "not an ar archive" in caplog.text
+
+
+async def test_scan_sources_matches_dpkg(tmp_path):
+    repo = tmp_path / "repo"
+    repo.mkdir()
+    (repo / "foo_1.0-1.dsc").write_text(DSC)
+    (repo / "bar_2.0.dsc").write_text(
+        "-----BEGIN PGP SIGNED MESSAGE-----\n"
+        "Hash: SHA256\n"
+        "\n"
+        + DSC.replace("foo", "bar").replace("1.0-1", "2.0")
+        + "\n-----BEGIN PGP SIGNATURE-----\n"
+        "\n"
+        "aGVsbG8=\n"
+        "-----END PGP SIGNATURE-----\n"
+    )
+    expected = subprocess.run(
+        ["dpkg-scansources", str(repo)], capture_output=True, check=True
+    ).stdout
+    assert await collect(scan_sources(str(repo))) == expected
+
+
+def test_parse_control_errors():
+    with pytest.raises(ValueError):
+        parse_control(b"Package: foo\nPackage: bar\n")
+    with pytest.raises(ValueError):
+        parse_control(b" continuation\n")
+    with pytest.raises(ValueError):
+        parse_control(b"not a field\n")
+
+
+async def test_package_index(tmp_path):
+    build_deb(
+        tmp_path / "foo_1.0_amd64.deb",
+        "Package: foo\nVersion: 1.0\nArchitecture: amd64\n"
+        "Maintainer: Foo <foo@example.com>\nDescription: Foo\n",
+    )
+    build_deb(
+        tmp_path / "foo-doc_1.0_all.deb",
+        "Package: foo-doc\nVersion: 1.0\nArchitecture: all\n"
+        "Maintainer: Foo <foo@example.com>\nDescription: Foo docs\n",
+    )
+    (tmp_path / "foo_1.0.dsc").write_text(DSC)
+    directory = run_directory("unstable", "foo", "run-id")
+    index = package_index(
+        [scan_deb(str(tmp_path / "foo_1.0_amd64.deb"))],
+        [scan_dsc(str(tmp_path / "foo_1.0.dsc"))],
+        directory,
+    )
+    assert set(index) == {"amd64", "source"}
+    assert b"Filename: unstable/pkg/foo/run-id/foo_1.0_amd64.deb\n" in index["amd64"]
+    assert b"Directory: unstable/pkg/foo/run-id\n" in index["source"]
+
+    index = package_index(
+        [scan_deb(str(tmp_path / "foo-doc_1.0_all.deb"))], [], directory
+    )
+    assert index["source"] == b""
+    assert index["all"].startswith(b"Package: foo-doc\n")
@@ -0,0 +1,78 @@
+import asyncio
+
+import pytest
+
+from janitor.singleflight import SingleFlight
+
+
+async def test_coalesce():
+    single_flight = SingleFlight()
+    calls = []
+    event = asyncio.Event()
+
+    async def compute():
+        calls.append(1)
+        await event.wait()
+        return b"result"
+
+    tasks = [
+        asyncio.create_task(single_flight.do(("debdiff", "a", "b"), compute))
+        for i in range(5)
+    ]
+    await asyncio.sleep(0)
+    assert ("debdiff", "a", "b") in single_flight
+    event.set()
+    assert await asyncio.gather(*tasks) == [b"result"] * 5
+    assert calls == [1]
+    assert ("debdiff", "a", "b") not in single_flight
+
+    # Once the computation has finished, a new one is started
+    assert await single_flight.do(("debdiff", "a", "b"), compute) == b"result"
+    assert calls == [1, 1]
+
+
+async def test_different_keys():
+    single_flight = SingleFlight()
+
+    async def compute(value):
+        await asyncio.sleep(0)
+        return value
+
+    assert await asyncio.gather(
+        single_flight.do(("debdiff", "a", "b"), lambda: compute(1)),
+        single_flight.do(("diffoscope", "a", "b"), lambda: compute(2)),
+    ) == [1, 2]
+
+
+async def test_error_shared():
+    single_flight = SingleFlight()
+    event = asyncio.Event()
+
+    async def compute():
+        await event.wait()
+        raise KeyError("missing")
+
+    tasks = [asyncio.create_task(single_flight.do("key", compute)) for i in range(2)]
+    await asyncio.sleep(0)
+    event.set()
+    for task in tasks:
+        with pytest.raises(KeyError):
+            await task
+    assert "key" not in single_flight
+
+
+async def test_cancelled_caller():
+    single_flight = SingleFlight()
+    event = asyncio.Event()
+
+    async def compute():
+        await event.wait()
+        return 42
+
+    leader = asyncio.create_task(single_flight.do("key", compute))
+    follower = asyncio.create_task(single_flight.do("key", compute))
+    await asyncio.sleep(0)
+    leader.cancel()
+    await asyncio.sleep(0)
+    event.set()
+    assert await follower == 42
@@ -0,0 +1,85 @@
+from janitor.state import check_publish_ready
+
+
+async def create_publishable_run(con):
+    await con.execute("INSERT INTO codebase (name) VALUES ('foo')")
+    await con.execute(
+        "INSERT INTO named_publish_policy (name, per_branch_policy) VALUES "
+        "('default', ARRAY[ROW('main', 'propose', NULL)::branch_publish_policy])"
+    )
+    await con.execute(
+        "INSERT INTO change_set (id, campaign) VALUES ('cs1', 'bar')",
+    )
+    await con.execute(
+        "INSERT INTO candidate (codebase, suite, command, publish_policy) "
+        "VALUES ('foo', 'bar', 'true', 'default')"
+    )
+    await con.execute(
+        "INSERT INTO run (id, codebase, suite, command, result_code, "
+        "start_time, finish_time, revision, logfilenames, change_set) "
+        "VALUES ('run1', 'foo', 'bar', 'true', 'success', now(), now(), "
+        "'rev1', ARRAY[]::text[], 'cs1')"
+    )
+    await con.execute(
+        "INSERT INTO new_result_branch "
+        "(run_id, role, remote_name, base_revision, revision) "
+        "VALUES ('run1', 'main', 'master', 'rev0', 'rev1')"
+    )
+
+
+async def test_publish_ready_maintained(con):
+    assert await con.fetch("SELECT id FROM publish_ready") == []
+    await create_publishable_run(con)
+    assert [row["id"] for row in await con.fetch("SELECT id FROM publish_ready")] == [
+        "run1"
+    ]
+    assert await check_publish_ready(con) == []
+
+    await con.execute("UPDATE run SET publish_status = 'approved' WHERE id = 'run1'")
+    assert (
+        await con.fetchval("SELECT publish_status FROM publish_ready WHERE id = 'run1'")
+        == "approved"
+    )
+    assert await check_publish_ready(con) == []
+
+    await con.execute(
+        "UPDATE named_publish_policy SET rate_limit_bucket = 'bucket' "
+        "WHERE name = 'default'"
+    )
+    assert (
+        await con.fetchval(
+            "SELECT rate_limit_bucket FROM publish_ready WHERE id = 'run1'"
+        )
+        == "bucket"
+    )
+    assert await check_publish_ready(con) == []
+
+    await con.execute(
+        "UPDATE new_result_branch SET absorbed = true WHERE run_id = 'run1'"
+    )
+    assert await con.fetch("SELECT id FROM publish_ready") == []
+    assert await check_publish_ready(con) == []
+
+
+async def test_publish_ready_multiple_change_sets(con):
+    await create_publishable_run(con)
+    await con.execute(
+        "INSERT INTO change_set (id, campaign) VALUES ('cs2', 'bar')",
+    )
+    await con.execute(
+        "INSERT INTO candidate (codebase, suite, command, publish_policy, "
+        "change_set) VALUES ('foo', 'bar', 'false', 'default', 'cs2')"
+    )
+    assert [
+        (row["id"], row["policy_command"])
+        for row in await con.fetch("SELECT id, policy_command FROM publish_ready")
+    ] == [("run1", "true")]
+    assert await check_publish_ready(con) == []
+
+
+async def test_check_publish_ready_repair(con):
+    await create_publishable_run(con)
+    await con.execute("DELETE FROM publish_ready")
+    assert await check_publish_ready(con) == [("foo", "bar")]
+    assert await check_publish_ready(con, repair=True) == [("foo", "bar")]
+    assert await check_publish_ready(con) == []
@@ -0,0 +1,72 @@
+import asyncio
+
+from janitor.debian.suite_index import SuiteIndex
+
+
+class Fetcher:
+    def __init__(self, stanzas):
+        self.stanzas = stanzas
+        self.fetched = []
+
+    async def __call__(self, run_id):
+        self.fetched.append(run_id)
+        return self.stanzas.get(run_id)
+
+
+async def test_update_incremental(tmp_path):
+    index = SuiteIndex(str(tmp_path / "suite" / "main" / "binary-amd64"))
+    fetch = Fetcher({"a": b"Package: a\n\n", "b": b"Package: b\n\n"})
+    assert await index.update(["a", "b"], fetch) == [
+        b"Package: a\n\n",
+        b"Package: b\n\n",
+    ]
+    assert fetch.fetched == ["a", "b"]
+
+    fetch = Fetcher({"c": b"Package: c\n\n"})
+    assert await index.update(["b", "c"], fetch) == [
+        b"Package: b\n\n",
+        b"Package: c\n\n",
+    ]
+    assert fetch.fetched == ["c"]
+    assert list(index.load()) == ["b", "c"]
+
+
+async def test_update_missing(tmp_path):
+    index = SuiteIndex(str(tmp_path / "index"))
+    fetch = Fetcher({"a": b"Package: a\n\n"})
+    assert await index.update(["a", "b"], fetch) == [b"Package: a\n\n"]
+    # Missing stanzas are not recorded, so they are retried
+    fetch = Fetcher({"b": b"Package: b\n\n"})
+    assert await index.update(["a", "b"], fetch) == [
+        b"Package: a\n\n",
+        b"Package: b\n\n",
+    ]
+    assert fetch.fetched == ["b"]
+
+
+async def test_corrupt(tmp_path):
+    path = tmp_path / "index"
+    path.write_bytes(b"a 100\nPackage: a\n")
+    index = SuiteIndex(str(path))
+    assert index.load() == {}
+    fetch = Fetcher({"a": b"Package: a\n\n"})
+    assert await index.update(["a"], fetch) == [b"Package: a\n\n"]
+    assert index.load() == {"a": b"Package: a\n\n"}
+
+
+async def test_update_concurrent(tmp_path):
+    index = SuiteIndex(str(tmp_path / "index"))
+    running = 0
+    max_running = 0
+
+    async def fetch(run_id):
+        nonlocal running, max_running
+        running += 1
+        max_running = max(max_running, running)
+        await asyncio.sleep(0.01)
+        running -= 1
+        return run_id.encode()
+
+    keys = [str(i) for i in range(10)]
+    assert await index.update(keys, fetch, concurrency=4) == [k.encode() for k in keys]
+    assert max_running == 4